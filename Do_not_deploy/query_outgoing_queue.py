@@ -1,6 +1,10 @@
-from kombu import Connection, Exchange, Queue
-from flask import Flask
+from kombu import Connection, Exchange, Queue, Consumer
+from flask import Flask, Response, request
+from application.archive import Record, to_json
 import os
+import socket
+import json
+from collections import deque
 
 app = Flask(__name__)
 app.config.from_object(os.environ.get('SETTINGS'))
@@ -14,6 +18,53 @@ connection = Connection(app.config['OUTGOING_QUEUE_HOSTNAME'])
 queue = Queue(app.config['OUTGOING_QUEUE'], exchange, routing_key='#')(connection)
 queue.declare()
 
+# Bulk reads: messages delivered ahead of being consumed, and how long to wait for more (seconds).
+PREFETCH_COUNT = int(os.getenv('INSPECTOR_PREFETCH_COUNT', 500))
+WAIT = float(os.getenv('INSPECTOR_WAIT', 1))
+
+# Exports are written to this directory only.
+EXPORT_DIR = os.getenv('INSPECTOR_EXPORT_DIR', '/tmp')
+
+
+def as_record(message):
+    """ 'message' in the form of an 'archive.Record', e.g. for export (and replay). """
+
+    headers = dict(message.headers or {})
+    return Record(message.body, message.content_type, message.content_encoding, headers,
+                  message.delivery_info.get('routing_key'), headers.pop('compression', None), None)
+
+
+def consume(n=None):
+    """ Up to 'n' messages (None for all) from the queue, removing them as they go; on a connection of its own.
+
+        Messages are prefetched, so there is no round trip per message (as for 'queue.get()'), and acknowledged once
+        consumed (Basic.Ack has no reply). Any not consumed, e.g. as the client has gone, go back to the queue.
+
+    """
+
+    with Connection(app.config['OUTGOING_QUEUE_HOSTNAME']) as _connection:
+        received = deque()
+        consumer = Consumer(_connection.channel(), queues=[queue], on_message=received.append)
+        consumer.qos(prefetch_count=min(n, PREFETCH_COUNT) if n else PREFETCH_COUNT)
+        consumer.consume()
+
+        count = 0
+        try:
+            while n is None or count < n:
+                if not received:
+                    try:
+                        _connection.drain_events(timeout=WAIT)
+                    except socket.timeout:
+                        break
+                    continue
+
+                message = received.popleft()
+                yield message
+                message.ack()
+                count += 1
+        finally:
+            consumer.cancel()
+
 
 @app.route("/getnextqueuemessage")
 #Gets the next message from target queue.  Returns the signed JSON.
@@ -28,21 +79,43 @@ def get_last_queue_message():
         return "no message", 404
 
 
+@app.route("/getnextqueuemessages")
+#Gets (and removes) the next 'n' messages from target queue, as a JSON array streamed as they arrive.
+#Each message is given as in an export (see 'application/archive.py').
+def get_next_queue_messages():
+    n = request.args.get('n', 1, type=int)
+    if n < 1:
+        return "'n' must be positive", 400
+
+    def stream():
+        yield '['
+        for count, message in enumerate(consume(n)):
+            yield (',\n' if count else '\n') + to_json(as_record(message))
+        yield '\n]\n'
+
+    return Response(stream(), mimetype='application/json')
+
 
 @app.route("/removeallmessages")
-#Gets the next message from target queue.  Returns the signed JSON.
+#Removes all messages from target queue, by purging it.
+#With 'export=<file name>', they are first consumed and written (as JSONL, for replay) to that file in EXPORT_DIR.
 def remove_all_messages():
-    while True:
-        message = queue.get()
+    export = request.args.get('export')
+    exported = 0
+
+    if export:
+        path = os.path.join(EXPORT_DIR, os.path.basename(export))
+        with open(path, 'w') as f:
+            for message in consume():
+                f.write(to_json(as_record(message)) + '\n')
+                exported += 1
 
-        if message:
-            message.ack() #acknowledges message, ensuring its removal.
-        else:
-            break
-    return "done", 202
+    # Anything that has arrived since is purged too (unexported).
+    purged = queue.purge()
+
+    return json.dumps({'exported': exported, 'purged': purged}), 202
 
 
 @app.route("/")
 def check_status():
     return "Everything is OK"
-
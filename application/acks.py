@@ -0,0 +1,119 @@
+#!/bin/python
+import time
+import logging
+from collections import OrderedDict
+
+
+"""
+Batched acknowledgement of incoming messages.
+
+Basic.Ack's 'multiple' flag acknowledges every unacknowledged delivery on a channel up to and including the given
+delivery tag, so one frame can acknowledge many messages. That is only safe once every earlier delivery has been dealt
+with, so messages are tracked in delivery order and only the completed "prefix" is ever acknowledged.
+
+"""
+
+logger = logging.getLogger('RP.acks')
+
+
+class BatchAcker(object):
+    """ Acknowledge messages every 'size' messages or 'interval' seconds, whichever comes first.
+
+        'on_ack(message)' is called for each message once its acknowledgement has been sent.
+
+    """
+
+    def __init__(self, size=10, interval=0.1, on_ack=None):
+
+        # Run-time checks.
+        assert size > 0
+        assert interval > 0
+
+        self.size = size
+        self.interval = interval
+        self.on_ack = on_ack
+
+        self.channel = None
+        self.outstanding = OrderedDict()    # Delivery tag -> [message, settled, acked], in delivery order.
+        self.ready = []                     # Settled messages that have yet to be acknowledged.
+        self.last_tag = None                # Highest delivery tag that may be acknowledged.
+        self.ready_since = None             # When the oldest of 'ready' was settled.
+
+    def __len__(self):
+        return len(self.outstanding) + len(self.ready)
+
+    def received(self, message):
+        """ Track 'message', which has just been delivered. """
+
+        if message.channel is not self.channel:
+            # New channel (e.g. after reconnection): unacknowledged deliveries on the old one will be redelivered.
+            self.flush()
+            self.channel = message.channel
+            self.outstanding.clear()
+            self.ready = []
+            self.last_tag = None
+
+        self.outstanding[message.delivery_tag] = [message, False, False]
+
+    def ack(self, message):
+        """ Mark 'message' as ready for acknowledgement. """
+
+        self._settle(message, acked=True)
+
+    def requeue(self, message):
+        """ Return 'message' to its queue now; it is then skipped by the next batch acknowledgement. """
+
+        message.requeue()
+        self._settle(message, acked=False)
+
+    def tick(self):
+        """ Acknowledge anything that has been ready for longer than 'interval'. """
+
+        if self.ready_since is not None and time.monotonic() - self.ready_since >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """ Acknowledge all ready messages, with a single Basic.Ack. """
+
+        if self.last_tag is None:
+            return
+
+        self.channel.basic_ack(self.last_tag, multiple=True)
+        logger.debug('Acknowledged {} message(s), up to: {}'.format(len(self.ready), self.last_tag))
+
+        ready = self.ready
+        self.ready = []
+        self.last_tag = None
+        self.ready_since = None
+
+        if self.on_ack is not None:
+            for message in ready:
+                self.on_ack(message)
+
+    def _settle(self, message, acked):
+
+        # Ignore messages from a previous channel.
+        if message.channel is not self.channel:
+            return
+
+        entry = self.outstanding.get(message.delivery_tag)
+        if entry is None:
+            return
+        entry[1] = True
+        entry[2] = acked
+
+        # Advance over the completed prefix of deliveries.
+        while self.outstanding:
+            delivery_tag, (message, settled, acked) = next(iter(self.outstanding.items()))
+            if not settled:
+                break
+            del self.outstanding[delivery_tag]
+
+            if acked:
+                self.ready.append(message)
+                self.last_tag = delivery_tag
+                if self.ready_since is None:
+                    self.ready_since = time.monotonic()
+
+        if len(self.ready) >= self.size:
+            self.flush()
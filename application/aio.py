@@ -0,0 +1,326 @@
+#!/bin/python
+import time
+import asyncio
+import threading
+import kombu.compression
+import kombu.serialization
+from . import forwarder
+from .forwarder import (incoming_cfg, outgoing_cfg, setup_logger, setup_audit_logger, setup_dedup_cache, needs_decode,
+                        LOG_NAME, STAGES, LATENCY_HISTOGRAMS, LATENCY_WINDOW, PREFETCH_COUNT, CONNECT_TIMEOUT,
+                        CONFIRM_TIMEOUT, RECONNECT_INTERVAL, RECONNECT_INTERVAL_MAX, ACCEPT_CONTENT, POLL_INTERVAL,
+                        IDLE_INTERVAL, WORKER_MODE, COMPRESSION, COMPRESSION_THRESHOLD, routing_key)
+from .workers import WorkerStats
+from .backoff import Backoff
+from .compression import setup_compressor
+from .dedup import dedup_key
+from .sources import configurations
+from .sharding import hostnames
+from .audit import AuditRecord, remove_username_password, PULL, PUSH, PUSH_ACK, PULL_ACK, DUPLICATE
+
+# Optional dependency, for ENGINE 'asyncio' only.
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+# Content types accepted for decoding, as per the kombu consumer's 'accept'.
+ACCEPT = kombu.serialization.prepare_accept_content(ACCEPT_CONTENT)
+
+
+"""
+Forwarding engine on an asyncio event loop (ENGINE 'asyncio'), via the 'aio-pika' AMQP client.
+
+Each delivered message is handled in a task of its own, so up to PREFETCH_COUNT messages are in flight at once, their
+publishes awaiting confirmation concurrently. Otherwise, messages are forwarded as by 'forwarder.run()': with the same
+audit records, and with each incoming message acknowledged only once its publication has been confirmed (or requeued
+if it could not be published). 'aio_pika.connect_robust()' reconnects, and resumes consuming, after connection loss.
+
+"""
+
+
+async def declare_exchange(channel, cfg):
+    """ Exchange 'cfg.exchange', declared (unless it is the default exchange). """
+
+    if not cfg.exchange.name:
+        return channel.default_exchange
+
+    return await channel.declare_exchange(cfg.exchange.name, cfg.exchange.type, durable=cfg.exchange.durable)
+
+
+async def declare_queue(channel, cfg, exchange):
+    """ Queue 'cfg.queue', declared and bound to 'exchange' with 'cfg.binding_key'; as 'forwarder.setup_queue()'. """
+
+    queue = await channel.declare_queue(cfg.queue, durable=True)
+
+    # Every queue is bound to the default exchange anyway.
+    if exchange.name:
+        await queue.bind(exchange, routing_key=cfg.binding_key)
+
+    return queue
+
+
+def unsupported(incoming=incoming_cfg, outgoing=outgoing_cfg):
+    """ Settings that are in effect but that this engine does not support (see 'forwarder.run()' for them), for
+        forwarding from 'incoming' to 'outgoing'.
+
+    """
+
+    features = []
+    if forwarder.SIGNING_KEY:
+        features.append('SIGNING_KEY')
+    if forwarder.SPOOL_DIR:
+        features.append('SPOOL_DIR')
+    if forwarder.ARCHIVE_DIR:
+        features.append('ARCHIVE_DIR')
+    if forwarder.batch_cfg.exchange.name:
+        features.append('BATCH_EXCHANGE')
+    if forwarder.INCOMING_LANES:
+        features.append('INCOMING_LANES')
+    if forwarder.BACKPRESSURE:
+        features.append('BACKPRESSURE')
+    if forwarder.CONFIRM_MODE != 'sync':
+        features.append('CONFIRM_MODE')
+    if forwarder.ACK_BATCH_SIZE > 1:
+        features.append('ACK_BATCH_SIZE')
+    if len(configurations(incoming)) > 1:
+        features.append('INCOMING_QUEUE_HOSTNAME (several brokers)')
+    if len(hostnames(outgoing.hostname)) > 1:
+        features.append('OUTGOING_QUEUE_HOSTNAME (several brokers)')
+
+    return features
+
+
+def check(incoming=incoming_cfg, outgoing=outgoing_cfg):
+    """ Raise RuntimeError if anything is configured that this engine does not support, rather than ignore it. """
+
+    features = unsupported(incoming, outgoing)
+    if features:
+        raise RuntimeError("ENGINE 'asyncio' does not support: {}; use ENGINE 'kombu'.".format(', '.join(features)))
+
+
+def outgoing_message(message, compressor=None):
+    """ The message to publish for (incoming) 'message'; its body is only unpacked and packed again if necessary.
+
+        A body that was compressed when received is forwarded as it is; otherwise it is compressed by 'compressor'.
+
+    """
+
+    headers = dict(message.headers or {})
+    body, content_type, content_encoding = message.body, message.content_type, message.content_encoding
+
+    if needs_decode(message):
+        compression = headers.pop('compression', None)
+        if compression:
+            body = kombu.compression.decompress(body, compression)
+        data = kombu.serialization.loads(body, content_type, content_encoding, accept=ACCEPT)
+        content_type, content_encoding, body = kombu.serialization.dumps(data, serializer='json')
+
+    if compressor is not None:
+        body, headers = compressor.compress(body, headers)
+
+    return aio_pika.Message(body, content_type=content_type, content_encoding=content_encoding, headers=headers,
+                            delivery_mode=aio_pika.DeliveryMode.PERSISTENT)
+
+
+class AsyncForwarder(object):
+    """ Forwards from 'incoming' to 'outgoing' (configurations) once started, updating 'stats'. """
+
+    def __init__(self, incoming, outgoing, stats, audit_logger, logger, dedup=None):
+        self.incoming = incoming
+        self.outgoing = outgoing
+        self.stats = stats
+        self.latency = stats.latency
+        self.compressor = setup_compressor(COMPRESSION, COMPRESSION_THRESHOLD, stats)
+        self.dedup = dedup
+        self.audit_logger = audit_logger
+        self.logger = logger
+
+        # Queue addresses for audit purposes, without credentials.
+        self.incoming_address = remove_username_password(incoming.hostname)
+        self.outgoing_address = remove_username_password(outgoing.hostname)
+
+        self.connections = []
+        self.exchange = None
+        self.queue = None
+        self.consumer_tag = None
+        self.in_flight = 0
+
+    async def connect(self, hostname):
+        if aio_pika is None:
+            raise RuntimeError("ENGINE 'asyncio' requires the 'aio-pika' package.")
+
+        connection = await aio_pika.connect_robust(hostname, timeout=CONNECT_TIMEOUT)
+        connection.reconnect_callbacks.add(self.on_reconnect)
+        self.connections.append(connection)
+
+        return connection
+
+    def on_reconnect(self, *args):
+        self.logger.info('Reconnected.')
+        self.stats.incr('reconnects')
+
+    async def start(self):
+        """ Declare the topology, as per 'forwarder.setup_producer()' and 'setup_consumer()', then consume. """
+
+        # Outgoing exchange, with publisher confirms; the outgoing queue stores messages *before* publication.
+        connection = await self.connect(self.outgoing.hostname)
+        channel = await connection.channel(publisher_confirms=True)
+        self.exchange = await declare_exchange(channel, self.outgoing)
+        await declare_queue(channel, self.outgoing, self.exchange)
+
+        connection = await self.connect(self.incoming.hostname)
+        channel = await connection.channel()
+        if PREFETCH_COUNT:
+            await channel.set_qos(prefetch_count=PREFETCH_COUNT)
+        self.queue = await declare_queue(channel, self.incoming, await declare_exchange(channel, self.incoming))
+
+        self.consumer_tag = await self.queue.consume(self.process_message)
+        self.logger.info("queue_name: {}".format(self.incoming.queue))
+
+    async def stop(self, timeout=CONFIRM_TIMEOUT):
+        """ Stop consuming, then close the connections once messages in flight have been dealt with. """
+
+        if self.consumer_tag is not None:
+            await self.queue.cancel(self.consumer_tag)
+            self.consumer_tag = None
+
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(POLL_INTERVAL)
+
+        if self.in_flight:
+            self.logger.error("Stopped with {} message(s) in flight.".format(self.in_flight))
+
+        for connection in self.connections:
+            await connection.close()
+        self.connections = []
+
+    async def process_message(self, message):
+        """ Forward 'message' (a task per message); acknowledged only once its publication has been confirmed. """
+
+        latency = self.latency
+        started = latency.start()
+
+        self.in_flight += 1
+        self.stats.incr('consumed')
+        try:
+            # Header (which contains the title number) and delivery details, for the audit records.
+            header = message.headers
+            delivery_info = dict(delivery_tag=message.delivery_tag, exchange=message.exchange,
+                                 routing_key=message.routing_key, redelivered=message.redelivered)
+            lap = latency.lap('header', started)
+
+            self.audit_logger.audit(AuditRecord(PULL, delivery_info, header, self.incoming_address))
+
+            # A redelivered message may have been published already, before the forwarder died; if so, just ack it.
+            message_key = dedup_key(message.message_id, message.body) if self.dedup is not None else None
+            if message_key is not None and message.redelivered:
+                self.stats.incr('dedup_checks')
+                if self.dedup.seen(message_key):
+                    self.stats.incr('duplicates')
+                    self.audit_logger.audit(AuditRecord(DUPLICATE, delivery_info, header, self.incoming_address))
+                    await self.ack(message, header, latency.lap('audit', lap))
+                    return
+
+            self.audit_logger.audit(AuditRecord(PUSH, delivery_info, header, self.incoming_address))
+            lap = latency.lap('audit', lap)
+
+            outgoing = outgoing_message(message, self.compressor)
+            key = routing_key(message.headers) if routing_key is not None else self.outgoing.queue
+            try:
+                await self.exchange.publish(outgoing, routing_key=key)
+            except Exception as e:
+                self.stats.incr('publish_errors')
+                await self.requeue(message, e)
+                return
+            self.stats.incr('published')
+            lap = latency.lap('publish', lap)
+
+            self.audit_logger.audit(AuditRecord(PUSH_ACK, message.delivery_tag, header, self.outgoing_address))
+            self.stats.set('last_forward', time.time())
+
+            if message_key is not None:
+                self.dedup.add(message_key)
+
+            # Acknowledge message only after publish; if that fails, message is still in queue.
+            await self.ack(message, header, lap)
+
+        # Trap (log) everything else; the message is redelivered if it has not been acknowledged.
+        except Exception as e:
+            self.logger.exception("process_message: {}".format(e))
+            self.stats.incr('errors')
+        finally:
+            self.in_flight -= 1
+            latency.lap('process', started)
+
+    async def ack(self, message, header, lap):
+        """ Acknowledge 'message'; 'lap' is as for 'latency.lap()'. """
+
+        await message.ack()
+        lap = self.latency.lap('ack', lap)
+        self.stats.incr('acked')
+
+        self.audit_logger.audit(AuditRecord(PULL_ACK, message.delivery_tag, header, self.outgoing_address))
+        self.latency.lap('audit', lap)
+
+    async def requeue(self, message, error):
+        """ Return 'message' to the incoming queue, as it could not be published. """
+
+        self.logger.error("Publish failed ({}), requeue: {}".format(error, message.delivery_tag))
+        self.stats.incr('requeued')
+        try:
+            await message.nack(requeue=True)
+        # Message is redelivered anyway if the incoming channel has gone.
+        except Exception as e:
+            self.logger.error("Requeue failed: {}".format(e))
+
+
+async def forward(engine, stop, stats, logger):
+    """ Run 'engine' until the 'stop' event is set, retrying (with backoff) until it can be started. """
+
+    backoff = Backoff(initial=RECONNECT_INTERVAL, maximum=RECONNECT_INTERVAL_MAX)
+
+    while not stop.is_set():
+        try:
+            await engine.start()
+            break
+        except Exception as e:
+            logger.exception("start: {}".format(e))
+            stats.incr('errors')
+            await engine.stop(timeout=0)
+            await asyncio.sleep(backoff.next())
+
+    # The 'stop' event belongs to the worker pool, so it is polled rather than awaited. A worker process's own audit
+    # sink etc. are sampled meanwhile, for the parent.
+    while not stop.is_set():
+        await asyncio.sleep(IDLE_INTERVAL)
+        if WORKER_MODE == 'process':
+            forwarder.sample_process_stats(stats)
+
+    await engine.stop()
+
+
+def run(worker_id=0, stats=None, stop=None, incoming=incoming_cfg, outgoing=outgoing_cfg):
+    """ As 'forwarder.run()', but forwarding via an 'AsyncForwarder' on an event loop of its own. """
+
+    logger = setup_logger(LOG_NAME + '.aio')
+    logger.info("worker_id: {}".format(worker_id))
+
+    # E.g. messages must not be published unsigned if they are meant to be signed.
+    check(incoming, outgoing)
+
+    if stats is None:
+        stats = WorkerStats(STAGES if LATENCY_HISTOGRAMS else None, LATENCY_WINDOW)
+    if stop is None:
+        stop = threading.Event()
+
+    engine = AsyncForwarder(incoming, outgoing, stats, setup_audit_logger(), logger, setup_dedup_cache(worker_id))
+    try:
+        asyncio.run(forward(engine, stop, stats, logger))
+    # Permit an explicit abort.
+    except KeyboardInterrupt:
+        logger.error("KeyboardInterrupt received!")
+
+    # A worker process is about to exit, so write out its outstanding audit records.
+    if WORKER_MODE == 'process' and forwarder.audit_sink is not None:
+        forwarder.audit_sink.stop()
@@ -0,0 +1,152 @@
+#!/bin/python
+import os
+import sys
+import json
+import time
+import base64
+import logging
+from collections import namedtuple
+from .spool import read_segment, in_use, SUFFIX
+
+
+"""
+Archives of forwarded messages, e.g. for replay (see 'replay.py').
+
+The forwarder archives each message it has forwarded (once its publication has been confirmed) if 'ARCHIVE_DIR' is
+set: a JSONL export per worker per day (UTC), as 'ARCHIVE_DIR/<worker>/<YYYY-MM-DD>.jsonl' (see 'Archive'). Files are
+not rotated or removed by the forwarder, and are written to without 'fsync'; what a crash loses is still in the spool or
+the incoming queue, if it has not been forwarded.
+
+Two kinds of archive are read: a directory (any '*.jsonl' exports and '*.seg' spool segments beneath it, in name order -
+i.e. oldest first - within each directory) and a JSONL export, with one message per line:
+
+    {"body": "...", "content_type": "application/json", "content_encoding": "utf-8", "headers": {...},
+     "routing_key": "...", "compression": null, "timestamp": 1500000000.0}
+
+Binary bodies are exported as "body_base64" instead of "body"; everything but the body is optional.
+
+A spool holds messages that have yet to be forwarded, so one that is in use (i.e. still to be drained by a worker) is
+never read.
+
+"""
+
+logger = logging.getLogger('RP.archive')
+
+# An archived message; 'timestamp' is when it was forwarded (or spooled), as seconds since the epoch, if known.
+Record = namedtuple('Record', ['body', 'content_type', 'content_encoding', 'headers', 'routing_key', 'compression',
+                               'timestamp'])
+
+EXPORT_SUFFIX = '.jsonl'
+
+
+def to_json(record):
+    """ 'record' as a line of a JSONL export (without the newline). """
+
+    data = dict(record._asdict())
+    body = data.pop('body')
+    try:
+        data['body'] = body.decode(record.content_encoding or 'utf-8') if isinstance(body, bytes) else body
+    except (UnicodeDecodeError, LookupError):
+        data['body_base64'] = base64.b64encode(body).decode('ascii')
+
+    return json.dumps(data, default=str, sort_keys=True)
+
+
+def from_json(line):
+    """ Record for a line of a JSONL export. """
+
+    data = json.loads(line)
+
+    content_encoding = data.get('content_encoding')
+    if 'body_base64' in data:
+        body = base64.b64decode(data['body_base64'])
+    else:
+        body = data['body']
+        # Hand-written exports may embed JSON bodies as such.
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        body = body.encode(content_encoding or 'utf-8')
+
+    return Record(body, data.get('content_type', 'application/json'), content_encoding, data.get('headers') or {},
+                  data.get('routing_key'), data.get('compression'), data.get('timestamp'))
+
+
+def read_jsonl(path):
+    """ Records of the JSONL export at 'path' ('-' for stdin); blank lines are skipped. """
+
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    yield from_json(line)
+                except (ValueError, KeyError) as e:
+                    raise ValueError("{}, line {}: {}".format(path, number, e))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def read_directory(directory):
+    """ Records of the exports and spool segments in 'directory', including any per-worker directories beneath it. """
+
+    for path, directories, files in os.walk(directory):
+        directories.sort()
+        for name in sorted(files):
+            if name.endswith(EXPORT_SUFFIX):
+                yield from read_jsonl(os.path.join(path, name))
+            elif name.endswith(SUFFIX):
+                for meta, body in read_segment(os.path.join(path, name)):
+                    yield Record(body, meta.get('content_type'), meta.get('content_encoding'),
+                                 meta.get('headers') or {}, meta.get('routing_key'), meta.get('compression'),
+                                 meta.get('t'))
+
+
+def read_archive(path):
+    """ Records of the archive at 'path': a directory (see 'read_directory()') or a JSONL export.
+
+        Raises RuntimeError if there is a spool in use in the directory, whose messages would be published twice.
+
+    """
+
+    if os.path.isdir(path):
+        for directory, _, files in os.walk(path):
+            if any(name.endswith(SUFFIX) for name in files) and in_use(directory):
+                raise RuntimeError("Spool {} is in use; not replayed".format(directory))
+        return read_directory(path)
+
+    return read_jsonl(path)
+
+
+class Archive(object):
+    """ Writes forwarded messages to JSONL exports in 'directory' (created if necessary), one per day (UTC). """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        self.file = None
+        self.day = None
+        self.written = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, record):
+        """ Append 'record' to the export for the day of its timestamp; not necessarily written out until 'flush()'. """
+
+        day = time.strftime('%Y-%m-%d', time.gmtime(record.timestamp))
+        if day != self.day:
+            self.close()
+            self.file = open(os.path.join(self.directory, day + EXPORT_SUFFIX), 'a')
+            self.day = day
+
+        self.file.write(to_json(record) + '\n')
+        self.written += 1
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = self.day = None
@@ -0,0 +1,229 @@
+#!/bin/python
+import os
+import pwd
+import re
+import time
+import queue
+import logging
+import threading
+
+
+"""
+Audit trail for forwarded messages; see "Audit Requirements" in the README.
+
+Each message gives rise to four audit events (or three, for a suppressed duplicate). These are logged as 'AuditRecord'
+instances rather than strings: the text is only built (by 'make_log_msg()') if a log handler actually formats the
+record, and handlers may also inspect the record's fields directly.
+
+Optionally, an 'AuditSink' moves the handlers themselves off the forwarding path.
+
+"""
+
+# Audit events.
+PULL = " Pull from incoming queue: {}"
+PUSH = " Push to outgoing queue: {}"
+PUSH_ACK = "Push Acknowledged (implied): {}"
+PULL_ACK = "Acknowledged Pull: {}"
+DUPLICATE = "Duplicate (redelivered, already pushed), not pushed again: {}"
+SPOOLED = " Spooled (outgoing queue unavailable): {}"
+UNSPOOLED = "Push Acknowledged (from spool): {}"
+REPLAYED = " Replay to outgoing queue (forwarded at): {}"
+REPLAY_ACK = "Replay Acknowledged (forwarded at): {}"
+
+
+def linux_user():
+    try:
+        return pwd.getpwuid(os.geteuid()).pw_name
+    except Exception as err:
+        return "failed to get user: %s" % err
+
+# Per-process constant.
+LINUX_USER = linux_user()
+
+
+def remove_username_password(endpoint_string):
+    try:
+        return re.sub('://[^:]+:[^@]+@', '://', endpoint_string)
+    except:
+        return "unknown endpoint"
+
+
+def make_log_msg(log_message, log_level, message_header, hostname):
+    #Constructs the message to submit to audit. Message header contains title number.
+    msg = log_message + ' queue address is: %s. ' % hostname
+    msg = msg + ' Signed in as: %s. ' % LINUX_USER
+    msg = msg + ' Message header is: %s. ' % message_header
+    msg = msg + ' Logged at: register-publisher/logs. '
+    return msg
+
+
+class AuditRecord(object):
+    """ An audit event for a message: 'event' (above) is formatted with 'detail', e.g. the delivery tag.
+
+        'hostname' should already have had any credentials removed.
+
+    """
+
+    __slots__ = ('event', 'detail', 'header', 'hostname')
+
+    def __init__(self, event, detail, header, hostname):
+        self.event = event
+        self.detail = detail
+        self.header = header
+        self.hostname = hostname
+
+    def __str__(self):
+        return make_log_msg(self.event.format(self.detail), 'debug', self.header, self.hostname)
+
+    def __repr__(self):
+        return '<AuditRecord: {!r}, {!r}>'.format(self.event, self.detail)
+
+
+class AuditSink(object):
+    """ Takes the writing of audit records off the forwarding thread.
+
+        Records logged via the sink's logger are put on a bounded queue; a background thread hands them to the
+        logger's (original) handlers in batches, flushing - and, for files, fsync'ing - them every 'flush_interval'
+        seconds. When the queue is full, logging either blocks ('overflow' of 'block', for a strict audit trail) or
+        the record is dropped and counted ('drop').
+
+    """
+
+    def __init__(self, capacity=10000, batch_size=100, flush_interval=1.0, overflow='block'):
+
+        # Run-time checks.
+        assert capacity > 0
+        assert batch_size > 0
+        assert flush_interval > 0
+        assert overflow in ('block', 'drop')
+
+        self.queue = queue.Queue(maxsize=capacity)
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+
+        self.handlers = []
+        self.thread = None
+        self.stopping = threading.Event()
+        self.drop_lock = threading.Lock()
+
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def install(self, logger):
+        """ Divert 'logger' (and its children) through the queue, then start the writer thread. """
+
+        # The handlers that would otherwise have been called, as per 'Logger.callHandlers()'.
+        current = logger
+        while current is not None:
+            self.handlers.extend(current.handlers)
+            if not current.propagate:
+                break
+            current = current.parent
+
+        logger.handlers = [_SinkHandler(self)]
+        logger.propagate = False
+
+        self.thread = threading.Thread(name='audit_sink', target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, record):
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.drop_lock:
+                self.dropped += 1
+
+    def stop(self, timeout=10):
+        """ Write out everything queued so far, then stop the writer thread. """
+
+        self.stopping.set()
+
+        # Wake the writer, if it is waiting for a record; if the queue is full, it is not waiting.
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def stats(self):
+        return dict(depth=self.queue.qsize(), capacity=self.capacity, overflow=self.overflow,
+                    written=self.written, dropped=self.dropped, batches=self.batches,
+                    last_flush_latency=self.last_flush_latency, max_flush_latency=self.max_flush_latency)
+
+    def _write(self):
+
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(last_flush + self.flush_interval - time.monotonic(), 0)
+            batch = self._get_batch(timeout)
+
+            for record in batch:
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            self.written += len(batch)
+            if batch:
+                self.batches += 1
+
+            stopping = self.stopping.is_set() and self.queue.empty()
+            if stopping or time.monotonic() - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = time.monotonic()
+
+            if stopping:
+                break
+
+    def _get_batch(self, timeout):
+
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # Less the wake-up call from 'stop()'.
+        return [record for record in batch if record is not None]
+
+    def _flush(self):
+
+        started = time.monotonic()
+        for handler in self.handlers:
+            try:
+                handler.flush()
+                stream = getattr(handler, 'stream', None)
+                if isinstance(handler, logging.FileHandler) and stream is not None:
+                    os.fsync(stream.fileno())
+            # Exceptions are handled silently, so logging doesn't impair the app.
+            except Exception:
+                pass
+
+        self.last_flush_latency = time.monotonic() - started
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+
+
+class _SinkHandler(logging.Handler):
+    """ Queues records for an 'AuditSink', unformatted. """
+
+    def __init__(self, sink):
+        logging.Handler.__init__(self)
+        self.sink = sink
+
+    def emit(self, record):
+        self.sink.put(record)
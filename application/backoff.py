@@ -0,0 +1,39 @@
+#!/bin/python
+import random
+
+
+"""
+Reconnection delays: exponential backoff with jitter.
+
+The first retry follows a failure almost at once (within 'initial' seconds), so that a broker failover is recovered from
+quickly; if the failure persists, the delay doubles up to 'maximum'. Half of each delay is random ("equal jitter"), so
+that workers (and other clients) that lost their connections together do not all retry together.
+
+"""
+
+
+class Backoff(object):
+    """ Successive delays for retrying after a connection failure, until 'reset()' after a success. """
+
+    def __init__(self, initial=0.1, maximum=10.0, multiplier=2.0):
+
+        # Run-time checks.
+        assert 0 < initial <= maximum
+        assert multiplier >= 1
+
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+
+        self.attempts = 0
+
+    def next(self):
+        """ Seconds to wait before the next attempt. """
+
+        ceiling = min(self.maximum, self.initial * self.multiplier ** self.attempts)
+        self.attempts += 1
+
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def reset(self):
+        self.attempts = 0
@@ -0,0 +1,104 @@
+#!/bin/python
+import time
+import logging
+
+
+"""
+Adaptive backpressure, driven by the depth of the outgoing queue.
+
+Forwarding into a queue whose consumers have fallen behind just moves the backlog onto the outgoing broker, which then
+suffers memory alarms. So the outgoing depth is sampled every 'interval' seconds (by passive 'queue_declare', as for
+the count endpoints) and forwarding is throttled accordingly:
+
+* up to the 'low' watermark: 'open', i.e. prefetch as configured and no limit on the publish rate.
+* from 'low' to 'high': 'throttled' - prefetch and publish rate are scaled down in proportion, to 'min_factor'.
+* at 'limit': 'paused' - consumption stops altogether, until the depth is back below 'high'.
+
+"""
+
+logger = logging.getLogger('RP.backpressure')
+
+OPEN = 0
+THROTTLED = 1
+PAUSED = 2
+
+STATES = ('open', 'throttled', 'paused')
+
+
+class Backpressure(object):
+    """ Throttling for outgoing depth 'sample()', with watermarks 'low' and 'high' and hard limit 'limit'.
+
+        'rate' is the publish rate (messages per second) once throttled, before scaling; see above.
+
+    """
+
+    def __init__(self, sample, low, high, limit, rate=500.0, interval=1.0, min_factor=0.1):
+
+        # Run-time checks.
+        assert 0 <= low < high <= limit
+        assert rate > 0
+        assert 0 < min_factor <= 1
+
+        self.sample = sample
+        self.low = low
+        self.high = high
+        self.limit = limit
+        self.rate = rate
+        self.interval = interval
+        self.min_factor = min_factor
+
+        self.state = OPEN
+        self.depth = None
+        self.factor = 1.0
+        self.sampled = None
+        self.next_publish = 0.0
+
+    def update(self, now=None):
+        """ Sample the outgoing depth, if it is time to, and adjust; True if that changed state or scaling. """
+
+        now = time.monotonic() if now is None else now
+        if self.sampled is not None and now - self.sampled < self.interval:
+            return False
+
+        self.sampled = now
+        self.depth = depth = self.sample()
+
+        if depth >= self.limit or (self.state == PAUSED and depth >= self.high):
+            state, factor = PAUSED, self.min_factor
+        elif depth <= self.low:
+            state, factor = OPEN, 1.0
+        else:
+            state = THROTTLED
+            factor = max(self.min_factor, 1.0 - float(depth - self.low) / (self.high - self.low))
+
+        # Don't chase small changes in depth (e.g. re-applying prefetch every time).
+        changed = state != self.state or abs(factor - self.factor) >= self.min_factor / 2
+        if changed:
+            if state != self.state:
+                logger.info("Backpressure: {} (outgoing depth {})".format(STATES[state], depth))
+            self.state = state
+            self.factor = factor
+
+        return changed
+
+    def scale(self, prefetch):
+        """ 'prefetch' (a consumer's configured prefetch limit) as it is now; 0 (unlimited) stays as it is. """
+
+        return max(1, int(prefetch * self.factor)) if prefetch else 0
+
+    def current_rate(self):
+        """ Publish rate now, in messages per second; None if there is no limit. """
+
+        return None if self.state == OPEN else self.rate * self.factor
+
+    def delay(self, now=None):
+        """ Seconds to wait before the next publish, to keep to the current rate. """
+
+        if self.state == OPEN:
+            return 0.0
+
+        now = time.monotonic() if now is None else now
+        start = max(now, self.next_publish)
+        self.next_publish = start + 1.0 / (self.rate * self.factor)
+
+        return start - now
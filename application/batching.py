@@ -0,0 +1,155 @@
+#!/bin/python
+import json
+import time
+import base64
+import struct
+import logging
+
+
+"""
+Batched envelopes, for downstream consumers that only want bulk loads.
+
+Alongside the usual per-message publish, messages are coalesced into envelopes of up to 'size' messages (or
+'interval' seconds of traffic), each published as a single message to a secondary exchange. Envelope formats:
+
+* 'json': a JSON array of {"headers": ..., "content_type": ..., "body": ...} objects. JSON bodies are spliced in
+  verbatim (i.e. not decoded and encoded again); other text is given as a string and anything else as "body_base64".
+* 'frames': a sequence of length-prefixed frames, each a JSON object (headers, content type and encoding) then the
+  raw body; see 'decode_frames()'.
+
+Envelopes have headers 'batch_size' and 'batch_format'.
+
+"""
+
+logger = logging.getLogger('RP.batching')
+
+FORMATS = {'json': 'application/json', 'frames': 'application/x-rp-frames'}
+
+LENGTH = struct.Struct('>I')
+
+
+def _encode_json(items):
+
+    elements = []
+    for body, content_type, content_encoding, headers in items:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        prefix = '{{"headers": {}, "content_type": {}, '.format(json.dumps(headers, default=str),
+                                                               json.dumps(content_type))
+
+        if content_type == 'application/json':
+            elements.append(prefix.encode('utf-8') + b'"body": ' + body + b'}')
+            continue
+
+        try:
+            value = json.dumps({'body': body.decode(content_encoding or 'utf-8')})
+        except (UnicodeDecodeError, LookupError):
+            value = json.dumps({'body_base64': base64.b64encode(body).decode('ascii')})
+        elements.append((prefix + value[1:]).encode('utf-8'))
+
+    return b'[' + b', '.join(elements) + b']'
+
+
+def _encode_frames(items):
+
+    frames = []
+    for body, content_type, content_encoding, headers in items:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        meta = json.dumps(dict(headers=headers, content_type=content_type, content_encoding=content_encoding),
+                          default=str).encode('utf-8')
+        frames.extend((LENGTH.pack(len(meta)), meta, LENGTH.pack(len(body)), body))
+
+    return b''.join(frames)
+
+
+def encode(items, format='json'):
+    """ Envelope body for 'items', a list of (body, content type, content encoding, headers). """
+
+    return _encode_json(items) if format == 'json' else _encode_frames(items)
+
+
+def decode_frames(data):
+    """ Generate (meta, body) for each frame of a 'frames' envelope; the reverse of 'encode(..., "frames")'. """
+
+    offset = 0
+    while offset < len(data):
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        meta = json.loads(bytes(data[offset:offset + length]).decode('utf-8'))
+        offset += length
+
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        yield meta, bytes(data[offset:offset + length])
+        offset += length
+
+
+class Batcher(object):
+    """ Coalesce messages into envelopes of up to 'size' messages, published at least every 'interval' seconds.
+
+        'publish(body, content_type, headers)' publishes an envelope, returning once the broker has confirmed it.
+        Then 'on_confirm(message)' is called for each message in the envelope - or 'on_reject(message)', if the
+        publish raised (in which case so does 'flush()').
+
+    """
+
+    def __init__(self, publish, on_confirm, on_reject, size=100, interval=1.0, format='json'):
+
+        # Run-time checks.
+        assert size > 0
+        assert interval > 0
+        assert format in FORMATS
+
+        self.publish = publish
+        self.on_confirm = on_confirm
+        self.on_reject = on_reject
+        self.size = size
+        self.interval = interval
+        self.format = format
+
+        self.messages = []
+        self.items = []
+        self.since = None                   # When the oldest message in the batch was added.
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, message, body, content_type, content_encoding, headers):
+        """ Add 'message' (with the body etc. to be enveloped) to the batch, publishing the batch if it is full. """
+
+        if self.since is None:
+            self.since = time.monotonic()
+
+        self.messages.append(message)
+        self.items.append((body, content_type, content_encoding, headers))
+
+        if len(self.messages) >= self.size:
+            self.flush()
+
+    def tick(self):
+        """ Publish the batch if it has been waiting for longer than 'interval'. """
+
+        if self.since is not None and time.monotonic() - self.since >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """ Publish the batch, if there is one. """
+
+        if not self.messages:
+            return
+
+        messages, items = self.messages, self.items
+        self.messages, self.items, self.since = [], [], None
+
+        headers = dict(batch_size=len(messages), batch_format=self.format)
+        try:
+            self.publish(encode(items, self.format), FORMATS[self.format], headers)
+        except Exception:
+            logger.error('Envelope of {} message(s) not published.'.format(len(messages)))
+            for message in messages:
+                self.on_reject(message)
+            raise
+
+        for message in messages:
+            self.on_confirm(message)
@@ -0,0 +1,67 @@
+#!/bin/python
+import time
+import kombu.compression
+
+
+"""
+Compression of outgoing message bodies, above a size threshold.
+
+Compressed bodies are advertised as kombu does, via a 'compression' header giving the codec's MIME type (e.g.
+'application/x-gzip' for zlib); kombu consumers decompress such messages transparently. Small bodies are not worth the
+CPU time, nor are bodies that do not actually get any smaller.
+
+"""
+
+
+class Compressor(object):
+    """ Compresses bodies of at least 'threshold' bytes with kombu compression 'method' (e.g. 'zlib', 'bzip2').
+
+        Each attempt is counted in 'stats' (see 'workers.WorkerStats'): bytes before and after, and CPU seconds.
+
+    """
+
+    def __init__(self, method='zlib', threshold=1024, stats=None):
+
+        # Run-time checks.
+        assert threshold >= 0
+
+        # Fail early if the method isn't known (or its library isn't available).
+        kombu.compression.get_encoder(method)
+
+        self.method = method
+        self.threshold = threshold
+        self.stats = stats
+
+    def compress(self, body, headers):
+        """ Return 'body' and 'headers', compressed and with a 'compression' header if that is worthwhile. """
+
+        if len(body) < self.threshold or (headers and 'compression' in headers):
+            return body, headers
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        started = time.thread_time()
+        compressed, content_type = kombu.compression.compress(body, self.method)
+        elapsed = time.thread_time() - started
+
+        stats = self.stats
+        if stats is not None:
+            stats.incr('compress_seconds', elapsed)
+
+        if len(compressed) >= len(body):
+            return body, headers
+
+        if stats is not None:
+            stats.incr('compressed')
+            stats.incr('compress_bytes_in', len(body))
+            stats.incr('compress_bytes_out', len(compressed))
+
+        headers = dict(headers or {}, compression=content_type)
+        return compressed, headers
+
+
+def setup_compressor(method, threshold, stats=None):
+    """ A 'Compressor', or None if 'method' is empty (i.e. no compression). """
+
+    return Compressor(method, threshold, stats) if method else None
@@ -0,0 +1,180 @@
+#!/bin/python
+import socket
+import time
+import logging
+from collections import OrderedDict
+
+
+"""
+Asynchronous ("pipelined") publisher confirms.
+
+With the blocking 'confirm_publish' transport option each publish waits for the broker's Basic.Ack before returning,
+so forwarding is limited to one message per round trip. Here the producer's channel is put into confirm mode via
+'confirm_select()' instead and up to 'window' publishes may be awaiting confirmation at any one time.
+
+The broker numbers publishes on a confirm-mode channel from 1 and confirms them (possibly several at a time, via the
+'multiple' flag) in that order, so the corresponding incoming messages are settled in delivery order too.
+
+"""
+
+logger = logging.getLogger('RP.confirms')
+
+# Minimum 'drain_events' timeout; a zero timeout would put the socket into non-blocking mode.
+MIN_WAIT = 0.001
+
+
+class PublisherConfirms(object):
+    """ Track publishes that are awaiting confirmation on a producer's channel.
+
+        Each publish is made on behalf of an incoming message: 'on_confirm(message)' is called when the broker
+        confirms the publish and 'on_reject(message)' if it is nacked, times out or is lost along with its channel.
+
+    """
+
+    def __init__(self, producer, on_confirm, on_reject, window=100, timeout=30.0):
+
+        # Run-time checks.
+        assert window > 0
+        assert timeout > 0
+
+        self.producer = producer
+        self.on_confirm = on_confirm
+        self.on_reject = on_reject
+        self.window = window
+        self.timeout = timeout
+
+        self.channel = None
+        self.seq_no = 0
+        self.pending = OrderedDict()        # Publish sequence number -> (deadline, message), oldest first.
+
+    def __len__(self):
+        return len(self.pending)
+
+    def select(self):
+        """ Put the producer's current channel into confirm mode. """
+
+        self.channel = self.producer.channel
+        self.channel.events['basic_ack'].add(self._ack)
+        self.channel.events['basic_nack'].add(self._nack)
+        self.channel.confirm_select()
+        self.seq_no = 0
+
+        logger.debug('channel_id: {}'.format(self.channel.channel_id))
+
+    def publish(self, message, publish, *args, **kwargs):
+        """ Call 'publish(*args, **kwargs)' on behalf of 'message', once there is room in the window. """
+
+        while len(self.pending) >= self.window:
+            self.wait()
+
+        if self.producer.channel is not self.channel:
+            self.renew()
+
+        try:
+            publish(*args, **kwargs)
+        except Exception:
+            self.reject_all()
+            raise
+
+        # If the connection was re-established during the publish, it was made on a channel without confirms.
+        if self.producer.channel is not self.channel:
+            self.on_reject(message)
+            self.renew()
+            return
+
+        self.seq_no += 1
+        self.pending[self.seq_no] = (time.monotonic() + self.timeout, message)
+
+    def renew(self):
+        """ Switch to the producer's new channel; anything outstanding on the old one will never be confirmed. """
+
+        if self.channel is not None:
+            logger.warning('Channel replaced; {} publish(es) unconfirmed.'.format(len(self.pending)))
+
+        self.reject_all()
+        self.select()
+
+    def wait(self, timeout=None):
+        """ Process confirms, waiting up to 'timeout' seconds (or until the oldest publish expires) for the first of
+            them; then whatever others have arrived already, until there are no more (or none are pending).
+
+        """
+
+        if self.pending:
+            deadline = next(iter(self.pending.values()))[0]
+            remaining = deadline - time.monotonic()
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+
+            try:
+                self.producer.connection.drain_events(timeout=max(timeout, MIN_WAIT))
+
+                # Each frame may confirm a single publish, so keep going while frames settle any.
+                pending = len(self.pending)
+                while self.pending:
+                    self.producer.connection.drain_events(timeout=MIN_WAIT)
+                    if len(self.pending) == pending:
+                        break
+                    pending = len(self.pending)
+            except socket.timeout:
+                pass
+            except Exception:
+                self.reject_all()
+                raise
+
+        self.expire()
+
+    def flush(self, timeout=None):
+        """ Wait for all outstanding confirms, for up to 'timeout' seconds in total. """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while self.pending:
+            if deadline is None:
+                self.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.wait(remaining)
+
+        return not self.pending
+
+    def expire(self):
+        """ Reject publishes that have waited longer than 'timeout' for confirmation. """
+
+        now = time.monotonic()
+        while self.pending:
+            seq_no, (deadline, message) = next(iter(self.pending.items()))
+            if deadline > now:
+                break
+            del self.pending[seq_no]
+
+            logger.error('Publish {} not confirmed within {} seconds.'.format(seq_no, self.timeout))
+            self.on_reject(message)
+
+    def reject_all(self):
+        """ Reject every outstanding publish. """
+
+        while self.pending:
+            _, (_, message) = self.pending.popitem(last=False)
+            self.on_reject(message)
+
+    def _ack(self, delivery_tag, multiple):
+        self._settle(delivery_tag, multiple, self.on_confirm)
+
+    def _nack(self, delivery_tag, multiple, requeue=False):
+        logger.error('Publish {} nacked by broker (multiple: {}).'.format(delivery_tag, multiple))
+        self._settle(delivery_tag, multiple, self.on_reject)
+
+    def _settle(self, seq_no, multiple, callback):
+        """ Remove publish 'seq_no' (and, if 'multiple', all before it) from the window, via 'callback'. """
+
+        if multiple:
+            while self.pending and next(iter(self.pending)) <= seq_no:
+                _, (_, message) = self.pending.popitem(last=False)
+                callback(message)
+        else:
+            item = self.pending.pop(seq_no, None)
+            if item is not None:
+                callback(item[1])
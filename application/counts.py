@@ -0,0 +1,157 @@
+#!/bin/python
+import time
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+
+
+"""
+Queue counts for monitoring, via passive 'queue_declare'.
+
+Monitoring polls the count endpoints frequently, so rather than opening a connection per request, counts are obtained
+over a small pool of long-lived connections per broker and cached for a short time. Concurrent requests for the same
+count share a single broker call ("single flight").
+
+"""
+
+logger = logging.getLogger('RP.counts')
+
+
+class ConnectionPool(object):
+    """ Up to 'limit' long-lived connections to 'hostname', made via 'connect(hostname)'. """
+
+    def __init__(self, connect, hostname, limit=2, timeout=10):
+
+        # Run-time checks.
+        assert limit > 0
+
+        self.connect = connect
+        self.hostname = hostname
+        self.limit = limit
+        self.timeout = timeout
+
+        self.free = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def channel(self):
+        """ Channel on a healthy pooled connection; the connection is discarded if anything goes wrong with it. """
+
+        connection = self._acquire()
+        try:
+            yield connection.default_channel
+        except Exception:
+            self._discard(connection)
+            raise
+        else:
+            self.free.put(connection)
+
+    def close(self):
+        while True:
+            try:
+                connection = self.free.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+    def _acquire(self):
+
+        while True:
+            try:
+                connection = self.free.get_nowait()
+            except queue.Empty:
+                break
+
+            # Health check.
+            if connection.connected:
+                return connection
+            self._discard(connection)
+
+        with self.lock:
+            create = self.created < self.limit
+            if create:
+                self.created += 1
+
+        if not create:
+            try:
+                return self.free.get(timeout=self.timeout)
+            except queue.Empty:
+                raise RuntimeError("No connection available: {}".format(self.hostname))
+
+        try:
+            return self.connect(self.hostname)
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def _discard(self, connection):
+
+        with self.lock:
+            self.created -= 1
+
+        try:
+            connection.close()
+        # Connection is probably broken anyway.
+        except Exception as e:
+            logger.debug("close: {}".format(e))
+
+
+class _Entry(object):
+    __slots__ = ('lock', 'value', 'expires')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = None
+        self.expires = 0.0
+
+
+class QueueCounter(object):
+    """ Cached message counts, 'ttl' seconds old at most, via per-broker connection pools. """
+
+    def __init__(self, connect, ttl=1.0, pool_size=2):
+        self.connect = connect
+        self.ttl = ttl
+        self.pool_size = pool_size
+
+        self.pools = {}
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def count(self, cfg):
+        """ Number of messages in queue 'cfg.queue' on broker 'cfg.hostname'. """
+
+        key = (cfg.hostname, cfg.queue)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = _Entry()
+
+        # Whoever holds the lock refreshes the count; anyone else waiting then gets that result.
+        with entry.lock:
+            if entry.expires <= time.monotonic():
+                entry.value = self._count(cfg)
+                entry.expires = time.monotonic() + self.ttl
+
+            return entry.value
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+
+    def _pool(self, hostname):
+        with self.lock:
+            pool = self.pools.get(hostname)
+            if pool is None:
+                pool = self.pools[hostname] = ConnectionPool(self.connect, hostname, limit=self.pool_size)
+            return pool
+
+    def _count(self, cfg):
+
+        with self._pool(cfg.hostname).channel() as channel:
+            name, jobs, consumers = channel.queue_declare(queue=cfg.queue, passive=True)
+
+        return jobs
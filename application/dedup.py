@@ -0,0 +1,162 @@
+#!/bin/python
+import os
+import sys
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+"""
+Suppression of duplicates: messages that were published but, as the forwarder died before acknowledging them, have
+been redelivered by the broker.
+
+Forwarded messages are remembered (by message id, or by a hash of the body if there is no id) in a bounded LRU cache,
+for up to 'ttl' seconds. A redelivered message that is found there is acknowledged without being published again.
+The cache may be backed by an append-only index file, so that it survives a restart - which is when it matters most.
+
+"""
+
+logger = logging.getLogger('RP.dedup')
+
+# Approximate memory per cache entry, in addition to the key itself: dict slot, linked list node, float.
+ENTRY_OVERHEAD = 150
+
+
+def dedup_key(message_id, body):
+    """ Cache key (a 16 byte digest) for a message, by 'message_id' if it has one, otherwise by 'body'. """
+
+    if message_id:
+        data = b'id:' + (message_id.encode('utf-8') if isinstance(message_id, str) else message_id)
+    else:
+        data = b'body:' + (body.encode('utf-8') if isinstance(body, str) else body)
+
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class DedupCache(object):
+    """ Keys of up to 'capacity' forwarded messages, each remembered for 'ttl' seconds; optionally indexed at 'path'.
+
+        Thread safe, as workers (threads) share the cache of their process.
+
+    """
+
+    def __init__(self, capacity=100000, ttl=3600.0, path=None):
+
+        # Run-time checks.
+        assert capacity > 0
+        assert ttl > 0
+
+        self.capacity = capacity
+        self.ttl = ttl
+        self.path = path
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.index = None
+        self.index_lines = 0
+
+        self.checks = 0
+        self.hits = 0
+
+        if path:
+            self._load()
+            self._compact()
+
+    def seen(self, key):
+        """ True if the message with 'key' has been forwarded already (within 'ttl'). """
+
+        now = time.time()
+        with self.lock:
+            self.checks += 1
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires <= now:
+                del self.entries[key]
+                return False
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, key):
+        """ Remember that the message with 'key' has been forwarded. """
+
+        expires = time.time() + self.ttl
+        with self.lock:
+            self._put(key, expires)
+
+            # Written through, so that the entry survives the process (if not the machine).
+            if self.index is not None:
+                self.index.write('{:.0f} {}\n'.format(expires, key.hex()))
+                self.index.flush()
+                self.index_lines += 1
+                if self.index_lines > 2 * self.capacity:
+                    self._compact()
+
+    def close(self):
+        with self.lock:
+            if self.index is not None:
+                self.index.close()
+                self.index = None
+
+    def stats(self):
+        with self.lock:
+            entries = len(self.entries)
+            checks, hits = self.checks, self.hits
+
+        # Keys are all the same size.
+        key_size = sys.getsizeof(b'\0' * 16)
+        return dict(entries=entries, capacity=self.capacity, ttl=self.ttl, checks=checks, hits=hits,
+                    hit_rate=float(hits) / checks if checks else None,
+                    bytes=entries * (key_size + ENTRY_OVERHEAD), index=self.path or None)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _put(self, key, expires):
+
+        entries = self.entries
+        entries[key] = expires
+        entries.move_to_end(key)
+        while len(entries) > self.capacity:
+            entries.popitem(last=False)
+
+    def _load(self):
+
+        if not os.path.exists(self.path):
+            return
+
+        now = time.time()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    expires, key = line.split()
+                    expires = float(expires)
+                    key = bytes.fromhex(key)
+                # A partly written (last) line, if the process died while writing it.
+                except ValueError:
+                    continue
+                if expires > now:
+                    self._put(key, expires)
+
+        logger.info("Loaded {} entries from {}".format(len(self.entries), self.path))
+
+    def _compact(self):
+        """ Replace the index with the current entries only (atomically), then append to that. """
+
+        if self.index is not None:
+            self.index.close()
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix='.dedup-', dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            for key, expires in self.entries.items():
+                f.write('{:.0f} {}\n'.format(expires, key.hex()))
+        os.replace(temp_path, self.path)
+
+        self.index = open(self.path, 'a')
+        self.index_lines = len(self.entries)
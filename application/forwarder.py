@@ -0,0 +1,1471 @@
+#!/bin/python
+import os
+import sys
+import logging
+import logging.handlers
+import kombu
+import kombu.serialization
+import time
+import socket
+import threading
+import argparse
+from kombu.common import maybe_declare
+from amqp import AccessRefused
+from python_logging.setup_logging import setup_logging
+from .confirms import PublisherConfirms, MIN_WAIT
+from .acks import BatchAcker
+from .workers import WorkerPool, WorkerStats
+from .backoff import Backoff
+from .routing import routing_key_template
+from .compression import setup_compressor
+from .dedup import DedupCache, dedup_key
+from .spool import Spool, Spooler, SpoolFull, undrained
+from .archive import Archive, Record
+from .batching import Batcher
+from .lanes import LaneConsumers, parse_lanes
+from .backpressure import Backpressure, PAUSED
+from .counts import QueueCounter
+from .signing import Signer, SIGNATURE_HEADER
+from .sharding import Shard, ShardRouter, ShardedProducer, hostnames
+from .sources import Source, SourcePool, configurations, source_name
+from . import metrics
+from . import settings
+from . import snapshot
+from .audit import (AuditRecord, AuditSink, make_log_msg, remove_username_password, PULL, PUSH, PUSH_ACK, PULL_ACK,
+                    DUPLICATE, SPOOLED, UNSPOOLED)
+
+
+"""
+Register-Publisher: forwards messages from the System of Record to the outside world, via AMQP "topic broadcast".
+
+* AMQP defines four type of exchange, one of which is 'topic'; that enables clients to subscribe on an 'ad hoc' basis.
+* RabbitMQ etc. should have default exchanges in place; 'amq.fanout' for example.
+* The "System of Record" (SoR) could publish directly to a fanout exchange and indeed used to do so.
+* A separate "Register-Publisher" (RP) module is required to isolate the SoR from the outside world.
+* Thus the SoR publishes to the RP via a 'direct' exchange, which in turn forwards the messages to a 'topic' exchange.
+
+See http://www.rabbitmq.com/blog/2010/10/19/exchange-to-exchange-bindings for an alternative arrangement, which may be
+unique to RabbitMQ. That does not permit logging etc., so 'Forwarder.process_message()' forwards the raw message body
+instead ("passthrough"), only unpacking messages that cannot be forwarded verbatim.
+More importantly perhaps, this package acts as a proxy publisher for the System of Record - i.e. security/isolation.
+
+The forwarder runs as a process of its own ('python -m application.forwarder'), without Flask; the HTTP app
+('server.py') only reports on it, via the stats snapshot written by 'run_workers()'.
+
+"""
+
+config = settings.load()
+
+incoming_cfg = config['INCOMING_CFG']
+outgoing_cfg = config['OUTGOING_CFG']
+batch_cfg = config['BATCH_CFG']
+
+# Constraints, etc.
+MAX_RETRIES = config['MAX_RETRIES']
+
+# Connection timeout and reconnection backoff (seconds).
+CONNECT_TIMEOUT = config['CONNECT_TIMEOUT']
+RECONNECT_INTERVAL = config['RECONNECT_INTERVAL'] / 1000.0
+RECONNECT_INTERVAL_MAX = config['RECONNECT_INTERVAL_MAX'] / 1000.0
+
+# Consumer prefetch and acknowledgement batching.
+PREFETCH_COUNT = config['PREFETCH_COUNT']
+ACK_BATCH_SIZE = config['ACK_BATCH_SIZE']
+ACK_BATCH_INTERVAL = config['ACK_BATCH_INTERVAL'] / 1000.0
+
+# Forward raw message bodies, rather than decoding and re-serializing them.
+PASSTHROUGH = config['PASSTHROUGH']
+
+# Content types that the consumer accepts and which may therefore be forwarded without being decoded first.
+ACCEPT_CONTENT = ['json']
+PASSTHROUGH_CONTENT_TYPES = frozenset(['application/json'])
+
+# Serialization of outgoing messages that are not passed through.
+SERIALIZER = 'json'
+
+# Routing keys from message headers (see 'routing.py'); None for the default, i.e. the outgoing queue name.
+routing_key = routing_key_template(config['ROUTING_KEY_TEMPLATE'], config['ROUTING_KEY_MISSING'])
+
+# Compression of outgoing bodies (see 'compression.py').
+COMPRESSION = config['COMPRESSION']
+COMPRESSION_THRESHOLD = config['COMPRESSION_THRESHOLD']
+
+# Suppression of redelivered duplicates (see 'dedup.py').
+DEDUP = config['DEDUP']
+DEDUP_CAPACITY = config['DEDUP_CAPACITY']
+DEDUP_TTL = config['DEDUP_TTL']
+DEDUP_INDEX = config['DEDUP_INDEX']
+
+# Local spool, for when the outgoing broker is unavailable (see 'spool.py').
+SPOOL_DIR = config['SPOOL_DIR']
+SPOOL_SEGMENT_SIZE = config['SPOOL_SEGMENT_SIZE']
+SPOOL_MAX_BYTES = config['SPOOL_MAX_BYTES']
+SPOOL_MAX_AGE = config['SPOOL_MAX_AGE']
+SPOOL_DRAIN_WINDOW = config['SPOOL_DRAIN_WINDOW']
+
+# Archive of forwarded messages, for replay (see 'archive.py').
+ARCHIVE_DIR = config['ARCHIVE_DIR']
+
+# Batched envelopes, to 'batch_cfg.exchange' (if named) as well as the per-message publish (see 'batching.py').
+BATCH_SIZE = config['BATCH_SIZE']
+BATCH_INTERVAL = config['BATCH_INTERVAL'] / 1000.0
+BATCH_FORMAT = config['BATCH_FORMAT']
+
+# Priority lanes (see 'lanes.py'); none for 'incoming_cfg.queue' alone. Each worker has lanes of its own.
+INCOMING_LANES = config['INCOMING_LANES']
+LANES = parse_lanes(INCOMING_LANES, PREFETCH_COUNT)
+LANE_QUANTUM = config['LANE_QUANTUM']
+
+# Backpressure, by outgoing queue depth (see 'backpressure.py').
+BACKPRESSURE = config['BACKPRESSURE']
+BACKPRESSURE_LOW = config['BACKPRESSURE_LOW']
+BACKPRESSURE_HIGH = config['BACKPRESSURE_HIGH']
+BACKPRESSURE_LIMIT = config['BACKPRESSURE_LIMIT']
+BACKPRESSURE_RATE = config['BACKPRESSURE_RATE']
+BACKPRESSURE_MIN_FACTOR = config['BACKPRESSURE_MIN_FACTOR']
+BACKPRESSURE_INTERVAL = config['BACKPRESSURE_INTERVAL'] / 1000.0
+
+# Signing of outgoing messages (see 'signing.py').
+SIGNING_KEY = config['SIGNING_KEY']
+SIGNING_PROCESSES = config['SIGNING_PROCESSES']
+SIGNING_BATCH = config['SIGNING_BATCH']
+
+# Sharding across outgoing brokers (see 'sharding.py'), if there are several; named as for audit purposes.
+SHARD_HEADER = config['SHARD_HEADER']
+SHARD_REPLICAS = config['SHARD_REPLICAS']
+SHARDS = [remove_username_password(hostname) for hostname in hostnames(outgoing_cfg.hostname)]
+if len(SHARDS) < 2:
+    SHARDS = []
+
+# Consumption from several incoming brokers (see 'sources.py'), if there are several; named as for audit purposes.
+SOURCES = [source_name(cfg) for cfg in configurations(incoming_cfg)]
+if len(SOURCES) < 2:
+    SOURCES = []
+SOURCE_BATCH = config['SOURCE_BATCH']
+
+# Forwarding workers.
+WORKERS = config['WORKERS']
+WORKER_MODE = config['WORKER_MODE']
+
+# Forwarding engine: 'kombu' ('run()') or 'asyncio' ('aio.run()').
+ENGINE = config['ENGINE']
+
+# Latency instrumentation, for these stages of forwarding.
+LATENCY_HISTOGRAMS = config['LATENCY_HISTOGRAMS']
+LATENCY_WINDOW = config['LATENCY_WINDOW']
+STAGES = ('drain_events', 'process', 'header', 'audit', 'publish', 'ack')
+
+# Publisher confirms.
+CONFIRM_MODE = config['CONFIRM_MODE']
+CONFIRM_WINDOW = config['CONFIRM_WINDOW']
+CONFIRM_TIMEOUT = config['CONFIRM_TIMEOUT']
+
+# 'drain_events' timeout (seconds) while there is outstanding work, such as unconfirmed publishes or pending acks.
+POLL_INTERVAL = 0.1
+
+# 'drain_events' timeout (seconds) otherwise, so that a worker notices when it is asked to stop.
+IDLE_INTERVAL = 1.0
+
+# Pool of 'run()' workers, once started by 'run_workers()'.
+pool = None
+
+# Stats snapshot for the HTTP app, written every STATS_INTERVAL seconds.
+STATS_FILE = config['STATS_FILE']
+STATS_INTERVAL = config['STATS_INTERVAL'] / 1000.0
+
+LOG_NAME = "RP"
+
+# Audit logging.
+AUDIT_ASYNC = config['AUDIT_ASYNC']
+AUDIT_QUEUE_SIZE = config['AUDIT_QUEUE_SIZE']
+AUDIT_BATCH_SIZE = config['AUDIT_BATCH_SIZE']
+AUDIT_FLUSH_INTERVAL = config['AUDIT_FLUSH_INTERVAL'] / 1000.0
+AUDIT_OVERFLOW = config['AUDIT_OVERFLOW']
+
+# Background audit writer for this process, if any; see 'setup_audit_logger()'.
+audit_sink = None
+audit_sink_lock = threading.Lock()
+
+# Outgoing queue depth, sampled for backpressure; shared by the workers (if threads) of this process.
+depth_counter = None
+depth_counter_lock = threading.Lock()
+
+# Signer for this process, if any; see 'setup_signer()'.
+signer = None
+signer_lock = threading.Lock()
+
+# Duplicates cache for this process, if any; see 'setup_dedup_cache()'.
+dedup_cache = None
+dedup_cache_lock = threading.Lock()
+
+# Set up logger
+def setup_logger(name=__name__):
+
+    # Standard LR configuration.
+    setup_logging()
+    # Specify base logging threshold level.
+    ll = config['LOG_THRESHOLD_LEVEL']
+    logger = logging.getLogger(name)
+    logger.setLevel(ll)
+
+    return logger
+
+logger = setup_logger(LOG_NAME)
+
+
+def setup_audit_logger(name=LOG_NAME + '.run.audit'):
+    """ Logger for audit records; these are written by a background 'AuditSink' if 'AUDIT_ASYNC' is set. """
+
+    global audit_sink
+
+    audit_logger = logging.getLogger(name)
+
+    with audit_sink_lock:
+        if AUDIT_ASYNC and audit_sink is None:
+            audit_sink = AuditSink(capacity=AUDIT_QUEUE_SIZE, batch_size=AUDIT_BATCH_SIZE,
+                                   flush_interval=AUDIT_FLUSH_INTERVAL, overflow=AUDIT_OVERFLOW)
+            audit_sink.install(audit_logger)
+
+    return audit_logger
+
+
+def sample_process_stats(stats):
+    """ Copy the status of this (worker) process's audit sink and duplicates cache into 'stats', for the parent
+        process to gather.
+
+    """
+
+    if audit_sink is not None:
+        sink = audit_sink.stats()
+        stats.set('audit_depth', sink['depth'])
+        stats.set('audit_written', sink['written'])
+        stats.set('audit_dropped', sink['dropped'])
+        stats.set('audit_batches', sink['batches'])
+        stats.set('audit_flush_latency', sink['last_flush_latency'])
+        stats.set('audit_max_flush_latency', sink['max_flush_latency'])
+
+    if dedup_cache is not None:
+        cache = dedup_cache.stats()
+        stats.set('dedup_entries', cache['entries'])
+        stats.set('dedup_bytes', cache['bytes'])
+
+
+def setup_dedup_cache(worker_id=0):
+    """ This process's 'DedupCache' if 'DEDUP' is set, shared by its workers (if threads); otherwise None. """
+
+    global dedup_cache
+
+    with dedup_cache_lock:
+        if DEDUP and dedup_cache is None:
+            path = DEDUP_INDEX
+            # Worker processes have an index each.
+            if path and WORKER_MODE == 'process':
+                path = '{}.{}'.format(path, worker_id)
+            dedup_cache = DedupCache(capacity=DEDUP_CAPACITY, ttl=DEDUP_TTL, path=path)
+
+    return dedup_cache
+
+
+def setup_signer():
+    """ This process's 'Signer' if 'SIGNING_KEY' is set, shared by its workers (if threads); otherwise None. """
+
+    global signer
+
+    with signer_lock:
+        if SIGNING_KEY and signer is None:
+            signer = Signer(SIGNING_KEY, processes=SIGNING_PROCESSES)
+            logger.info("Signing with '{}'; processes: {}".format(SIGNING_KEY, SIGNING_PROCESSES))
+
+    return signer
+
+
+def setup_spool(worker_id=0):
+    """ This worker's 'Spool' if 'SPOOL_DIR' is set, otherwise None; each worker has a subdirectory of its own. """
+
+    if not SPOOL_DIR:
+        return None
+
+    return Spool(os.path.join(SPOOL_DIR, str(worker_id)), segment_size=SPOOL_SEGMENT_SIZE, max_bytes=SPOOL_MAX_BYTES,
+                 max_age=SPOOL_MAX_AGE)
+
+
+def setup_archive(worker_id=0):
+    """ This worker's 'Archive' if 'ARCHIVE_DIR' is set, otherwise None; each worker has a subdirectory of its own. """
+
+    if not ARCHIVE_DIR:
+        return None
+
+    return Archive(os.path.join(ARCHIVE_DIR, str(worker_id)))
+
+
+def setup_backpressure(outgoing=outgoing_cfg):
+    """ 'Backpressure' for the depth of the 'outgoing' queue if 'BACKPRESSURE' is set, otherwise None.
+
+        The depth is sampled as for the count endpoints, and the sample shared by this process's workers (if threads).
+        If sharded, it is the depth of the deepest shard's queue.
+
+    """
+
+    global depth_counter
+
+    if not BACKPRESSURE:
+        return None
+
+    with depth_counter_lock:
+        if depth_counter is None:
+            depth_counter = QueueCounter(setup_connection, ttl=BACKPRESSURE_INTERVAL, pool_size=1)
+
+    cfgs = [outgoing._replace(hostname=hostname) for hostname in hostnames(outgoing.hostname)]
+
+    return Backpressure(lambda: max(depth_counter.count(cfg) for cfg in cfgs), BACKPRESSURE_LOW, BACKPRESSURE_HIGH,
+                        BACKPRESSURE_LIMIT, rate=BACKPRESSURE_RATE, interval=BACKPRESSURE_INTERVAL,
+                        min_factor=BACKPRESSURE_MIN_FACTOR)
+
+
+log_threshold_level_name = logging.getLevelName(logger.getEffectiveLevel())
+
+
+# RabbitMQ connection; default user/password.
+def setup_connection(queue_hostname, confirm_publish=True):
+    """ Attempt connection, with timeout.
+
+    'confirm_publish' refers to the "Confirmation Model", with the broker as client to a publisher.
+
+    This can be for asynchronous operation, in which case channel.confirm_select() is called,
+    or for synchronous operation, which employs channel.basic_publish() in a blocking way; note
+    that this call is invoked via the Producer.publish() method, rather than being invoked directly.
+
+    The blocking approach is simpler but costs a broker round trip per message; asynchronous operation
+    ('CONFIRM_MODE' of 'async') is handled by 'confirms.PublisherConfirms', in which case the connection
+    is made with 'confirm_publish' False.
+
+    See the "2013-09-04 02:39 P.M UTC" entry of http://amqp.readthedocs.org/en/latest/changelog.html for details.
+
+    """
+
+    # Run-time checks.
+    assert type(confirm_publish) is bool
+
+    logger.debug(queue_hostname)
+    logger.debug("confirm_publish: {}".format(confirm_publish))
+
+    # The (implied) 'connect' call may hang if permissions not set etc., so the socket itself has a timeout.
+    connection = kombu.Connection(hostname=queue_hostname, connect_timeout=CONNECT_TIMEOUT,
+                                  transport_options={'confirm_publish': confirm_publish})
+
+    try:
+        connection.connect()
+    except socket.timeout:
+        err_msg = "Connection unavailable: {}".format(queue_hostname)
+        raise RuntimeError(err_msg)
+
+    logger.info("URI: {}".format(connection.as_uri()))
+
+    return connection
+
+
+# RabbitMQ channel.
+def setup_channel(queue_hostname, exchange=None, connection=None, confirm_publish=True):
+    """ Get a channel and bind exchange to it. """
+
+    assert exchange is not None
+    logger.info("exchange: {}".format(exchange))
+
+    if connection is None:
+        channel = setup_connection(queue_hostname, confirm_publish=confirm_publish).channel()
+    else:
+        channel = connection.channel()
+
+    # Bind/Declare exchange on broker if necessary; declarations are cached for the lifetime of the connection.
+    exchange.maybe_bind(channel)
+    maybe_declare(exchange, channel)
+
+    logger.debug('channel_id: {}'.format(channel.channel_id))
+
+    return channel
+
+
+# Get Producer, for 'outgoing' exchange and JSON "serializer" by default.
+def setup_producer(cfg=outgoing_cfg, serializer=SERIALIZER, set_queue=True, confirm_publish=True):
+    """ Create a Producer, with a corresponding queue if required.
+
+        'confirm_publish' False leaves publisher confirms to the caller (see 'confirms.PublisherConfirms').
+
+    """
+
+    assert type(set_queue) is bool
+
+    logger.debug("cfg: {}".format(cfg))
+
+    channel = setup_channel(cfg.hostname, exchange=cfg.exchange, confirm_publish=confirm_publish)
+
+    # Publishing is to an exchange but we need a queue to store messages *before* publication.
+    # Note that Consumers should really be responsible for (their) queues.
+    queue = None
+    if set_queue:
+        queue = setup_queue(channel, cfg=cfg)
+
+    # Publish message; the default message *routing* key is the outgoing queue name.
+    producer = kombu.Producer(channel, exchange=cfg.exchange, routing_key=cfg.queue, serializer=serializer)
+
+    logger.debug('channel_id: {}'.format(producer.channel.channel_id))
+    logger.debug('exchange: {}'.format(producer.exchange.name))
+    logger.debug('routing_key: {}'.format(producer.routing_key))
+    logger.debug('serializer: {}'.format(producer.serializer))
+
+    # Track queue, for debugging purposes.
+    producer._queue = queue
+
+    return producer
+
+
+# Consumer, for 'incoming' queue by default.
+def setup_consumer(cfg=incoming_cfg, callback=None, on_message=None, prefetch_count=0, connection=None):
+    """ Create consumer with single queue and callback
+
+        If 'on_message' is given, it is called with the raw (undecoded) message instead of 'callback'.
+        A non-zero 'prefetch_count' limits the number of unacknowledged messages that the broker will deliver.
+        The consumer has a channel of its own, on 'connection' if given (else on a new connection).
+
+    """
+
+    logger.debug("cfg: {}".format(cfg))
+
+    channel = setup_channel(cfg.hostname, cfg.exchange, connection=connection)
+    logger.info("queue_name: {}".format(cfg.queue))
+
+    # A consumer needs a queue, so create one (if necessary).
+    queue = setup_queue(channel, cfg=cfg)
+
+    # The queue has just been declared, so the consumer need not do so again.
+    callbacks = [callback] if callback is not None else None
+    consumer = kombu.Consumer(channel, queues=queue, callbacks=callbacks, on_message=on_message, accept=ACCEPT_CONTENT,
+                              auto_declare=False)
+
+    if prefetch_count:
+        consumer.qos(prefetch_count=prefetch_count)
+        logger.debug('prefetch_count: {}'.format(prefetch_count))
+
+    # Kept for when the consumer is revived on a new channel.
+    consumer._prefetch_count = prefetch_count
+
+    logger.debug('channel_id: {}'.format(consumer.channel.channel_id))
+    logger.debug('queue(s): {}'.format(consumer.queues))
+
+    return consumer
+
+
+def setup_queue(channel=None, cfg=None, durable=True):
+    """ Return bound queue, "durable" by default """
+
+    if channel is None:
+        raise RuntimeError("setup_queue: 'channel' required!")
+
+    if cfg is None:
+        raise RuntimeError("setup_queue: 'cfg' required!")
+
+    logger.debug("cfg: {}".format(cfg))
+
+    # N.B.: kombu mis-names the queue's Binding key as a Routing key!
+    queue = kombu.Queue(name=cfg.queue, exchange=cfg.exchange, routing_key=cfg.binding_key, durable=durable)
+    queue.maybe_bind(channel)
+
+    # VIP: ensure that queue is declared! If it isn't, we can send messages to the queue but they die, silently :-(
+    # Note: IMO, this should have been done by default via the 'bind' operation - and that by the class.
+    # The declaration (of queue, exchange and binding) is cached by the connection, so it is made once per connection.
+    try:
+        maybe_declare(queue, channel)
+    # 'AccessRefused' raised by kombu if queue already declared.
+    except AccessRefused:
+        pass
+
+    logger.info("queue name, exchange, binding_key: {}, {}, {}".format(queue.name, cfg.exchange, cfg.binding_key))
+
+    return queue
+
+
+def needs_decode(message):
+    """ True if 'message' has to be unpacked (and packed again) rather than forwarded verbatim. """
+
+    return not PASSTHROUGH or message.content_type not in PASSTHROUGH_CONTENT_TYPES
+
+
+def passthrough_properties(message):
+    """ Return 'publish()' keyword arguments that reproduce 'message' as it was received.
+
+        kombu has already decompressed the body, so any compression is re-applied on publication.
+
+    """
+
+    headers = dict(message.headers)
+    compression = headers.pop('compression', None)
+
+    return dict(content_type=message.content_type, content_encoding=message.content_encoding,
+                headers=headers, compression=compression)
+
+
+def drain_events(connection, timeout=None):
+    """ Wait for a single event from the server, for up to 'timeout' seconds; False if none arrived. """
+
+    try:
+        connection.drain_events(timeout=timeout)
+    except socket.timeout:
+        return False
+
+    return True
+
+
+def get_message_header(mq_message):
+    #contains the title number for audit
+    try:
+        return mq_message.properties['application_headers']
+    except Exception as err:
+        error_message = "message header not retrieved for message"
+        logger.error(make_log_msg(error_message, 'error', 'no title', incoming_cfg.hostname))
+        return error_message + str(err)
+
+
+def check(batch=batch_cfg):
+    """ Raise RuntimeError if settings are combined that 'run()' cannot honour, rather than forward otherwise than as
+        configured.
+
+    """
+
+    # Messages drained from the spool were acknowledged once spooled, so they cannot be held back for an envelope too.
+    if SPOOL_DIR and batch.exchange.name:
+        raise RuntimeError("SPOOL_DIR is not supported with BATCH_EXCHANGE: messages drained from the spool would be "
+                           "missing from the envelopes.")
+
+
+class Forwarder(object):
+    """ "System of Record" to "Feeder" re-publisher, once started: forwards from 'incoming' to 'outgoing'
+        (configurations), updating 'stats' (see 'workers.WorkerStats'); also in envelopes to 'batch', if its exchange is
+        named. 'incoming' may be a list of configurations, for several sources (see 'sources.py'). Waits are cut short
+        once the 'stop' event is set.
+
+        Each 'poll()' forwards whatever has been delivered, then attends to confirms, acknowledgements, the spool,
+        backpressure etc.; see 'run()'.
+
+    """
+
+    def __init__(self, worker_id=0, stats=None, stop=None, incoming=incoming_cfg, outgoing=outgoing_cfg,
+                 batch=batch_cfg, logger=logger):
+        self.logger = logger
+        self.stop = threading.Event() if stop is None else stop
+
+        # Several incoming brokers, if so configured; each is consumed from on a connection of its own.
+        sources = [Source(cfg, Backoff(initial=RECONNECT_INTERVAL, maximum=RECONNECT_INTERVAL_MAX))
+                   for cfg in configurations(incoming)]
+        self.incoming = sources[0].cfg
+        self.outgoing = outgoing
+        if len(sources) < 2:
+            sources = []
+
+        # Queue addresses for audit purposes, without credentials.
+        self.incoming_address = remove_username_password(self.incoming.hostname)
+        self.outgoing_address = remove_username_password(outgoing.hostname)
+
+        self.audit_logger = setup_audit_logger()
+
+        # Several outgoing brokers, if sharded; batched envelopes go to the first of them.
+        shards = [Shard(hostname, remove_username_password(hostname),
+                        Backoff(initial=RECONNECT_INTERVAL, maximum=RECONNECT_INTERVAL_MAX))
+                  for hostname in hostnames(outgoing.hostname)]
+        if len(shards) < 2:
+            shards = []
+        self.batch = batch._replace(hostname=hostnames(batch.hostname)[0])
+
+        if stats is None:
+            stats = WorkerStats(STAGES if LATENCY_HISTOGRAMS else None, LATENCY_WINDOW, [lane.queue for lane in LANES],
+                                [shard.name for shard in shards], [source.name for source in sources])
+        self.stats = stats
+        self.latency = stats.latency
+
+        for source in sources:
+            if source.name in stats.sources:
+                source.stats = stats
+
+        self.compressor = setup_compressor(COMPRESSION, COMPRESSION_THRESHOLD, stats)
+        self.signer = setup_signer()
+        self.dedup = setup_dedup_cache(worker_id)
+
+        # What has been forwarded is archived (if so configured), for replay.
+        self.archive = setup_archive(worker_id)
+
+        # Throttling by outgoing queue depth, if so configured; consumption is cancelled while 'paused()'.
+        self.backpressure = setup_backpressure(outgoing)
+        if self.backpressure is not None:
+            stats.set('bp_factor', self.backpressure.factor)
+
+        # Delays between reconnection attempts, whether by 'ensure' or by 'run()'.
+        self.backoff = Backoff(initial=RECONNECT_INTERVAL, maximum=RECONNECT_INTERVAL_MAX)
+
+        # Producer for outgoing exchange (see 'start()'); with asynchronous confirms if so configured. If sharded, each
+        # shard has its own (see 'sharding.ShardedProducer'); a shard that is down to begin with is tried again later,
+        # as if it had failed.
+        self.async_confirms = CONFIRM_MODE == 'async'
+        self.producer = None
+        self.confirms = None
+        self.sharded = None
+        if shards:
+            router = ShardRouter(shards, header=SHARD_HEADER, replicas=SHARD_REPLICAS,
+                                 stats=stats if stats.shards else None)
+            self.sharded = ShardedProducer(
+                router, lambda shard: setup_producer(cfg=outgoing._replace(hostname=shard.hostname),
+                                                     confirm_publish=not self.async_confirms),
+                self.published if self.async_confirms else None, self.not_published if self.async_confirms else None,
+                window=CONFIRM_WINDOW, timeout=CONFIRM_TIMEOUT, stats=stats)
+
+        # While the outgoing broker is unavailable, messages are spooled (if so configured), then drained once it is
+        # back, on a connection of its own with pipelined confirms (see 'spool.Spooler').
+        self.spooler = None
+        spool = setup_spool(worker_id)
+        if spool is not None and shards:
+            # Failing over to another shard takes the place of spooling.
+            self.logger.error("Spool not supported with several outgoing brokers; not spooling.")
+            spool.close()
+        elif spool is not None:
+            self.spooler = Spooler(spool, lambda: setup_producer(cfg=outgoing, confirm_publish=False), self.unspooled,
+                                   window=SPOOL_DRAIN_WINDOW, timeout=CONFIRM_TIMEOUT,
+                                   backoff=Backoff(initial=RECONNECT_INTERVAL, maximum=RECONNECT_INTERVAL_MAX),
+                                   stats=stats)
+
+        # Batched envelopes, if so configured; never more messages than the prefetch limit, as none are acknowledged
+        # yet.
+        self.batch_producer = None
+        self.batcher = None
+        if self.batch.exchange.name:
+            batch_size = min(BATCH_SIZE, PREFETCH_COUNT) if PREFETCH_COUNT else BATCH_SIZE
+            self.batcher = Batcher(self.publish_batch, self.confirmed, self.rejected, size=batch_size,
+                                   interval=BATCH_INTERVAL, format=BATCH_FORMAT)
+
+        # Acknowledge incoming messages in batches if so configured; never more than the prefetch limit at a time.
+        # Lanes, or sources, are acknowledged separately ('None' for neither).
+        self.lanes = parse_lanes(INCOMING_LANES, PREFETCH_COUNT)
+        if self.lanes and sources:
+            self.logger.error("Lanes not supported with several incoming brokers; consuming '{}'.".format(
+                self.incoming.queue))
+            self.lanes = []
+
+        self.ackers = {}
+        channels = ([(lane.queue, lane.prefetch) for lane in self.lanes] or
+                    [(source.name, PREFETCH_COUNT) for source in sources] or [(None, PREFETCH_COUNT)])
+        for key, prefetch_count in channels:
+            acker = self.setup_acker(prefetch_count)
+            if acker is not None:
+                self.ackers[key] = acker
+
+        # Consumer(s) for the incoming queue(s); see 'start()'.
+        self.consumer = None
+        self.lane_consumers = None
+        self.delivered = None
+        self.source_pool = None
+        if sources:
+            self.source_pool = SourcePool(sources, lambda source, on_message: setup_consumer(
+                cfg=source.cfg, on_message=on_message, prefetch_count=PREFETCH_COUNT), drain_events,
+                self.start_consumer, self.source_failed, wait=self.stop.wait, poll_interval=POLL_INTERVAL)
+
+    def start(self):
+        """ Connect to the outgoing broker(s), then start consuming. """
+
+        if self.sharded is not None:
+            self.sharded.start()
+        else:
+            self.producer = setup_producer(cfg=self.outgoing, confirm_publish=not self.async_confirms)
+
+        if self.async_confirms and self.producer is not None:
+            self.confirms = PublisherConfirms(self.producer, self.published, self.not_published, window=CONFIRM_WINDOW,
+                                              timeout=CONFIRM_TIMEOUT)
+            self.confirms.select()
+
+        if self.batcher is not None:
+            self.batch_producer = setup_producer(cfg=self.batch)
+
+        # Create consumer with incoming exchange/queue; or, for lanes, a consumer per lane queue (bound by its name),
+        # all on the same connection, and forward their messages by way of the scheduler (see 'lanes.LaneConsumers').
+        # Without lanes, but with signing, deliveries are likewise taken in together (see 'forward_delivered()').
+        # For several sources, each has a consumer on a connection of its own, made in the background (see
+        # 'sources.SourcePool'); deliveries are taken in together, so that a failing source is told apart from a
+        # failing publish.
+        if self.source_pool is not None:
+            self.source_pool.start()
+            return
+
+        if not self.lanes:
+            on_message = self.process_message
+            if self.signer is not None:
+                self.delivered = []
+                on_message = self.delivered.append
+            self.consumer = setup_consumer(cfg=self.incoming, on_message=on_message, prefetch_count=PREFETCH_COUNT)
+        else:
+            self.lane_consumers = LaneConsumers(self.lanes, lambda lane, on_message, connection: setup_consumer(
+                cfg=self.incoming._replace(queue=lane.queue, binding_key=lane.queue), on_message=on_message,
+                prefetch_count=lane.prefetch, connection=connection), quantum=LANE_QUANTUM, stats=self.stats)
+            self.consumer = self.lane_consumers.consumers[0]
+
+        for consumer in self.consumers():
+            consumer.consume()
+
+    def poll(self):
+        """ Wait for deliveries ("a single event from the server"), then forward them and attend to everything else. """
+
+        latency = self.latency
+
+        # Don't wait long if confirms, acks etc. are outstanding.
+        unconfirmed = any(len(confirms) > 0 for confirms in self.pending_confirms())
+        timeout = self.poll_timeout(unconfirmed)
+
+        started = latency.start()
+        if self.source_pool is not None:
+            self.source_pool.drain(timeout)
+        else:
+            self.drain_consumer(timeout)
+        latency.lap('drain_events', started)
+        self.backoff.reset()
+
+        if self.lane_consumers is not None:
+            self.forward(self.lane_consumers.take(self.drain_consumer))
+        elif self.source_pool is not None or self.delivered is not None:
+            self.forward_delivered()
+
+        if unconfirmed:
+            self.wait_confirms()
+        if self.batcher is not None:
+            self.batcher.tick()
+        for acker in self.ackers.values():
+            acker.tick()
+        if self.spooler is not None:
+            self.spooler.maybe_drain()
+        if self.archive is not None:
+            self.archive.flush()
+        if self.backpressure is not None:
+            self.apply_backpressure()
+
+    def poll_timeout(self, unconfirmed):
+        """ Seconds to wait for deliveries; not long if work is outstanding, such as 'unconfirmed' publishes. """
+
+        timeout = IDLE_INTERVAL
+        if unconfirmed:
+            timeout = POLL_INTERVAL
+        if any(len(acker.ready) > 0 for acker in self.ackers.values()):
+            timeout = min(POLL_INTERVAL, ACK_BATCH_INTERVAL)
+        if self.spooler is not None and self.spooler.spool.segments:
+            timeout = min(timeout, POLL_INTERVAL)
+        if self.batcher is not None and len(self.batcher):
+            timeout = min(timeout, POLL_INTERVAL, BATCH_INTERVAL)
+        if ((self.lane_consumers is not None and len(self.lane_consumers)) or
+                (self.source_pool is not None and len(self.source_pool)) or self.delivered):
+            timeout = MIN_WAIT
+
+        return timeout
+
+    def close(self):
+        """ Graceful degradation: settle what can be settled, then close every connection. """
+
+        for confirms in self.pending_confirms():
+            try:
+                confirms.flush(timeout=CONFIRM_TIMEOUT)
+            except Exception as e:
+                self.logger.error("Confirms not flushed: {}".format(e))
+        if self.batcher is not None:
+            try:
+                self.batcher.flush()
+            except Exception as e:
+                self.logger.error("Batch not published: {}".format(e))
+        for acker in self.ackers.values():
+            acker.flush()
+        if self.producer is not None:
+            self.producer.close()
+        if self.sharded is not None:
+            self.sharded.close()
+        if self.batch_producer is not None:
+            self.batch_producer.close()
+        for consumer in self.consumers():
+            consumer.close()
+        if self.source_pool is not None:
+            self.source_pool.close()
+        if self.spooler is not None:
+            self.spooler.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def errback(self, exc, interval):
+        """ Callback for use with 'ensure/autoretry'.
+
+            kombu's own retry interval is zero (see 'ensure()'), so the backoff delay is waited for here instead.
+
+        """
+
+        delay = self.backoff.next()
+        self.logger.error('Error: {}'.format(exc))
+        self.logger.info('Retry in {:.3f} seconds.'.format(delay))
+        self.stats.incr('retries')
+
+        self.stop.wait(delay)
+
+    def on_revive(self, channel):
+        """ Callback for use with 'ensure', once the connection (or channel) has been re-established.
+
+            The topology is declared again if the connection is a new one; otherwise it is cached.
+
+        """
+
+        self.logger.info('Reconnected; channel_id: {}'.format(channel.channel_id))
+        self.stats.incr('reconnects')
+        self.backoff.reset()
+
+        for producer in (self.producer, self.batch_producer):
+            if producer is not None and producer.channel is channel and producer._queue is not None:
+                maybe_declare(producer._queue, channel)
+
+        # The consumer has been revived on the new channel, so it has to resume consuming; so do any other lanes'
+        # consumers, on new channels of their own. Messages delivered on the old channels will be redelivered.
+        # Backpressure applies to the new channels too.
+        if self.consumer is not None and self.consumer.channel is channel:
+            for consumer in self.consumers():
+                if consumer is not self.consumer:
+                    consumer.revive(self.consumer.connection.channel())
+                for queue in consumer.queues:
+                    maybe_declare(queue, consumer.channel)
+                prefetch_count = self.prefetch(consumer)
+                if prefetch_count:
+                    consumer.qos(prefetch_count=prefetch_count)
+                if not self.paused():
+                    consumer.consume()
+
+            if self.lane_consumers is not None:
+                self.lane_consumers.clear()
+            if self.delivered is not None:
+                self.delivered.clear()
+
+    def ensure(self, connection, instance, method, *args, **kwargs):
+        """ Retries 'method' if it raises connection or channel error.
+
+            'method' is the name of a method of 'instance', or a function to be called in its stead.
+            Error is re-raised if 'max_retries' exceeded.
+
+        """
+        self.logger.debug("instance: {}, method: {}".format(instance.__class__, method))
+        _method = getattr(instance, method) if isinstance(method, str) else method
+        _wrapper = connection.ensure(instance, _method, errback=self.errback, on_revive=self.on_revive,
+                                     max_retries=MAX_RETRIES, interval_start=0, interval_step=0, interval_max=0)
+
+        return _wrapper(*args, **kwargs)
+
+    def prefetch(self, consumer):
+        """ Prefetch limit for 'consumer' now, i.e. as configured but scaled by any backpressure. """
+
+        if self.backpressure is None:
+            return consumer._prefetch_count
+        return self.backpressure.scale(consumer._prefetch_count)
+
+    def paused(self):
+        """ True if consumption is paused, by backpressure. """
+
+        return self.backpressure is not None and self.backpressure.state == PAUSED
+
+    def apply_backpressure(self):
+        """ Adjust to the outgoing queue depth (once it has been sampled again): prefetch, or pause or resume. """
+
+        backpressure, stats = self.backpressure, self.stats
+
+        was_paused = self.paused()
+        try:
+            changed = backpressure.update()
+        except Exception as e:
+            self.logger.error("Outgoing queue depth not sampled: {}".format(e))
+            return
+
+        stats.set('bp_state', backpressure.state)
+        stats.set('bp_depth', backpressure.depth)
+        stats.set('bp_factor', backpressure.factor)
+        stats.set('bp_rate', backpressure.current_rate() or 0.0)
+        if not changed:
+            return
+
+        # Messages already delivered are still forwarded, and acknowledged, while consumption is paused.
+        if self.paused():
+            if not was_paused:
+                self.logger.warning("Consumption paused; outgoing queue depth: {}".format(backpressure.depth))
+                stats.incr('bp_pauses')
+                for consumer in self.consumers():
+                    consumer.cancel()
+            return
+
+        for consumer in self.consumers():
+            prefetch_count = self.prefetch(consumer)
+            if prefetch_count:
+                consumer.qos(prefetch_count=prefetch_count)
+        self.logger.info("Prefetch scaled by {:.2f}; outgoing queue depth: {}".format(backpressure.factor,
+                                                                                   backpressure.depth))
+
+        if was_paused:
+            self.logger.warning("Consumption resumed; outgoing queue depth: {}".format(backpressure.depth))
+            for consumer in self.consumers():
+                consumer.consume()
+
+    def encode(self, message):
+        """ Body and 'publish()' keyword arguments for 'message', before any signature or compression.
+
+            The raw body is forwarded along with its content type, encoding and headers; only messages that cannot
+            be passed through are decoded, then serialized again.
+
+        """
+
+        if needs_decode(message):
+            content_type, content_encoding, body = kombu.serialization.dumps(message.decode(), SERIALIZER)
+            properties = dict(content_type=content_type, content_encoding=content_encoding, headers={},
+                              compression=None)
+        else:
+            body, properties = message.body, passthrough_properties(message)
+
+        # What is signed is exactly what is published (less any compression).
+        if isinstance(body, str):
+            body = body.encode(properties['content_encoding'] or 'utf-8')
+
+        return body, properties
+
+    def prepare(self, message, encoded=None, signature=None):
+        """ Body, routing key and 'publish()' keyword arguments for 'message'.
+
+            The routing key is derived from the headers; the body (as from 'encode()', unless 'encoded' is given) is
+            signed, unless its 'signature' is given already, and compressed, if so configured.
+
+        """
+
+        key = routing_key(message.headers) if routing_key is not None else None
+
+        body, properties = encoded or self.encode(message)
+
+        if self.signer is not None:
+            if signature is None:
+                signature = self.signer.sign(body)
+                self.stats.incr('signed')
+            properties['headers'] = dict(properties['headers'] or {}, **{SIGNATURE_HEADER: signature})
+
+        # A message that was compressed when received is compressed again anyway.
+        if self.compressor is not None and properties['compression'] is None:
+            body, properties['headers'] = self.compressor.compress(body, properties['headers'])
+
+        return body, key, properties
+
+    def publish(self, message):
+        """ Publish 'message' to the outgoing exchange, with retry management. """
+
+        # Kept with the message, in case it has to be spooled instead; it may have been prepared (and signed) already.
+        body, key, properties = message.outgoing = getattr(message, 'outgoing', None) or self.prepare(message)
+
+        try:
+            self.ensure(self.producer.connection, self.producer, 'publish', body, routing_key=key, **properties)
+        except Exception:
+            self.stats.incr('publish_errors')
+            raise
+
+        self.stats.incr('published')
+
+    def publish_sharded(self, message):
+        """ Publish 'message' to its shard or, if that is down, to another (see 'sharding.ShardedProducer'). """
+
+        body, key, properties = message.outgoing = getattr(message, 'outgoing', None) or self.prepare(message)
+        message.shard = self.sharded.publish(message, body, routing_key=key, **properties)
+
+    def pending_confirms(self):
+        """ Confirms in use: per shard, if sharded. """
+
+        if self.sharded is not None:
+            return self.sharded.confirms()
+        return [self.confirms] if self.confirms is not None else []
+
+    def wait_confirms(self):
+        """ Process whatever confirms have arrived; a shard whose connection fails is down. """
+
+        if self.sharded is not None:
+            self.sharded.wait()
+        else:
+            self.confirms.wait(timeout=0)
+
+    def published(self, message):
+        """ Complete the forwarding of 'message', once its publication has been confirmed. """
+
+        latency = self.latency
+
+        started = latency.start()
+        address = self.outgoing_address if self.sharded is None else message.shard.name
+        self.audit_logger.audit(AuditRecord(PUSH_ACK, message.delivery_tag, message.audit_header, address))
+        lap = latency.lap('audit', started)
+
+        self.stats.set('last_forward', time.time())
+
+        if self.dedup is not None:
+            self.dedup.add(message.dedup_key)
+
+        if self.archive is not None:
+            body, key, properties = message.outgoing
+            self.archive_message(body, key, properties)
+
+        # Acknowledge message only after publish(); if that fails, message is still in queue.
+        self.confirmed(message, lap)
+
+    def confirmed(self, message, lap=None):
+        """ One of the publishes of 'message' has been confirmed; acknowledge it once they all have. """
+
+        if message.unconfirmed > 0:
+            message.unconfirmed -= 1
+            if not message.unconfirmed:
+                self.acknowledge(message, self.latency.start() if lap is None else lap)
+
+    def rejected(self, message):
+        """ One of the publishes of 'message' has not been confirmed, so return it to the incoming queue (once). """
+
+        if message.unconfirmed > 0:
+            message.unconfirmed = 0
+            self.requeue(message)
+
+    def acknowledge(self, message, lap):
+        """ Acknowledge 'message' (or have it acknowledged, if in batches); 'lap' is as for 'latency.lap()'.
+
+            A message whose channel has gone (e.g. as its source failed while its publish awaited confirmation) is
+            skipped, as it is redelivered anyway; the acknowledgement of others is not held up by it.
+
+        """
+
+        try:
+            if message.acker is None:
+                message.ack()
+            else:
+                message.acker.ack(message)
+        except Exception as e:
+            self.logger.error("Acknowledgement failed: {}; redelivered: {}".format(e, message.delivery_tag))
+            return
+
+        self.latency.lap('ack', lap)
+        if message.acker is None:
+            self.acknowledged(message)
+
+    def acknowledged(self, message):
+        """ Audit the acknowledgement of 'message'. """
+
+        self.stats.incr('acked')
+
+        started = self.latency.start()
+        self.audit_logger.audit(AuditRecord(PULL_ACK, message.delivery_tag, message.audit_header,
+                                            self.outgoing_address))
+        self.latency.lap('audit', started)
+
+    def not_published(self, message):
+        """ Return 'message' to the incoming queue, as its publication was not confirmed. """
+
+        self.logger.error("Publish not confirmed, requeue: {}".format(message.delivery_tag))
+        self.rejected(message)
+
+    def requeue(self, message):
+        """ Return 'message' to the incoming queue. """
+
+        self.stats.incr('requeued')
+        try:
+            if getattr(message, 'acker', None) is None:
+                message.requeue()
+            else:
+                message.acker.requeue(message)
+        # Message is redelivered anyway if the incoming channel has gone.
+        except Exception as e:
+            self.logger.error("Requeue failed: {}".format(e))
+
+    def publish_batch(self, body, content_type, headers):
+        """ Publish an envelope to the batch exchange (see 'batching.Batcher'), compressed if so configured. """
+
+        if self.compressor is not None:
+            body, headers = self.compressor.compress(body, headers)
+
+        self.ensure(self.batch_producer.connection, self.batch_producer, 'publish', body, content_type=content_type,
+                    content_encoding='binary' if content_type != 'application/json' else 'utf-8', headers=headers)
+
+        self.stats.incr('batches')
+        self.stats.incr('batched', headers['batch_size'])
+
+    def spool_message(self, message, lap):
+        """ Spool 'message', then acknowledge it once it is on disk; 'lap' is as for 'latency.lap()'.
+
+            If the spool is full, the message is requeued instead and 'SpoolFull' raised.
+
+        """
+
+        body, key, properties = getattr(message, 'outgoing', None) or self.prepare(message)
+        if isinstance(body, str):
+            body = body.encode(properties['content_encoding'] or 'utf-8')
+
+        try:
+            self.spooler.append(body, dict(properties, routing_key=key, audit_header=message.audit_header))
+        except SpoolFull as e:
+            self.logger.error("{}; requeue: {}".format(e, message.delivery_tag))
+            self.requeue(message)
+            raise
+
+        self.audit_logger.audit(AuditRecord(SPOOLED, message.delivery_info, message.audit_header,
+                                            message.incoming_address))
+        self.acknowledge(message, self.latency.lap('audit', lap))
+
+    def unspooled(self, meta, body):
+        """ Complete the forwarding of a spooled message, once its publication has been confirmed. """
+
+        self.stats.incr('published')
+        self.stats.incr('unspooled')
+        self.stats.set('last_forward', time.time())
+
+        self.audit_logger.audit(AuditRecord(UNSPOOLED, meta['t'], meta['audit_header'], self.outgoing_address))
+
+        if self.archive is not None:
+            self.archive_message(body, meta['routing_key'], meta)
+
+    def archive_message(self, body, key, properties):
+        """ Archive a message that has been forwarded; if that fails, it is just logged, as forwarding carries on. """
+
+        try:
+            self.archive.write(Record(body, properties['content_type'], properties['content_encoding'],
+                                      properties['headers'], key, properties['compression'], time.time()))
+        except Exception as e:
+            self.logger.error("Not archived: {}".format(e))
+
+    # Handler ('on_message' callback) for consumer.
+    def process_message(self, message):
+        """ Forward messages from the 'System of Record' to the outside world
+
+            'message' is the packet as a whole; its body is not decoded unless that is necessary.
+
+        """
+
+        latency, stats, audit_logger = self.latency, self.stats, self.audit_logger
+
+        started = latency.start()
+
+        stats.incr('consumed')
+
+        # Acknowledged in batches, if so configured; per lane (or source), as each has a channel of its own.
+        message.acker = self.ackers.get(getattr(message, 'lane', None) or getattr(message, 'source', None))
+        if message.acker is not None:
+            message.acker.received(message)
+
+        # Audited as from its own source, if there are several.
+        message.incoming_address = getattr(message, 'source', None) or self.incoming_address
+
+        # Header (which contains the title number) is kept with the message, for the audit records that follow.
+        message.audit_header = get_message_header(message)
+        lap = latency.lap('header', started)
+
+        audit_logger.audit(AuditRecord(PULL, message.delivery_info, message.audit_header, message.incoming_address))
+
+        # A redelivered message may have been published already, before the forwarder died; if so, just acknowledge it.
+        if self.dedup is not None:
+            message.dedup_key = dedup_key(message.properties.get('message_id'), message.body)
+            if message.delivery_info.get('redelivered'):
+                stats.incr('dedup_checks')
+                if self.dedup.seen(message.dedup_key):
+                    stats.incr('duplicates')
+                    audit_logger.audit(AuditRecord(DUPLICATE, message.delivery_info, message.audit_header,
+                                                   message.incoming_address))
+                    self.acknowledge(message, latency.lap('audit', lap))
+                    latency.lap('process', started)
+                    return
+
+        # Publishes (per message and in an envelope) that have yet to be confirmed; see 'confirmed()'.
+        message.unconfirmed = 1 if self.batcher is None else 2
+
+        # Whatever is in the spool has to be published first, so that messages stay in order.
+        if self.spooler is not None and self.spooler.active:
+            self.spool_message(message, lap)
+            latency.lap('process', started)
+            return
+
+        # Keep to the publish rate, if throttled.
+        if self.backpressure is not None:
+            delay = self.backpressure.delay()
+            if delay > 0:
+                stats.incr('bp_wait_seconds', delay)
+                self.stop.wait(delay)
+
+        # Forward message to outgoing exchange, with retry management.
+        audit_logger.audit(AuditRecord(PUSH, message.delivery_info, message.audit_header, message.incoming_address))
+        lap = latency.lap('audit', lap)
+
+        try:
+            if self.sharded is not None:
+                self.publish_sharded(message)
+            elif self.confirms is None:
+                self.publish(message)
+            else:
+                # Acknowledged (or requeued) later, when the broker confirms (or rejects) the publish.
+                self.confirms.publish(message, self.publish, message)
+        except Exception as e:
+            # Settled here, rather than left unacknowledged to hold up the batch acknowledgement of the rest.
+            if self.spooler is None:
+                self.requeue(message)
+                raise
+            self.spooler.failed(e)
+            self.spool_message(message, lap)
+            latency.lap('process', started)
+            return
+
+        latency.lap('publish', lap)
+        if not self.async_confirms:
+            self.published(message)
+
+        # Acknowledged once the envelope has been confirmed too; kombu has already decompressed the body.
+        if self.batcher is not None:
+            headers = dict(message.headers)
+            headers.pop('compression', None)
+            self.batcher.add(message, message.body, message.content_type, message.content_encoding, headers)
+
+        latency.lap('process', started)
+
+    def drain_consumer(self, timeout=MIN_WAIT):
+        """ Wait up to 'timeout' seconds for a delivery to the consumer (or a lane's); True if there was one. """
+
+        connection = self.consumer.connection
+        return self.ensure(connection, self.consumer, drain_events, connection, timeout=timeout)
+
+    def forward_delivered(self):
+        """ Take in whatever else has been delivered already (up to 'SIGNING_BATCH' or, from several sources and if not
+            signing, 'SOURCE_BATCH'), then forward it all.
+
+        """
+
+        if self.source_pool is not None:
+            messages = self.source_pool.take(SIGNING_BATCH if self.signer is not None else SOURCE_BATCH)
+        else:
+            while len(self.delivered) < SIGNING_BATCH and self.drain_consumer():
+                pass
+            messages = list(self.delivered)
+            self.delivered.clear()
+
+        self.forward(messages)
+
+    def sign_messages(self, messages):
+        """ Prepare 'messages' for publication, signing them all at once (in parallel, if so configured). """
+
+        encoded = [self.encode(message) for message in messages]
+
+        started = time.monotonic()
+        signatures = self.signer.sign_all([body for body, _ in encoded])
+        self.stats.incr('sign_seconds', time.monotonic() - started)
+        self.stats.incr('signed', len(messages))
+
+        for message, _encoded, signature in zip(messages, encoded, signatures):
+            message.outgoing = self.prepare(message, _encoded, signature)
+
+    def forward(self, messages):
+        """ Forward 'messages' in turn, having signed them (together) first if so configured. """
+
+        done = 0
+        try:
+            if self.signer is not None:
+                self.sign_messages(messages)
+            for message in messages:
+                self.process_message(message)
+                done += 1
+        except Exception:
+            # The rest go back to the incoming queue(s), rather than being left unacknowledged; the one that failed
+            # may have been requeued already.
+            for message in messages[done:]:
+                if not message.acknowledged:
+                    self.requeue(message)
+            raise
+
+    def start_consumer(self, consumer):
+        """ Start a source's new 'consumer' consuming (unless paused), its prefetch limit scaled by backpressure. """
+
+        if self.backpressure is not None and consumer._prefetch_count:
+            consumer.qos(prefetch_count=self.prefetch(consumer))
+        if not self.paused():
+            consumer.consume()
+
+    def source_failed(self, source):
+        """ 'source' has failed, so whatever it delivered that is still to be acknowledged is forgotten. """
+
+        if source.name in self.ackers:
+            self.ackers[source.name] = self.setup_acker(PREFETCH_COUNT)
+
+    def consumers(self):
+        """ Incoming consumers in use: per source or lane, if so configured. """
+
+        if self.source_pool is not None:
+            return self.source_pool.consumers
+        if self.lane_consumers is not None:
+            return self.lane_consumers.consumers
+        return [self.consumer] if self.consumer is not None else []
+
+    def setup_acker(self, prefetch_count):
+        """ Batched acknowledgement (see 'acks.py') for a channel with 'prefetch_count', if so configured. """
+
+        ack_batch_size = min(ACK_BATCH_SIZE, prefetch_count) if prefetch_count else ACK_BATCH_SIZE
+        if ack_batch_size > 1:
+            return BatchAcker(size=ack_batch_size, interval=ACK_BATCH_INTERVAL, on_ack=self.acknowledged)
+        return None
+
+
+# This is executed as a separate process by unit tests; cannot refer to 'INCOMING_QUEUE' etc. in that case.
+def run(worker_id=0, stats=None, stop=None, incoming=incoming_cfg, outgoing=outgoing_cfg, batch=batch_cfg):
+    """ "System of Record" to "Feeder" re-publisher.
+
+        Forwards from 'incoming' to 'outgoing' (configurations) via a 'Forwarder' until interrupted or until the 'stop'
+        event is set, updating 'stats' (see 'workers.WorkerStats'); also in envelopes to 'batch', if its exchange is
+        named. 'incoming' may be a list of configurations, for several sources (see 'sources.py').
+
+    """
+
+    logger = setup_logger(LOG_NAME + '.run')
+    logger.info("worker_id: {}".format(worker_id))
+
+    # E.g. no message may be missing from the envelopes.
+    check(batch)
+
+    engine = Forwarder(worker_id, stats, stop, incoming, outgoing, batch, logger)
+    engine.start()
+    stats, stop = engine.stats, engine.stop
+
+    # This process's own audit sink etc. are sampled for the parent (see 'stats()'), if a process of its own.
+    sample_at = 0.0
+
+    # Loop "forever" (until asked to stop), as a service.
+    # N.B.: if there is a serious network failure or the like then this will keep logging errors!
+    while not stop.is_set():
+        try:
+            engine.poll()
+
+            if WORKER_MODE == 'process' and time.monotonic() >= sample_at:
+                sample_process_stats(stats)
+                sample_at = time.monotonic() + STATS_INTERVAL
+
+        # Permit an explicit abort.
+        except KeyboardInterrupt:
+            logger.error("KeyboardInterrupt received!")
+            break
+        # Trap (log) everything else.
+        except Exception as e:
+            err_line_no = sys.exc_info()[2].tb_lineno
+            logger.exception("{}: {}".format(err_line_no, str(e)))
+            stats.incr('errors')
+
+            # If we ignore the problem, perhaps it will go away ...
+            stop.wait(engine.backoff.next())
+
+    # Graceful degradation.
+    engine.close()
+
+    # A worker process is about to exit, so write out its outstanding audit records (and stop its signing processes).
+    if WORKER_MODE == 'process' and audit_sink is not None:
+        audit_sink.stop()
+    if WORKER_MODE == 'process':
+        sample_process_stats(stats)
+    if WORKER_MODE == 'process' and signer is not None:
+        signer.close()
+
+
+def stats():
+    """ Stats for the HTTP app: per-worker counters, latency summary, audit sink and duplicates cache status, and
+        backpressure and signing settings.
+
+    """
+
+    workers = pool.status() if pool is not None else []
+    latency = metrics.latency_summary([worker_stats.latency for worker_stats in pool.stats]) if pool is not None else {}
+
+    # Worker processes have an audit sink each, so theirs are gathered from their stats.
+    audit = dict(enabled=audit_sink is not None)
+    if WORKER_MODE == 'process':
+        audit = dict(enabled=AUDIT_ASYNC)
+        if AUDIT_ASYNC:
+            audit.update(metrics.audit_summary(workers, AUDIT_QUEUE_SIZE, AUDIT_OVERFLOW))
+    elif audit_sink is not None:
+        audit.update(audit_sink.stats())
+
+    # Likewise their duplicates caches; each has an index of its own, suffixed by the worker's id.
+    dedup = dict(enabled=dedup_cache is not None)
+    if WORKER_MODE == 'process':
+        dedup = dict(enabled=DEDUP)
+        if DEDUP:
+            dedup.update(metrics.dedup_summary(workers, DEDUP_CAPACITY, DEDUP_TTL, DEDUP_INDEX or None))
+    elif dedup_cache is not None:
+        dedup.update(dedup_cache.stats())
+
+    backpressure = dict(enabled=BACKPRESSURE)
+    if BACKPRESSURE:
+        backpressure.update(low=BACKPRESSURE_LOW, high=BACKPRESSURE_HIGH, limit=BACKPRESSURE_LIMIT,
+                            rate=BACKPRESSURE_RATE, min_factor=BACKPRESSURE_MIN_FACTOR)
+
+    signing = dict(enabled=bool(SIGNING_KEY))
+    if SIGNING_KEY:
+        signing.update(key=SIGNING_KEY, processes=SIGNING_PROCESSES, batch=SIGNING_BATCH)
+
+    return dict(pid=os.getpid(), workers=workers, latency=latency, audit=audit, dedup=dedup, backpressure=backpressure,
+                signing=signing)
+
+
+def write_stats():
+    try:
+        snapshot.write(STATS_FILE, stats())
+    # Stats are not worth stopping for.
+    except Exception as e:
+        logger.error("Stats not written: {}".format(e))
+
+
+def run_workers():
+    """ Run 'WORKERS' instances of 'run()', restarting any that die, until interrupted. """
+
+    global pool
+
+    # Refuses to start if it would not forward as configured.
+    target = run
+    if ENGINE == 'asyncio':
+        # Imported here, as that module builds on this one.
+        from . import aio
+        target = aio.run
+        aio.check()
+    else:
+        check()
+
+    # Each worker drains its own spool only, so anything spooled by a worker that no longer exists stays put.
+    for path in undrained(SPOOL_DIR, WORKERS) if SPOOL_DIR else []:
+        logger.warning("Spool {} is not drained by any of {} worker(s); replay it (see 'replay.py') or run more "
+                       "workers.".format(path, WORKERS))
+
+    if DEDUP and WORKER_MODE == 'process' and WORKERS > 1:
+        logger.warning("DEDUP with {0} worker processes: each has a duplicates cache of its own, so only about 1 in "
+                       "{0} redelivered duplicates are suppressed.".format(WORKERS))
+
+    stages = STAGES if LATENCY_HISTOGRAMS else None
+    pool = WorkerPool(target, size=WORKERS, mode=WORKER_MODE, stages=stages, window=LATENCY_WINDOW,
+                      lanes=[lane.queue for lane in LANES], shards=SHARDS, sources=SOURCES)
+    pool.start()
+
+    try:
+        pool.supervise(interval=STATS_INTERVAL, callback=write_stats)
+    except KeyboardInterrupt:
+        logger.error("KeyboardInterrupt received!")
+    finally:
+        pool.stop()
+        write_stats()
+        if audit_sink is not None:
+            audit_sink.stop()
+        if dedup_cache is not None:
+            dedup_cache.close()
+        if depth_counter is not None:
+            depth_counter.close()
+        if signer is not None:
+            signer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Register-Publisher: forward messages from the System of Record.")
+    parser.add_argument('--workers', type=int, help="Number of forwarding workers (default: WORKERS).")
+    args = parser.parse_args()
+
+    global WORKERS
+    if args.workers:
+        WORKERS = args.workers
+
+    logger.info("Forwarder started; pid: {}".format(os.getpid()))
+    run_workers()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/bin/python
+import time
+import logging
+from collections import deque
+
+
+"""
+Priority lanes: several incoming queues, consumed in weighted-fair order.
+
+Each lane is an incoming queue with a weight and a prefetch limit of its own, so the broker never has more than
+'prefetch' unacknowledged messages out from any one lane. Delivered messages are buffered per lane and forwarded by
+deficit round robin (DRR): in each round, every lane with messages waiting may forward up to 'weight' * 'quantum'
+bytes' worth, plus whatever it was owed from the last round. A flood on one lane only fills that lane's buffer, so it
+cannot starve the others.
+
+'LaneScheduler' does the buffering and scheduling; 'LaneConsumers' consumes from the lanes' queues into it.
+
+"""
+
+logger = logging.getLogger('RP.lanes')
+
+
+class Lane(object):
+    """ Incoming queue 'queue', with DRR weight 'weight' and prefetch limit 'prefetch' (0 is unlimited). """
+
+    def __init__(self, queue, weight=1, prefetch=0):
+
+        # Run-time checks.
+        assert weight > 0
+        assert prefetch >= 0
+
+        self.queue = queue
+        self.weight = weight
+        self.prefetch = prefetch
+
+        self.messages = deque()             # (message, time delivered), oldest first.
+        self.deficit = 0
+
+    def __repr__(self):
+        return '<Lane: {}, weight {}, prefetch {}>'.format(self.queue, self.weight, self.prefetch)
+
+
+def parse_lanes(spec, prefetch=0):
+    """ Lanes from 'spec', e.g. "urgent:8,bulk:1:20" (queue name, weight and optional prefetch, else 'prefetch'). """
+
+    lanes = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+
+        fields = item.split(':')
+        if len(fields) > 3:
+            raise ValueError("Invalid lane: '{}'".format(item))
+        queue = fields[0]
+        weight = int(fields[1]) if len(fields) > 1 else 1
+        lane_prefetch = int(fields[2]) if len(fields) > 2 else prefetch
+        lanes.append(Lane(queue, weight, lane_prefetch))
+
+    if len(set(lane.queue for lane in lanes)) != len(lanes):
+        raise ValueError("Duplicate lane: '{}'".format(spec))
+
+    return lanes
+
+
+class LaneScheduler(object):
+    """ Buffers deliveries from 'lanes' and hands them out by DRR, with a quantum of 'quantum' bytes per weight.
+
+        Per-lane counts, bytes, waiting time (from delivery to being handed out) and buffered messages are recorded
+        in 'stats' (see 'workers.WorkerStats'), if given.
+
+    """
+
+    def __init__(self, lanes, quantum=4096, stats=None):
+
+        # Run-time checks.
+        assert lanes
+        assert quantum > 0
+
+        self.lanes = list(lanes)
+        self.quantum = quantum
+        self.stats = stats
+
+        self.buffered = 0
+
+    def __len__(self):
+        return self.buffered
+
+    def put(self, lane, message):
+        """ Buffer 'message', just delivered from 'lane'. """
+
+        lane.messages.append((message, time.monotonic()))
+        self.buffered += 1
+
+        if self.stats is not None:
+            self.stats.lane_set(lane.queue, 'buffered', len(lane.messages))
+
+    def round(self):
+        """ One DRR round: buffered messages from each lane in turn, up to what that lane may forward this round. """
+
+        now = time.monotonic()
+        messages = []
+
+        for lane in self.lanes:
+            if not lane.messages:
+                continue
+
+            lane.deficit += lane.weight * self.quantum
+            taken = 0
+            waited = 0.0
+            size = 0
+            while lane.messages:
+                message, delivered = lane.messages[0]
+                cost = max(len(message.body), 1)
+                if cost > lane.deficit:
+                    break
+
+                lane.messages.popleft()
+                lane.deficit -= cost
+                messages.append(message)
+                taken += 1
+                waited += now - delivered
+                size += cost
+
+            # An idle lane does not save up its allowance.
+            if not lane.messages:
+                lane.deficit = 0
+
+            self.buffered -= taken
+
+            if self.stats is not None and taken:
+                self.stats.lane_incr(lane.queue, 'forwarded', taken)
+                self.stats.lane_incr(lane.queue, 'bytes', size)
+                self.stats.lane_incr(lane.queue, 'wait_seconds', waited)
+                self.stats.lane_set(lane.queue, 'buffered', len(lane.messages))
+
+        return messages
+
+    def clear(self):
+        """ Discard all buffered messages, e.g. as their channels have gone (so they will be redelivered). """
+
+        for lane in self.lanes:
+            lane.messages.clear()
+            lane.deficit = 0
+            if self.stats is not None:
+                self.stats.lane_set(lane.queue, 'buffered', 0)
+
+        self.buffered = 0
+
+
+class LaneConsumers(object):
+    """ A consumer for each of 'lanes', made by 'connect(lane, on_message, connection)' (on the connection of the
+        first, once made), whose deliveries are buffered and handed out by a 'LaneScheduler' with 'quantum' and 'stats'.
+
+    """
+
+    def __init__(self, lanes, connect, quantum=4096, stats=None):
+        self.scheduler = LaneScheduler(lanes, quantum=quantum, stats=stats)
+
+        # No more is buffered than the lanes' prefetch limits allow (or 1000 for each that is unlimited).
+        self.capacity = sum(lane.prefetch or 1000 for lane in lanes)
+
+        self.consumers = []
+        for lane in lanes:
+            connection = self.consumers[0].connection if self.consumers else None
+            self.consumers.append(connect(lane, lambda message, lane=lane: self.receive(lane, message), connection))
+            logger.info("Lane: {}".format(lane))
+
+    def __len__(self):
+        return len(self.scheduler)
+
+    def receive(self, lane, message):
+        """ Handler for a lane's consumer: buffer 'message', to be handed out in its turn. """
+
+        message.lane = lane.queue
+        self.scheduler.put(lane, message)
+
+    def take(self, drain):
+        """ Take in whatever else has been delivered already, via 'drain()' (True if there was a delivery), then hand
+            out one (weighted-fair) round of it.
+
+        """
+
+        while len(self.scheduler) < self.capacity and drain():
+            pass
+
+        return self.scheduler.round()
+
+    def clear(self):
+        self.scheduler.clear()
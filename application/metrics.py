@@ -0,0 +1,415 @@
+#!/bin/python
+import math
+import time
+from bisect import bisect_left
+from multiprocessing.sharedctypes import RawArray
+
+
+"""
+Metrics for scrapers (e.g. Prometheus), in the text exposition format.
+
+The counters themselves are the per-worker 'workers.WorkerStats', which are incremented without locking on the
+forwarding path; they are only gathered up and formatted here, when the metrics are requested. Likewise, per-stage
+latencies are recorded in per-worker 'LatencyHistograms' and only summarized on request.
+
+"""
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# WorkerStats field -> (metric name, help).
+COUNTERS = [
+    ('consumed', 'rp_messages_consumed_total', 'Messages consumed from the incoming queue.'),
+    ('published', 'rp_messages_published_total', 'Messages published to the outgoing exchange.'),
+    ('acked', 'rp_messages_acked_total', 'Incoming messages acknowledged.'),
+    ('requeued', 'rp_messages_requeued_total', 'Incoming messages requeued, as their publication was not confirmed.'),
+    ('retries', 'rp_retries_total', 'Broker operations retried after a connection or channel error.'),
+    ('publish_errors', 'rp_publish_errors_total', 'Publishes that failed, after any retries.'),
+    ('errors', 'rp_errors_total', 'Errors trapped by the forwarding loop.'),
+    ('reconnects', 'rp_reconnects_total', 'Connections re-established after an error.'),
+    ('restarts', 'rp_worker_restarts_total', 'Workers restarted by the supervisor.'),
+    ('compressed', 'rp_messages_compressed_total', 'Outgoing messages published compressed.'),
+    ('compress_bytes_in', 'rp_compression_input_bytes_total', 'Size of outgoing message bodies before compression.'),
+    ('compress_bytes_out', 'rp_compression_output_bytes_total', 'Size of outgoing message bodies after compression.'),
+    ('compress_seconds', 'rp_compression_cpu_seconds_total', 'CPU time spent compressing outgoing message bodies.'),
+    ('dedup_checks', 'rp_dedup_checks_total', 'Redelivered messages checked against the duplicates cache.'),
+    ('duplicates', 'rp_duplicates_total', 'Redelivered messages not published again, as they had been already.'),
+    ('spooled', 'rp_messages_spooled_total', 'Incoming messages spooled, as the outgoing broker was unavailable.'),
+    ('unspooled', 'rp_messages_unspooled_total', 'Spooled messages published (and confirmed) once it was back.'),
+    ('spool_refused', 'rp_spool_refused_total', 'Messages left in the incoming queue, as the spool was full.'),
+    ('batches', 'rp_batches_published_total', 'Batched envelopes published to the batch exchange.'),
+    ('batched', 'rp_messages_batched_total', 'Messages published in batched envelopes.'),
+    ('bp_pauses', 'rp_backpressure_pauses_total', 'Times that consumption was paused, as the outgoing queue was full.'),
+    ('bp_wait_seconds', 'rp_backpressure_wait_seconds_total', 'Time spent waiting to publish, while throttled.'),
+    ('signed', 'rp_messages_signed_total', 'Outgoing messages signed.'),
+    ('sign_seconds', 'rp_signing_seconds_total', 'Time spent waiting for signatures.'),
+]
+
+# WorkerStats field -> (metric name, help), for values that are not counts.
+GAUGES = [
+    ('spool_messages', 'rp_spool_messages', 'Messages in the spool.'),
+    ('spool_bytes', 'rp_spool_bytes', 'Size of the spool.'),
+    ('bp_state', 'rp_backpressure_state', 'Backpressure: 0 for open, 1 for throttled, 2 for paused.'),
+    ('bp_depth', 'rp_backpressure_outgoing_depth', 'Outgoing queue depth, as last sampled for backpressure.'),
+    ('bp_factor', 'rp_backpressure_factor', 'Scaling of prefetch and publish rate, from 1 (open) down.'),
+]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in sorted(labels.items())) + '}'
+
+
+def _value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(families):
+    """ Exposition text for 'families': (name, type, help, [(labels, value), ...]) tuples.
+
+        A sample may also be given as (suffix, labels, value), e.g. for the '_count' and '_sum' of a summary.
+
+    """
+
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for sample in samples:
+            suffix, labels, value = sample if len(sample) == 3 else ('',) + tuple(sample)
+            lines.append('{}{}{} {}'.format(name, suffix, _labels(labels), _value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+def forwarder_families(workers, queue_depths, now=None):
+    """ Metric families for the forwarder, from 'WorkerPool.status()' and a {queue: depth} dict. """
+
+    now = time.time() if now is None else now
+    families = []
+
+    for field, name, help_text in COUNTERS:
+        samples = [({'worker': worker['worker']}, worker[field]) for worker in workers]
+        families.append((name, 'counter', help_text, samples))
+
+    for field, name, help_text in GAUGES:
+        samples = [({'worker': worker['worker']}, worker[field]) for worker in workers]
+        families.append((name, 'gauge', help_text, samples))
+
+    families.append(('rp_spool_oldest_age_seconds', 'gauge', 'Age of the oldest message in the spool, if any.',
+                     [({'worker': worker['worker']}, now - worker['spool_oldest'] if worker['spool_oldest'] else 0.0)
+                      for worker in workers]))
+
+    last_forward = max([worker['last_forward'] for worker in workers] or [0])
+    since = now - last_forward if last_forward else None
+    families.append(('rp_seconds_since_last_forward', 'gauge',
+                     'Seconds since a message was last forwarded successfully (by any worker).', [({}, since)]))
+
+    families.append(('rp_workers_alive', 'gauge', 'Workers that are running.',
+                     [({}, sum(1 for worker in workers if worker['alive']))]))
+
+    families.append(('rp_queue_messages', 'gauge', 'Messages waiting in a queue.',
+                     [({'queue': queue}, depth) for queue, depth in sorted(queue_depths.items())]))
+
+    return families
+
+
+def lane_summary(workers):
+    """ Per-lane totals across 'workers' (from 'WorkerPool.status()'), with the mean waiting time of each lane. """
+
+    lanes = {}
+    for worker in workers:
+        for lane, values in worker.get('lanes', {}).items():
+            totals = lanes.setdefault(lane, dict(forwarded=0, bytes=0, wait_seconds=0.0, buffered=0))
+            for name, value in values.items():
+                totals[name] += value
+
+    for totals in lanes.values():
+        totals['mean_wait_seconds'] = totals['wait_seconds'] / totals['forwarded'] if totals['forwarded'] else None
+
+    return lanes
+
+
+def lane_families(workers):
+    """ Metric families for priority lanes (see 'lanes.py'), per worker and lane; none if there are no lanes. """
+
+    samples = dict((name, []) for name in ('forwarded', 'bytes', 'wait_seconds', 'buffered'))
+    for worker in workers:
+        for lane, values in sorted(worker.get('lanes', {}).items()):
+            labels = {'worker': worker['worker'], 'lane': lane}
+            for name, value in values.items():
+                samples[name].append((labels, value))
+
+    if not samples['forwarded']:
+        return []
+
+    return [
+        ('rp_lane_messages_total', 'counter', 'Messages forwarded from each lane.', samples['forwarded']),
+        ('rp_lane_bytes_total', 'counter', 'Message bytes forwarded from each lane.', samples['bytes']),
+        ('rp_lane_wait_seconds_total', 'counter', 'Time that messages from each lane waited to be forwarded.',
+         samples['wait_seconds']),
+        ('rp_lane_buffered', 'gauge', 'Messages delivered from each lane and waiting to be forwarded.',
+         samples['buffered']),
+    ]
+
+
+def shard_summary(workers):
+    """ Per-shard totals across 'workers' (from 'WorkerPool.status()'); a shard is healthy if so for every worker. """
+
+    shards = {}
+    for worker in workers:
+        for shard, values in worker.get('shards', {}).items():
+            totals = shards.setdefault(shard, dict(published=0, failovers=0, errors=0, healthy=1))
+            for name, value in values.items():
+                if name == 'healthy':
+                    totals[name] = min(totals[name], value)
+                else:
+                    totals[name] += value
+
+    for totals in shards.values():
+        totals['healthy'] = bool(totals['healthy'])
+
+    return shards
+
+
+def shard_families(workers):
+    """ Metric families for outgoing shards (see 'sharding.py'), per worker and shard; none if there are no shards. """
+
+    samples = dict((name, []) for name in ('published', 'failovers', 'errors', 'healthy'))
+    for worker in workers:
+        for shard, values in sorted(worker.get('shards', {}).items()):
+            labels = {'worker': worker['worker'], 'shard': shard}
+            for name, value in values.items():
+                samples[name].append((labels, value))
+
+    if not samples['published']:
+        return []
+
+    return [
+        ('rp_shard_messages_published_total', 'counter', 'Messages published to each outgoing shard.',
+         samples['published']),
+        ('rp_shard_failovers_total', 'counter', 'Messages for each shard published to another, as it was down.',
+         samples['failovers']),
+        ('rp_shard_errors_total', 'counter', 'Failed publishes to each shard.', samples['errors']),
+        ('rp_shard_healthy', 'gauge', 'Whether each shard is up (1) or down (0).', samples['healthy']),
+    ]
+
+
+def source_summary(workers):
+    """ Per-source totals across 'workers' (from 'WorkerPool.status()'); a source is healthy if it is for every
+        worker.
+
+    """
+
+    sources = {}
+    for worker in workers:
+        for source, values in worker.get('sources', {}).items():
+            totals = sources.setdefault(source, dict(consumed=0, reconnects=0, errors=0, healthy=1))
+            for name, value in values.items():
+                if name == 'healthy':
+                    totals[name] = min(totals[name], value)
+                else:
+                    totals[name] += value
+
+    for totals in sources.values():
+        totals['healthy'] = bool(totals['healthy'])
+
+    return sources
+
+
+def source_families(workers):
+    """ Metric families for incoming sources (see 'sources.py'), per worker and source; none if there are none. """
+
+    samples = dict((name, []) for name in ('consumed', 'reconnects', 'errors', 'healthy'))
+    for worker in workers:
+        for source, values in sorted(worker.get('sources', {}).items()):
+            labels = {'worker': worker['worker'], 'source': source}
+            for name, value in values.items():
+                samples[name].append((labels, value))
+
+    if not samples['consumed']:
+        return []
+
+    return [
+        ('rp_source_messages_consumed_total', 'counter', 'Messages consumed from each incoming source.',
+         samples['consumed']),
+        ('rp_source_reconnects_total', 'counter', 'Reconnections to each source, after it failed.',
+         samples['reconnects']),
+        ('rp_source_errors_total', 'counter', 'Connection failures for each source.', samples['errors']),
+        ('rp_source_healthy', 'gauge', 'Whether each source is up (1) or down (0).', samples['healthy']),
+    ]
+
+
+def audit_summary(workers, capacity, overflow):
+    """ Audit sink status, in total across 'workers' (from 'WorkerPool.status()') that are processes with a sink each
+        of 'capacity'; as per 'AuditSink.stats()'.
+
+    """
+
+    return dict(depth=sum(worker['audit_depth'] for worker in workers), capacity=capacity * len(workers),
+                overflow=overflow, written=sum(worker['audit_written'] for worker in workers),
+                dropped=sum(worker['audit_dropped'] for worker in workers),
+                batches=sum(worker['audit_batches'] for worker in workers),
+                last_flush_latency=max([worker['audit_flush_latency'] for worker in workers] or [0.0]),
+                max_flush_latency=max([worker['audit_max_flush_latency'] for worker in workers] or [0.0]))
+
+
+def dedup_summary(workers, capacity, ttl, index=None):
+    """ Duplicates cache status, in total across 'workers' (from 'WorkerPool.status()') that are processes with a
+        cache each of 'capacity'; as per 'DedupCache.stats()'.
+
+    """
+
+    checks = sum(worker['dedup_checks'] for worker in workers)
+    hits = sum(worker['duplicates'] for worker in workers)
+
+    return dict(entries=sum(worker['dedup_entries'] for worker in workers), capacity=capacity * len(workers), ttl=ttl,
+                checks=checks, hits=hits, hit_rate=float(hits) / checks if checks else None,
+                bytes=sum(worker['dedup_bytes'] for worker in workers), index=index)
+
+
+# Latency histogram bucket upper bounds (seconds): 10 microseconds to ~10 seconds, doubling; plus an overflow bucket.
+LATENCY_BUCKETS = tuple(0.00001 * 2 ** n for n in range(21))
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencyHistograms(object):
+    """ Fixed-bucket histograms of per-stage latency, over a rolling window of 'window' to 2 * 'window' seconds.
+
+        Counts are kept in shared memory for two windows - the current one and the last - and the older is cleared
+        when the current window is 'window' seconds old. As with 'WorkerStats', there is a single (unlocked) writer.
+
+    """
+
+    def __init__(self, stages, window=60.0):
+        self.stages = tuple(stages)
+        self.window = window
+
+        self._index = dict((stage, n) for n, stage in enumerate(self.stages))
+        self._size = len(LATENCY_BUCKETS) + 1
+        self._stride = len(self.stages) * self._size
+
+        self._counts = RawArray('L', 2 * self._stride)
+        self._sums = RawArray('d', 2 * len(self.stages))
+        self._state = RawArray('d', 2)      # Current window (0 or 1), start of current window.
+
+    def start(self):
+        """ Start timing; returns a value for 'lap()'. """
+
+        return time.perf_counter()
+
+    def lap(self, stage, started):
+        """ Record the time taken by 'stage', since 'started'; returns a value for the next 'lap()'. """
+
+        now = time.perf_counter()
+        self.observe(stage, now - started, now)
+        return now
+
+    def observe(self, stage, seconds, now):
+
+        state = self._state
+        if now - state[1] >= self.window:
+            self._rotate(now)
+
+        current = int(state[0])
+        n = self._index[stage]
+        self._counts[current * self._stride + n * self._size + bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self._sums[current * len(self.stages) + n] += seconds
+
+    def _rotate(self, now):
+
+        current = 1 - int(self._state[0])
+
+        offset = current * self._stride
+        self._counts[offset:offset + self._stride] = [0] * self._stride
+        offset = current * len(self.stages)
+        self._sums[offset:offset + len(self.stages)] = [0.0] * len(self.stages)
+
+        self._state[0] = current
+        self._state[1] = now
+
+    def buckets(self, stage):
+        """ Counts per bucket for 'stage', over both windows. """
+
+        n = self._index[stage]
+        offset = n * self._size
+        counts = self._counts[offset:offset + self._size]
+        offset += self._stride
+        return [a + b for a, b in zip(counts, self._counts[offset:offset + self._size])]
+
+    def total(self, stage):
+        n = self._index[stage]
+        return self._sums[n] + self._sums[len(self.stages) + n]
+
+
+class NoLatencyHistograms(object):
+    """ Stand-in for 'LatencyHistograms' when instrumentation is switched off. """
+
+    stages = ()
+
+    def start(self):
+        return None
+
+    def lap(self, stage, started):
+        return None
+
+
+def quantile(buckets, q):
+    """ Estimate quantile 'q' from per-bucket counts, by interpolation within the bucket concerned. """
+
+    count = sum(buckets)
+    if not count:
+        return None
+
+    rank = q * count
+    cumulative = 0
+    for n, bucket in enumerate(buckets):
+        if bucket and cumulative + bucket >= rank:
+            if n == len(LATENCY_BUCKETS):
+                return LATENCY_BUCKETS[-1]
+            lower = LATENCY_BUCKETS[n - 1] if n else 0.0
+            return lower + (LATENCY_BUCKETS[n] - lower) * (rank - cumulative) / bucket
+        cumulative += bucket
+
+    return LATENCY_BUCKETS[-1]
+
+
+def latency_summary(histograms):
+    """ {stage: {count, sum, p50, p95, p99}} over all of 'histograms' (e.g. one per worker). """
+
+    summary = {}
+    stages = []
+    for histogram in histograms:
+        stages.extend(stage for stage in histogram.stages if stage not in stages)
+
+    for stage in stages:
+        buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        total = 0.0
+        for histogram in histograms:
+            if stage in histogram.stages:
+                buckets = [a + b for a, b in zip(buckets, histogram.buckets(stage))]
+                total += histogram.total(stage)
+
+        stage_summary = dict(count=sum(buckets), sum=total)
+        for q in QUANTILES:
+            stage_summary['p{}'.format(int(q * 100))] = quantile(buckets, q)
+        summary[stage] = stage_summary
+
+    return summary
+
+
+def latency_families(summary):
+    """ Metric families (see 'render()') for a 'latency_summary()'. """
+
+    samples = []
+    for stage, stage_summary in sorted(summary.items()):
+        for q in QUANTILES:
+            samples.append(({'stage': stage, 'quantile': q}, stage_summary['p{}'.format(int(q * 100))]))
+        samples.append(('_count', {'stage': stage}, stage_summary['count']))
+        samples.append(('_sum', {'stage': stage}, stage_summary['sum']))
+
+    return [('rp_stage_latency_seconds', 'summary', 'Forwarding latency per stage, over the latest window(s).',
+             samples)]
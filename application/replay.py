@@ -0,0 +1,357 @@
+#!/bin/python
+import sys
+import time
+import zlib
+import queue
+import logging
+import argparse
+import threading
+import datetime
+from .confirms import PublisherConfirms
+from .archive import read_archive, to_json
+from .audit import AuditRecord, remove_username_password, REPLAYED, REPLAY_ACK
+from .sharding import HashRing, hostnames
+from .forwarder import (setup_producer, setup_audit_logger, config, outgoing_cfg, CONFIRM_TIMEOUT, LOG_NAME,
+                        SHARD_HEADER, SHARD_REPLICAS)
+from . import forwarder
+
+
+"""
+Replay ("backfill"): republish archived messages (see 'archive.py') to the outgoing exchange.
+
+    python -m application.replay /var/lib/register-publisher/archive --title DN100 --since 2017-06-01T00:00:00
+
+Selected messages are published as they were originally forwarded (body, properties and routing key) over several
+channels in parallel, each with pipelined publisher confirms and all within an overall rate limit. Messages for the
+same title always go over the same channel, so they are republished in archive order. If there are several outgoing
+brokers (see 'sharding.py'), each has channels of its own and gets the titles that hash to it, as when forwarding.
+Each publish and confirm is audited, as for forwarding; publishes that are not confirmed can be exported for another
+attempt ('--failed').
+
+"""
+
+logger = logging.getLogger(LOG_NAME + '.replay')
+
+REPLAY_CHANNELS = config['REPLAY_CHANNELS']
+REPLAY_WINDOW = config['REPLAY_WINDOW']
+REPLAY_RATE = config['REPLAY_RATE']
+REPLAY_PROGRESS_INTERVAL = config['REPLAY_PROGRESS_INTERVAL'] / 1000.0
+
+# Header that holds a message's title number.
+TITLE_HEADER = 'title_number'
+
+
+def parse_time(value):
+    """ Seconds since the epoch, from 'value': likewise, or an ISO 8601 date/time (UTC unless stated). """
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    when = datetime.datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+
+    return when.timestamp()
+
+
+def title_of(record):
+    return record.headers.get(TITLE_HEADER)
+
+
+def select(records, titles=None, since=None, until=None):
+    """ Those of 'records' for any of 'titles' and forwarded from 'since' until (but not including) 'until'.
+
+        Any criterion may be None, for all; records without a timestamp never match a time range.
+
+    """
+
+    for record in records:
+        if titles and title_of(record) not in titles:
+            continue
+        if since is not None or until is not None:
+            if record.timestamp is None:
+                continue
+            if since is not None and record.timestamp < since:
+                continue
+            if until is not None and record.timestamp >= until:
+                continue
+
+        yield record
+
+
+class RateLimiter(object):
+    """ Paces callers of 'wait()' (from any thread) to 'rate' per second in total; 0 for no limit. """
+
+    def __init__(self, rate=0):
+
+        # Run-time checks.
+        assert rate >= 0
+
+        self.rate = rate
+
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + 1.0 / self.rate
+
+        if start > now:
+            time.sleep(start - now)
+
+
+class Progress(object):
+    """ Replay counters, updated from any thread. """
+
+    FIELDS = ('read', 'selected', 'published', 'confirmed', 'rejected')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counts = dict((name, 0) for name in self.FIELDS)
+        self.lock = threading.Lock()
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def as_dict(self):
+        with self.lock:
+            result = dict(self.counts)
+
+        result['elapsed'] = elapsed = time.monotonic() - self.started
+        result['rate'] = result['confirmed'] / elapsed if elapsed > 0 else 0.0
+
+        return result
+
+    def __str__(self):
+        return ("read {read}, selected {selected}, published {published}, confirmed {confirmed}, "
+                "rejected {rejected}; {rate:.0f} msg/s over {elapsed:.1f}s").format(**self.as_dict())
+
+
+class Replayer(object):
+    """ Republish records to 'outgoing' (a configuration) over 'channels' channels (per broker, if sharded), each
+        with up to 'window' publishes awaiting confirmation (for up to 'timeout' seconds), at up to 'rate' per second
+        in total.
+
+        Records that are not confirmed are passed to 'on_failed', if given.
+
+    """
+
+    def __init__(self, outgoing=outgoing_cfg, channels=REPLAY_CHANNELS, window=REPLAY_WINDOW, rate=REPLAY_RATE,
+                 timeout=CONFIRM_TIMEOUT, on_failed=None):
+
+        # Run-time checks.
+        assert channels > 0
+        assert window > 0
+
+        self.outgoing = outgoing
+        self.channels = channels
+        self.window = window
+        self.timeout = timeout
+        self.on_failed = on_failed
+
+        self.limiter = RateLimiter(rate)
+        self.progress = Progress()
+        self.stop = threading.Event()
+
+        self.hostnames = hostnames(outgoing.hostname)
+        self.ring = HashRing(self.hostnames, SHARD_REPLICAS) if len(self.hostnames) > 1 else None
+        self.audit_logger = setup_audit_logger(LOG_NAME + '.replay.audit')
+
+    def run(self, records, report=None, interval=REPLAY_PROGRESS_INTERVAL):
+        """ Replay 'records' (e.g. from 'select()'), calling 'report(progress)' every 'interval' seconds. """
+
+        channels = [(hostname, n) for hostname in self.hostnames for n in range(self.channels)]
+        queues = dict((channel, queue.Queue(maxsize=self.window)) for channel in channels)
+        threads = [threading.Thread(name='replay-{}'.format(n), target=self._channel,
+                                    args=(hostname, n, queues[hostname, n]))
+                   for hostname, n in channels]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        reported = time.monotonic()
+        untitled = 0
+
+        def tick():
+            nonlocal reported
+            if report is not None and time.monotonic() - reported >= interval:
+                reported = time.monotonic()
+                report(self.progress)
+
+        try:
+            for record in records:
+                self.progress.incr('selected')
+
+                # Each title always goes over the same channel, so it stays in order; to its shard, if sharded.
+                title = title_of(record)
+                hostname = self.hostnames[0]
+                if self.ring is not None:
+                    shard_key = record.headers.get(SHARD_HEADER)
+                    hostname = self.ring.node(record.body if shard_key is None else str(shard_key))
+                if title is not None:
+                    n = zlib.crc32(str(title).encode('utf-8')) % self.channels
+                else:
+                    n = untitled % self.channels
+                    untitled += 1
+
+                while not self.stop.is_set():
+                    try:
+                        queues[hostname, n].put(record, timeout=0.1)
+                        break
+                    except queue.Full:
+                        tick()
+                if self.stop.is_set():
+                    break
+                tick()
+        except BaseException:
+            # E.g. interrupted: the channels reject whatever they have left.
+            self.stop.set()
+            raise
+        finally:
+            for channel_queue in queues.values():
+                channel_queue.put(None)
+
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.1)
+                    tick()
+
+        return self.progress
+
+    def _confirmed(self, record, address):
+        self.progress.incr('confirmed')
+        self.audit_logger.audit(AuditRecord(REPLAY_ACK, record.timestamp, record.headers, address))
+
+    def _rejected(self, record):
+        self.progress.incr('rejected')
+        if self.on_failed is not None:
+            self.on_failed(record)
+
+    def _channel(self, hostname, n, records):
+        """ Publish everything from 'records' to 'hostname' until None; if the channel fails, the rest are rejected. """
+
+        address = remove_username_password(hostname)
+        n = '{} ({})'.format(n, address) if self.ring is not None else n
+
+        confirms = None
+        try:
+            producer = setup_producer(cfg=self.outgoing._replace(hostname=hostname), confirm_publish=False)
+            confirms = PublisherConfirms(producer, lambda record: self._confirmed(record, address), self._rejected,
+                                         window=self.window, timeout=self.timeout)
+            confirms.select()
+        except Exception as e:
+            logger.error("Replay channel {} not opened: {}".format(n, e))
+
+        while True:
+            record = records.get()
+            if record is None:
+                break
+
+            if confirms is None or self.stop.is_set():
+                self._rejected(record)
+                continue
+
+            self.limiter.wait()
+            self.audit_logger.audit(AuditRecord(REPLAYED, record.timestamp, record.headers, address))
+
+            try:
+                confirms.publish(record, producer.publish, record.body, routing_key=record.routing_key,
+                                 content_type=record.content_type, content_encoding=record.content_encoding,
+                                 headers=record.headers, compression=record.compression)
+            except Exception as e:
+                logger.error("Replay channel {} failed: {}".format(n, e))
+                self._rejected(record)
+                self._close(confirms)
+                confirms = None
+                continue
+
+            self.progress.incr('published')
+
+        if confirms is not None:
+            if not confirms.flush(timeout=self.timeout):
+                confirms.reject_all()
+            self._close(confirms)
+
+    def _close(self, confirms):
+        try:
+            confirms.producer.connection.close()
+        except Exception as e:
+            logger.error("Replay connection not closed: {}".format(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Register-Publisher: replay archived messages to the outgoing "
+                                                 "exchange.")
+    parser.add_argument('archive', help="Archive (ARCHIVE_DIR) or spool directory, or JSONL export ('-' for stdin).")
+    parser.add_argument('--title', action='append', help="Title number to replay; may be repeated (default: all).")
+    parser.add_argument('--since', type=parse_time, help="Earliest forwarding time (epoch seconds or ISO 8601).")
+    parser.add_argument('--until', type=parse_time, help="Forwarding time to stop at (epoch seconds or ISO 8601).")
+    parser.add_argument('--channels', type=int, default=REPLAY_CHANNELS, help="Parallel channels.")
+    parser.add_argument('--window', type=int, default=REPLAY_WINDOW, help="Unconfirmed publishes per channel.")
+    parser.add_argument('--rate', type=float, default=REPLAY_RATE, help="Messages per second; 0 for no limit.")
+    parser.add_argument('--failed', help="Export messages that were not confirmed to this JSONL file.")
+    parser.add_argument('--dry-run', action='store_true', help="Count the selected messages only.")
+    args = parser.parse_args(argv)
+
+    progress = None
+
+    def counted(records):
+        for record in records:
+            progress.incr('read')
+            yield record
+
+    def report(progress):
+        print(progress, file=sys.stderr)
+
+    try:
+        records = select(counted(read_archive(args.archive)), set(args.title or ()), args.since, args.until)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    if args.dry_run:
+        progress = Progress()
+        for _ in records:
+            progress.incr('selected')
+        report(progress)
+        return 0
+
+    failed = open(args.failed, 'w') if args.failed else None
+    failed_lock = threading.Lock()
+
+    def on_failed(record):
+        if failed is not None:
+            with failed_lock:
+                failed.write(to_json(record) + '\n')
+
+    replayer = Replayer(channels=args.channels, window=args.window, rate=args.rate, on_failed=on_failed)
+    progress = replayer.progress
+
+    logger.info("Replay of '{}' started".format(args.archive))
+    try:
+        replayer.run(records, report=report)
+    except KeyboardInterrupt:
+        logger.error("KeyboardInterrupt received!")
+        replayer.stop.set()
+    finally:
+        if failed is not None:
+            failed.close()
+        if forwarder.audit_sink is not None:
+            forwarder.audit_sink.stop()
+
+    report(progress)
+    logger.info("Replay of '{}' finished: {}".format(args.archive, progress))
+
+    return 1 if progress.counts['rejected'] or replayer.stop.is_set() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
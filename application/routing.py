@@ -0,0 +1,83 @@
+#!/bin/python
+import string
+
+
+"""
+Routing keys for outgoing messages, from their application headers.
+
+By default every message is published with the outgoing queue name as its routing key, so topic subscribers have to bind
+'#' and filter for themselves. With a template such as "register.{type}.{title_number:2}", a message with headers
+{'type': 'title', 'title_number': 'DN100'} is published as "register.title.DN", so that subscribers can bind narrower
+patterns (e.g. "register.title.*") and the broker discards what they don't want.
+
+In a template, '{name}' is the value of header 'name' and '{name:N}' its first N characters. Templates are compiled
+once, leaving a single 'str.format()' per message.
+
+"""
+
+# Longest routing key permitted by AMQP (bytes).
+MAX_LENGTH = 255
+
+
+class RoutingKeyTemplate(object):
+    """ Routing key for a message's headers, as per 'template'; a missing header is given as 'missing'. """
+
+    def __init__(self, template, missing='none'):
+
+        # Run-time checks.
+        assert template
+        assert '.' not in missing
+
+        self.template = template
+        self.missing = missing
+
+        # Compile into a format string with positional fields, plus (header name, prefix length) for each field.
+        literals = []
+        self.fields = []
+        for literal, name, spec, conversion in string.Formatter().parse(template):
+            literals.append(literal.replace('{', '{{').replace('}', '}}'))
+            if name is None:
+                continue
+            if not name or conversion:
+                raise ValueError("Invalid routing key template: {}".format(template))
+            try:
+                length = int(spec) if spec else None
+            except ValueError:
+                raise ValueError("Invalid routing key template: {}".format(template))
+            literals.append('{}')
+            self.fields.append((name, length))
+
+        self.format = ''.join(literals).format
+
+    def __call__(self, headers):
+        headers = headers or {}
+        missing = self.missing
+
+        words = []
+        for name, length in self.fields:
+            value = headers.get(name)
+            if value is None:
+                words.append(missing)
+                continue
+            if isinstance(value, bytes):
+                value = value.decode('utf-8', 'replace')
+            # A '.' would split the value into separate words of the key.
+            value = str(value)[:length].replace('.', '_')
+            words.append(value or missing)
+
+        key = self.format(*words)
+
+        # The limit is in bytes; a multi-byte character that would be cut in two is left out.
+        if len(key) > MAX_LENGTH // 4:
+            key = key.encode('utf-8')[:MAX_LENGTH].decode('utf-8', 'ignore')
+
+        return key
+
+    def __repr__(self):
+        return '<RoutingKeyTemplate: {!r}>'.format(self.template)
+
+
+def routing_key_template(template, missing='none'):
+    """ A 'RoutingKeyTemplate', or None if 'template' is empty (i.e. use the producer's default routing key). """
+
+    return RoutingKeyTemplate(template, missing) if template else None
@@ -0,0 +1,21 @@
+#!/bin/python
+import os
+import importlib
+
+
+"""
+Configuration, without Flask: the forwarder is run on its own, so it reads the 'SETTINGS' class (e.g.
+"config.DevelopmentConfig") directly, as Flask's 'config.from_object()' would.
+
+"""
+
+
+def load(name=None):
+    """ Upper-case attributes of the class (or module) named by 'name', or by 'SETTINGS' by default. """
+
+    name = name or os.getenv('SETTINGS', "config.DevelopmentConfig")
+
+    module_name, _, attr = name.rpartition('.')
+    obj = getattr(importlib.import_module(module_name), attr) if module_name else importlib.import_module(attr)
+
+    return dict((key, getattr(obj, key)) for key in dir(obj) if key.isupper())
@@ -0,0 +1,285 @@
+#!/bin/python
+import time
+import bisect
+import hashlib
+import logging
+from .backoff import Backoff
+from .confirms import PublisherConfirms
+
+
+"""
+Sharding across several outgoing brokers, by consistent hashing.
+
+OUTGOING_QUEUE_HOSTNAME may list several brokers (comma separated). Each message goes to the broker ("shard") that
+its title number hashes to on a ring, on which each shard has 'replicas' points. So all messages for a title go to the
+same shard, in order; and adding a shard only moves the titles that now hash to it (about 1/N of them).
+
+Each shard has a producer, connection and health state of its own. A message for a shard that is down goes to the next
+shard on the ring instead ("failover"), so it is published somewhere, although then out of order with respect to
+messages for the same title already on the shard that is down. A shard that is down is tried again after a backoff.
+
+'ShardRouter' picks the shards for each message; 'ShardedProducer' publishes via their producers.
+
+"""
+
+logger = logging.getLogger('RP.sharding')
+
+
+def hostnames(value):
+    """ Broker hostnames (URLs) from 'value', e.g. OUTGOING_QUEUE_HOSTNAME: one, or several comma separated. """
+
+    return [hostname.strip() for hostname in value.split(',') if hostname.strip()]
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """ Consistent hash ring of 'nodes' (strings), with 'replicas' points per node. """
+
+    def __init__(self, nodes=(), replicas=128):
+
+        # Run-time checks.
+        assert replicas > 0
+
+        self.replicas = replicas
+
+        self.points = []                    # (hash, node), in ring order.
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.points) // self.replicas
+
+    def add(self, node):
+        for n in range(self.replicas):
+            bisect.insort(self.points, (_hash('{}#{}'.format(node, n).encode('utf-8')), node))
+
+    def remove(self, node):
+        self.points = [point for point in self.points if point[1] != node]
+
+    def nodes(self, key):
+        """ Every node, in ring order from where 'key' (bytes or text) hashes to; i.e. its node, then failovers. """
+
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+
+        if not self.points:
+            return []
+
+        start = bisect.bisect(self.points, (_hash(key),))
+        nodes = []
+        for n in range(len(self.points)):
+            node = self.points[(start + n) % len(self.points)][1]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == len(self):
+                    break
+
+        return nodes
+
+    def node(self, key):
+        """ The node for 'key'; None if there are no nodes. """
+
+        nodes = self.nodes(key)
+        return nodes[0] if nodes else None
+
+
+class Shard(object):
+    """ Outgoing broker 'hostname'; 'name' is as for stats (i.e. without credentials). """
+
+    def __init__(self, hostname, name, backoff=None):
+        self.hostname = hostname
+        self.name = name
+        self.backoff = backoff or Backoff()
+
+        self.producer = None
+        self.confirms = None
+        self.healthy = True
+        self.retry_at = 0.0
+
+    def __repr__(self):
+        return '<Shard: {}{}>'.format(self.name, '' if self.healthy else ' (down)')
+
+
+class ShardRouter(object):
+    """ Routes messages to 'shards' by the consistent hash of header 'header' (else the body).
+
+        Per-shard counts of failovers (from the shard, while it was down), errors and health are kept in 'stats'
+        (see 'workers.WorkerStats'), if given.
+
+    """
+
+    def __init__(self, shards, header='title_number', replicas=128, stats=None):
+
+        # Run-time checks.
+        assert shards
+        assert len(set(shard.name for shard in shards)) == len(shards)
+
+        self.shards = dict((shard.name, shard) for shard in shards)
+        self.header = header
+        self.ring = HashRing([shard.name for shard in shards], replicas)
+        self.stats = stats
+
+        if stats is not None:
+            for shard in shards:
+                stats.shard_set(shard.name, 'healthy', 1)
+
+    def key(self, headers, body):
+        value = (headers or {}).get(self.header)
+        return body if value is None else str(value)
+
+    def route(self, headers, body, now=None):
+        """ Shards for a message, in order of preference: its own shard, then those to fail over to.
+
+            Shards that are down are left out until it is time to try them again.
+
+        """
+
+        now = time.monotonic() if now is None else now
+        shards = [self.shards[name] for name in self.ring.nodes(self.key(headers, body))]
+
+        return [shard for shard in shards if shard.healthy or now >= shard.retry_at]
+
+    def primary(self, headers, body):
+        """ The shard that a message belongs on, whether or not it is up. """
+
+        return self.shards[self.ring.node(self.key(headers, body))]
+
+    def failed(self, shard, error, now=None):
+        """ Publication to 'shard' failed; it is down until its backoff has passed. """
+
+        now = time.monotonic() if now is None else now
+        delay = shard.backoff.next()
+        shard.retry_at = now + delay
+
+        if shard.healthy:
+            logger.error("Shard {} down: {}; retry in {:.3f} seconds.".format(shard.name, error, delay))
+        shard.healthy = False
+
+        if self.stats is not None:
+            self.stats.shard_incr(shard.name, 'errors')
+            self.stats.shard_set(shard.name, 'healthy', 0)
+
+    def succeeded(self, shard, primary):
+        """ A message for shard 'primary' was published to 'shard'. """
+
+        if not shard.healthy:
+            logger.info("Shard {} up.".format(shard.name))
+            shard.healthy = True
+            shard.backoff.reset()
+            if self.stats is not None:
+                self.stats.shard_set(shard.name, 'healthy', 1)
+
+        if self.stats is not None:
+            self.stats.shard_incr(shard.name, 'published')
+            if shard is not primary:
+                self.stats.shard_incr(primary.name, 'failovers')
+
+
+class ShardedProducer(object):
+    """ Publishes messages to their shards, as routed by 'router' (a 'ShardRouter'), via a producer for each shard made
+        by 'connect(shard)' (one attempt). If 'on_confirm' and 'on_reject' are given, each shard's publishes are
+        confirmed asynchronously (see 'confirms.PublisherConfirms'), up to 'window' at a time and within 'timeout'
+        seconds.
+
+        Publishes and publish errors (for each shard tried) are counted in 'stats' (see 'workers.WorkerStats'), if
+        given.
+
+    """
+
+    def __init__(self, router, connect, on_confirm=None, on_reject=None, window=100, timeout=30.0, stats=None):
+
+        # Run-time checks.
+        assert (on_confirm is None) == (on_reject is None)
+
+        self.router = router
+        self.connect = connect
+        self.on_confirm = on_confirm
+        self.on_reject = on_reject
+        self.window = window
+        self.timeout = timeout
+        self.stats = stats
+
+        self.shards = list(router.shards.values())
+
+    def start(self):
+        """ Connect to every shard; one that is down to begin with is tried again later, as if it had failed. """
+
+        for shard in self.shards:
+            try:
+                self.open(shard)
+            except Exception as e:
+                self.router.failed(shard, e)
+
+    def open(self, shard):
+        """ (Re)connect to 'shard': a producer, with confirms of its own if asynchronous; one attempt only. """
+
+        if shard.producer is not None:
+            self.close_shard(shard)
+
+        shard.producer = self.connect(shard)
+        if self.on_confirm is not None:
+            if shard.confirms is None:
+                shard.confirms = PublisherConfirms(shard.producer, self.on_confirm, self.on_reject, window=self.window,
+                                                   timeout=self.timeout)
+            # Anything outstanding on the old channel is rejected.
+            shard.confirms.producer = shard.producer
+            shard.confirms.renew()
+
+    def publish(self, message, body, **kwargs):
+        """ Publish 'message' (as 'body', with 'publish()' keyword arguments 'kwargs') to its shard or, if that is down,
+            to the next shard (on the ring) that is up; returns the shard. Raises RuntimeError if none are up.
+
+        """
+
+        primary = self.router.primary(message.headers, body)
+        for shard in self.router.route(message.headers, body):
+            try:
+                if shard.producer is None or not shard.healthy:
+                    self.open(shard)
+                if shard.confirms is None:
+                    shard.producer.publish(body, **kwargs)
+                else:
+                    shard.confirms.publish(message, shard.producer.publish, body, **kwargs)
+            except Exception as e:
+                self._incr('publish_errors')
+                self.router.failed(shard, e)
+                continue
+
+            self.router.succeeded(shard, primary)
+            self._incr('published')
+            return shard
+
+        raise RuntimeError("No outgoing broker available")
+
+    def confirms(self):
+        """ Confirms in use, per shard. """
+
+        return [shard.confirms for shard in self.shards if shard.confirms is not None]
+
+    def wait(self):
+        """ Process whatever confirms have arrived; a shard whose connection fails is down. """
+
+        for shard in self.shards:
+            if shard.confirms is not None and len(shard.confirms):
+                try:
+                    shard.confirms.wait(timeout=0)
+                except Exception as e:
+                    self.router.failed(shard, e)
+
+    def close(self):
+        for shard in self.shards:
+            if shard.producer is not None:
+                self.close_shard(shard)
+
+    def close_shard(self, shard):
+        try:
+            shard.producer.connection.close()
+        except Exception as e:
+            logger.error("Shard {} connection not closed: {}".format(shard.name, e))
+
+    def _incr(self, name):
+        if self.stats is not None:
+            self.stats.incr(name)
@@ -0,0 +1,58 @@
+#!/bin/python
+import os
+import json
+import time
+import threading
+import tempfile
+
+
+"""
+Forwarder stats, shared with the HTTP app via a file.
+
+The forwarder runs as its own process, so it periodically writes a JSON snapshot of its stats; the file is replaced
+atomically (via 'os.replace()'), so a reader never sees a partial snapshot. Readers only re-read the file when it has
+been modified.
+
+"""
+
+
+def write(path, data):
+    """ Replace the snapshot at 'path' with 'data', plus the time of writing ('updated'). """
+
+    data = dict(data, updated=time.time())
+
+    fd, temp_path = tempfile.mkstemp(prefix='.stats-', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+class SnapshotReader(object):
+    """ Latest snapshot at 'path'; an empty dict if there isn't one (e.g. the forwarder hasn't started). """
+
+    def __init__(self, path):
+        self.path = path
+
+        self.version = None
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def read(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return {}
+
+        # Each snapshot is a new file, so its inode changes too.
+        version = (stat.st_ino, stat.st_mtime_ns)
+        with self.lock:
+            if version != self.version:
+                with open(self.path) as f:
+                    self.data = json.load(f)
+                self.version = version
+
+            return self.data
@@ -0,0 +1,234 @@
+#!/bin/python
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .backoff import Backoff
+from .confirms import MIN_WAIT
+from .sharding import hostnames
+from .audit import remove_username_password
+
+
+"""
+Consumption from several System of Record brokers ("sources") by the one forwarder.
+
+INCOMING_QUEUE_HOSTNAME may list several brokers (comma separated), or 'forwarder.run()' may be given a list of
+incoming configurations. Each source has a connection and consumer of its own, all polled by the same worker in turn
+and forwarded via the same producer(s).
+
+A source whose connection fails is left out, and connected again after a backoff of its own, while the others carry on.
+Connections are made in the background, so one source that is slow or down does not hold up the rest. Messages
+delivered by a source that has failed (and not yet acknowledged) are redelivered by its broker.
+
+'Source' is the state of one source; 'SourcePool' consumes from them all.
+
+"""
+
+logger = logging.getLogger('RP.sources')
+
+
+def configurations(incoming):
+    """ Incoming configurations, one per source: 'incoming' if a list, else one per broker in 'incoming.hostname'. """
+
+    if isinstance(incoming, list):
+        return incoming
+
+    return [incoming._replace(hostname=hostname) for hostname in hostnames(incoming.hostname)]
+
+
+def source_name(cfg):
+    """ Name of the source for 'cfg', as for stats (i.e. without credentials). """
+
+    return remove_username_password(cfg.hostname)
+
+
+class Source(object):
+    """ Incoming configuration 'cfg', with the state of its consumer; per-source counts are kept in 'stats' (see
+        'workers.WorkerStats'), if given.
+
+    """
+
+    def __init__(self, cfg, backoff=None, stats=None):
+        self.cfg = cfg
+        self.name = source_name(cfg)
+        self.backoff = backoff or Backoff()
+        self.stats = stats
+
+        self.consumer = None
+        self.pending = None                 # Connection in progress (a future), if any.
+        self.connects = 0
+        self.retry_at = 0.0
+
+    def __repr__(self):
+        return '<Source: {}{}>'.format(self.name, '' if self.consumer is not None else ' (down)')
+
+    def due(self, now=None):
+        """ True if the source is to be connected (again) now. """
+
+        now = time.monotonic() if now is None else now
+        return self.consumer is None and self.pending is None and now >= self.retry_at
+
+    def connected(self, consumer):
+        """ The source is consuming, via 'consumer'. """
+
+        self.consumer = consumer
+        self.connects += 1
+        self.backoff.reset()
+
+        if self.connects > 1:
+            logger.info("Source {} up.".format(self.name))
+
+        if self.stats is not None:
+            self.stats.source_set(self.name, 'healthy', 1)
+            if self.connects > 1:
+                self.stats.source_incr(self.name, 'reconnects')
+
+    def failed(self, error, now=None):
+        """ The source's connection failed (or could not be made); it is tried again once its backoff has passed. """
+
+        now = time.monotonic() if now is None else now
+        delay = self.backoff.next()
+        self.retry_at = now + delay
+        self.consumer = None
+
+        logger.error("Source {} down: {}; retry in {:.3f} seconds.".format(self.name, error, delay))
+
+        if self.stats is not None:
+            self.stats.source_incr(self.name, 'errors')
+            self.stats.source_set(self.name, 'healthy', 0)
+
+
+class SourcePool(object):
+    """ Consumes from 'sources', each via a consumer made (in the background) by 'connect(source, on_message)', and
+        takes in their deliveries together (see 'take()').
+
+        'drain_events(connection, timeout)' waits for a delivery, as for 'forwarder.drain_events()'. 'on_consumer()'
+        starts a new consumer consuming. 'on_failed(source)' is called once a source has failed and its deliveries have
+        been dropped (they are redelivered by its broker). While no source is up, 'wait(seconds)' is called instead of
+        draining, for up to 'poll_interval' seconds at a time.
+
+    """
+
+    def __init__(self, sources, connect, drain_events, on_consumer, on_failed=None, wait=time.sleep,
+                 poll_interval=0.1):
+
+        # Run-time checks.
+        assert sources
+
+        self.sources = sources
+        self.connect = connect
+        self.drain_events = drain_events
+        self.on_consumer = on_consumer
+        self.on_failed = on_failed
+        self.wait = wait
+        self.poll_interval = poll_interval
+
+        self.delivered = []                 # Deliveries that have yet to be taken, from all sources.
+        self.connector = ThreadPoolExecutor(max_workers=len(sources))
+
+    def __len__(self):
+        return len(self.delivered)
+
+    @property
+    def consumers(self):
+        """ Consumers of the sources that are up. """
+
+        return [source.consumer for source in self.sources if source.consumer is not None]
+
+    def start(self):
+        for source in self.sources:
+            self._connect(source)
+
+    def receive(self, source, message):
+        """ Handler for a source's consumer: keep 'message', to be taken with others. """
+
+        message.source = source.name
+        if source.stats is not None:
+            source.stats.source_incr(source.name, 'consumed')
+        self.delivered.append(message)
+
+    def drain(self, timeout):
+        """ Wait up to 'timeout' seconds for deliveries from any source, a share of that for each in turn; True if
+            there were any. Sources are (re)connected as they become due, without waiting for them.
+
+        """
+
+        now = time.monotonic()
+        for source in self.sources:
+            if source.pending is not None and source.pending.done():
+                self._connected(source)
+            elif source.due(now):
+                self._connect(source)
+
+        up = [source for source in self.sources if source.consumer is not None]
+        if not up:
+            self.wait(min(timeout, self.poll_interval))
+            return False
+
+        # Once there has been a delivery, the others are not waited for.
+        received = False
+        for source in up:
+            try:
+                received = self.drain_events(source.consumer.connection,
+                                             timeout=MIN_WAIT if received else timeout / len(up)) or received
+            # Only deliveries are taken in here, so any error is the source's own.
+            except Exception as e:
+                self._failed(source, e)
+
+        return received
+
+    def take(self, limit):
+        """ Take in whatever else has been delivered already, up to 'limit' in all; returns the deliveries. """
+
+        while len(self.delivered) < limit and self.drain(MIN_WAIT):
+            pass
+
+        messages, self.delivered = self.delivered, []
+        return messages
+
+    def close(self):
+        self.connector.shutdown(wait=True)
+        for source in self.sources:
+            if source.pending is not None and source.pending.exception() is None:
+                source.pending.result().connection.close()
+            elif source.consumer is not None:
+                try:
+                    source.consumer.connection.close()
+                except Exception as e:
+                    logger.error("Source {} not closed: {}".format(source.name, e))
+
+    def _connect(self, source):
+        """ Start connecting to 'source', in the background. """
+
+        source.pending = self.connector.submit(self.connect, source,
+                                               lambda message, source=source: self.receive(source, message))
+
+    def _connected(self, source):
+        """ Consume from 'source', now that its connection has been made (or has failed, in which case it is tried
+            again later).
+
+        """
+
+        future, source.pending = source.pending, None
+        consumer = None
+        try:
+            consumer = future.result()
+            self.on_consumer(consumer)
+        except Exception as e:
+            if consumer is not None:
+                consumer.connection.collect()
+            source.failed(e)
+            return
+
+        source.connected(consumer)
+
+    def _failed(self, source, error):
+        """ Leave out 'source', whose connection has failed, until it is time to connect to it again. """
+
+        consumer = source.consumer
+        source.failed(error)
+        consumer.connection.collect()
+
+        # Its messages that have yet to be forwarded (or acknowledged) are redelivered by its broker.
+        self.delivered = [message for message in self.delivered if message.source != source.name]
+        if self.on_failed is not None:
+            self.on_failed(source)
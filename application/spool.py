@@ -0,0 +1,427 @@
+#!/bin/python
+import os
+import mmap
+import json
+import time
+import zlib
+import fcntl
+import struct
+import logging
+from .backoff import Backoff
+from .confirms import PublisherConfirms
+
+
+"""
+Local write-ahead spool, for when the outgoing broker is unavailable.
+
+Rather than leaving the System of Record's queue to back up, incoming messages are appended to the spool and
+acknowledged once it has been fsync'ed. When the outgoing broker is back, the spool is drained - in order, a step of up
+to a window of messages at a time, so that the forwarder attends to its consumer in between - and each segment is
+deleted once all of its messages have been published (and confirmed). Should the forwarder die part way through a
+segment, the whole segment is published again: delivery is "at least once", as it is otherwise.
+
+The spool is a directory of append-only segment files, each of up to about 'segment_size' bytes, which are read back via
+'mmap'. Each record is a header (CRC-32, metadata length, body length), JSON metadata and the raw body. A partly written
+record at the end of a segment (the process died while writing it) is ignored.
+
+Hard limits: once the spool holds 'max_bytes', or its oldest message is 'max_age' seconds old, nothing more is spooled
+('SpoolFull'); further messages are left in the incoming queue instead.
+
+The directory is locked ('flock') while the spool is open, so that it is never drained twice over (see 'in_use()').
+
+'Spool' is the storage; 'Spooler' decides when to spool and when to drain.
+
+"""
+
+logger = logging.getLogger('RP.spool')
+
+HEADER = struct.Struct('>III')
+SUFFIX = '.seg'
+
+
+class SpoolFull(Exception):
+    pass
+
+
+def lock(directory):
+    """ Lock 'directory' (exclusively); returns the locked file descriptor, or raises 'BlockingIOError' if it is
+        locked already.
+
+    """
+
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BaseException:
+        os.close(fd)
+        raise
+
+    return fd
+
+
+def undrained(directory, workers):
+    """ Subdirectories of spool 'directory' (as for 'forwarder.setup_spool()') with segments that no worker drains,
+        being for worker ids of 'workers' or more.
+
+    """
+
+    if not os.path.isdir(directory):
+        return []
+
+    paths = []
+    for name in sorted(os.listdir(directory), key=lambda name: (len(name), name)):
+        path = os.path.join(directory, name)
+        if name.isdigit() and int(name) >= workers and os.path.isdir(path):
+            if any(segment.endswith(SUFFIX) for segment in os.listdir(path)):
+                paths.append(path)
+
+    return paths
+
+
+def in_use(directory):
+    """ True if there is a spool open in 'directory' (e.g. by a worker). """
+
+    try:
+        os.close(lock(directory))
+    except BlockingIOError:
+        return True
+
+    return False
+
+
+class Spool(object):
+    """ Spool in 'directory' (created if necessary); see above. """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024, max_age=86400.0):
+
+        # Run-time checks.
+        assert segment_size > 0
+        assert max_bytes >= segment_size
+        assert max_age > 0
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        # Sequence number -> [bytes, messages, time of first message].
+        self.segments = {}
+        self.writer = None
+        self.writer_seq = None
+        self.last_seq = 0
+        self.lock = None                    # The directory's file descriptor, while locked.
+
+        os.makedirs(directory, exist_ok=True)
+        try:
+            self.lock = lock(directory)
+        except BlockingIOError:
+            raise RuntimeError("Spool {} is in use".format(directory))
+
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SUFFIX):
+                seq = int(name[:-len(SUFFIX)])
+                records = self._read(seq)
+                first = records[0][0].get('t', 0.0) if records else time.time()
+                self.segments[seq] = [os.path.getsize(self._path(seq)), len(records), first]
+                self.last_seq = max(self.last_seq, seq)
+
+        if self.segments:
+            logger.info("Spool: {} message(s) in {}".format(len(self), directory))
+
+    def __len__(self):
+        return sum(segment[1] for segment in self.segments.values())
+
+    @property
+    def bytes(self):
+        return sum(segment[0] for segment in self.segments.values())
+
+    def oldest(self):
+        """ Time at which the oldest message was spooled; None if the spool is empty. """
+
+        return self.segments[min(self.segments)][2] if self.segments else None
+
+    def append(self, body, meta):
+        """ Append a message: 'body' (bytes) plus JSON-able 'meta' (properties etc.); not durable until 'sync()'. """
+
+        now = time.time()
+        meta = json.dumps(dict(meta, t=now), default=str).encode('utf-8')
+        size = HEADER.size + len(meta) + len(body)
+
+        oldest = self.oldest()
+        if self.bytes + size > self.max_bytes:
+            raise SpoolFull("Spool full: {} bytes".format(self.bytes))
+        if oldest is not None and now - oldest > self.max_age:
+            raise SpoolFull("Spool full: oldest message is {:.0f} seconds old".format(now - oldest))
+
+        if self.writer is None or self.segments[self.writer_seq][0] + size > self.segment_size:
+            self._roll(now)
+
+        self.writer.write(HEADER.pack(zlib.crc32(body, zlib.crc32(meta)), len(meta), len(body)))
+        self.writer.write(meta)
+        self.writer.write(body)
+
+        segment = self.segments[self.writer_seq]
+        segment[0] += size
+        segment[1] += 1
+
+    def sync(self):
+        """ Make everything appended so far durable. """
+
+        if self.writer is not None:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+
+    def head(self):
+        """ The oldest segment, as (sequence number, [(meta, body), ...]); None if the spool is empty.
+
+            If that is the segment being written to, it is closed (and a new one started by the next 'append()').
+
+        """
+
+        if not self.segments:
+            return None
+
+        seq = min(self.segments)
+        if seq == self.writer_seq:
+            self.sync()
+            self.writer.close()
+            self.writer = self.writer_seq = None
+
+        return seq, self._read(seq)
+
+    def remove(self, seq):
+        """ Delete segment 'seq', as it has been drained. """
+
+        os.unlink(self._path(seq))
+        del self.segments[seq]
+
+    def close(self):
+        if self.writer is not None:
+            self.sync()
+            self.writer.close()
+            self.writer = self.writer_seq = None
+
+        if self.lock is not None:
+            os.close(self.lock)
+            self.lock = None
+
+    def stats(self):
+        oldest = self.oldest()
+        return dict(messages=len(self), bytes=self.bytes, segments=len(self.segments),
+                    oldest_age=time.time() - oldest if oldest is not None else 0.0)
+
+    def _path(self, seq):
+        return os.path.join(self.directory, '{:020d}{}'.format(seq, SUFFIX))
+
+    def _roll(self, now):
+
+        if self.writer is not None:
+            self.sync()
+            self.writer.close()
+
+        # Numbered in order, never reusing the number of a segment that has been drained meanwhile.
+        seq = self.last_seq = self.last_seq + 1
+        self.writer = open(self._path(seq), 'ab')
+        self.writer_seq = seq
+        self.segments[seq] = [0, 0, now]
+
+        # Make the new file itself durable.
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _read(self, seq):
+        """ Records of segment 'seq', as [(meta, body), ...]. """
+
+        return read_segment(self._path(seq))
+
+
+class Spooler(object):
+    """ Spools messages to 'spool' while the outgoing broker is down, and drains it once the broker is back.
+
+        Segments are drained via a producer made by 'connect()', on a connection of its own, in steps of up to 'window'
+        publishes, each step waiting (for up to 'timeout' seconds) for its confirms; 'on_unspooled(meta, body)' is
+        called for each message once its publication has been confirmed. A segment that is not drained is tried again
+        (from the start) after 'backoff'.
+        Counts and the spool's depth are recorded in 'stats' (see 'workers.WorkerStats'), if given.
+
+    """
+
+    def __init__(self, spool, connect, on_unspooled, window=1000, timeout=30.0, backoff=None, stats=None):
+
+        # Run-time checks.
+        assert window > 0
+
+        self.spool = spool
+        self.connect = connect
+        self.on_unspooled = on_unspooled
+        self.window = window
+        self.timeout = timeout
+        self.backoff = backoff or Backoff()
+        self.stats = stats
+
+        self.down = False                   # The outgoing broker is unavailable, as far as is known.
+        self.drainer = None                 # 'PublisherConfirms' for draining, while the connection is open.
+        self.segment = None                 # The segment being drained, as from 'Spool.head()'...
+        self.position = 0                   # ... and how many of its messages have been confirmed so far.
+        self.rejected = 0                   # Publishes from the current step that were not confirmed.
+        self.drain_at = 0.0
+
+        # Anything left in the spool (e.g. by a previous run) is drained first.
+        self.update_stats()
+
+    def __len__(self):
+        return len(self.spool)
+
+    @property
+    def active(self):
+        """ True if messages are to be spooled rather than published: the outgoing broker is down, or there are
+            messages in the spool still, which have to be published first (so that messages stay in order).
+
+        """
+
+        return self.down or bool(self.spool.segments)
+
+    def failed(self, error):
+        """ Publication failed, so the outgoing broker is down until the spool has been drained. """
+
+        logger.error("Outgoing broker unavailable; spooling: {}".format(error))
+        self.down = True
+
+    def append(self, body, meta):
+        """ Spool a message (as for 'Spool.append()'), durably; raises 'SpoolFull' if the spool is full. """
+
+        try:
+            self.spool.append(body, meta)
+            self.spool.sync()
+        except SpoolFull:
+            self._incr('spool_refused')
+            raise
+
+        self._incr('spooled')
+        self.update_stats()
+
+    def maybe_drain(self, now=None):
+        """ Take a step in draining the spool, if there is anything in it and it is time to (try to) do so. """
+
+        now = time.monotonic() if now is None else now
+        if not self.spool.segments or now < self.drain_at:
+            return
+
+        try:
+            self.drain()
+        except Exception as e:
+            delay = self.backoff.next()
+            logger.error("Spool not drained: {}; retry in {:.3f} seconds.".format(e, delay))
+            self.segment = None
+            self.close_drainer()
+            self.drain_at = time.monotonic() + delay
+            return
+
+        self.backoff.reset()
+        if not self.spool.segments:
+            logger.info("Spool drained; outgoing broker available.")
+            self.down = False
+            self.close_drainer()
+
+    def drain(self):
+        """ Publish up to 'window' more messages of the spool's oldest segment and wait for their confirms, deleting
+            the segment once all of its messages have been confirmed.
+
+            Publishes are pipelined. This raises if the outgoing broker is (still) unavailable, in which case the whole
+            segment is published again next time (see 'maybe_drain()').
+
+        """
+
+        if self.drainer is None:
+            self.drainer = PublisherConfirms(self.connect(), self._unspooled, self._rejected, window=self.window,
+                                             timeout=self.timeout)
+            self.drainer.select()
+
+        if self.segment is None:
+            self.segment = self.spool.head()
+            self.position = 0
+
+        seq, records = self.segment
+        step = records[self.position:self.position + self.window]
+        self.rejected = 0
+
+        for record in step:
+            meta, body = record
+            self.drainer.publish(record, self.drainer.producer.publish, body, routing_key=meta['routing_key'],
+                                 content_type=meta['content_type'], content_encoding=meta['content_encoding'],
+                                 headers=meta['headers'], compression=meta['compression'])
+
+        if not self.drainer.flush(timeout=self.timeout) or self.rejected:
+            raise RuntimeError("Spool segment {}: {} publish(es) not confirmed".format(
+                seq, self.rejected + len(self.drainer)))
+
+        self.position += len(step)
+        if self.position < len(records):
+            return
+
+        self.segment = None
+        self.spool.remove(seq)
+        self.update_stats()
+        logger.info("Spool segment {} drained: {} message(s)".format(seq, len(records)))
+
+    def close_drainer(self):
+        if self.drainer is not None:
+            try:
+                self.drainer.producer.connection.close()
+            except Exception as e:
+                logger.error("Spool connection not closed: {}".format(e))
+            self.drainer = None
+
+    def close(self):
+        self.close_drainer()
+        self.spool.close()
+
+    def update_stats(self):
+        if self.stats is not None:
+            self.stats.set('spool_messages', len(self.spool))
+            self.stats.set('spool_bytes', self.spool.bytes)
+            self.stats.set('spool_oldest', self.spool.oldest() or 0.0)
+
+    def _unspooled(self, record):
+        meta, body = record
+        self.on_unspooled(meta, body)
+
+    def _rejected(self, record):
+        self.rejected += 1
+
+    def _incr(self, name):
+        if self.stats is not None:
+            self.stats.incr(name)
+
+
+def read_segment(path):
+    """ Records of the segment file at 'path', as [(meta, body), ...]; a partial or corrupt record ends the segment. """
+
+    records = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return records
+
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset + HEADER.size <= size:
+                crc, meta_length, body_length = HEADER.unpack_from(data, offset)
+                start = offset + HEADER.size
+                end = start + meta_length + body_length
+                if end > size:
+                    logger.error("{}: partial record at {}, ignored".format(path, offset))
+                    break
+
+                meta, body = data[start:start + meta_length], data[start + meta_length:end]
+                if zlib.crc32(body, zlib.crc32(meta)) != crc:
+                    logger.error("{}: bad record at {}, ignored".format(path, offset))
+                    break
+
+                records.append((json.loads(meta.decode('utf-8')), body))
+                offset = end
+
+    return records
@@ -0,0 +1,218 @@
+#!/bin/python
+import time
+import logging
+import threading
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from .metrics import LatencyHistograms, NoLatencyHistograms
+
+
+"""
+Pool of forwarding workers, each of which has its own connections, consumer and producer.
+
+Workers run as threads or as processes; per-worker counters are kept in shared memory either way, so that they can be
+read (e.g. by the Flask app) without any locking. Each counter has a single writer - its worker.
+
+"""
+
+logger = logging.getLogger('RP.workers')
+
+
+class WorkerStats(object):
+    """ Counters for a single worker, plus latency histograms for 'stages' and counters per lane, per shard and per
+        source, if any.
+
+    """
+
+    FIELDS = ('consumed', 'published', 'acked', 'requeued', 'retries', 'publish_errors', 'errors', 'reconnects',
+              'restarts', 'last_forward', 'compressed', 'compress_bytes_in', 'compress_bytes_out', 'compress_seconds',
+              'dedup_checks', 'duplicates', 'spooled', 'unspooled', 'spool_refused', 'spool_messages', 'spool_bytes',
+              'spool_oldest', 'batches', 'batched', 'bp_state', 'bp_depth', 'bp_factor', 'bp_rate', 'bp_pauses',
+              'bp_wait_seconds', 'signed', 'sign_seconds', 'audit_depth', 'audit_written', 'audit_dropped',
+              'audit_batches', 'audit_flush_latency', 'audit_max_flush_latency', 'dedup_entries', 'dedup_bytes')
+
+    # Fields that are not counts.
+    FLOATS = frozenset(['last_forward', 'compress_seconds', 'spool_oldest', 'bp_factor', 'bp_rate', 'bp_wait_seconds',
+                        'sign_seconds', 'audit_flush_latency', 'audit_max_flush_latency'])
+
+    _index = dict((name, n) for n, name in enumerate(FIELDS))
+
+    # Per lane (incoming queue; see 'lanes.py'). 'buffered' is not a count.
+    LANE_FIELDS = ('forwarded', 'bytes', 'wait_seconds', 'buffered')
+
+    _lane_index = dict((name, n) for n, name in enumerate(LANE_FIELDS))
+
+    # Per shard (outgoing broker; see 'sharding.py'). 'healthy' is not a count.
+    SHARD_FIELDS = ('published', 'failovers', 'errors', 'healthy')
+
+    _shard_index = dict((name, n) for n, name in enumerate(SHARD_FIELDS))
+
+    # Per source (incoming broker; see 'sources.py'). 'healthy' is not a count.
+    SOURCE_FIELDS = ('consumed', 'reconnects', 'errors', 'healthy')
+
+    _source_index = dict((name, n) for n, name in enumerate(SOURCE_FIELDS))
+
+    def __init__(self, stages=None, window=60.0, lanes=(), shards=(), sources=()):
+        self._values = RawArray('d', len(self.FIELDS))
+        self.latency = LatencyHistograms(stages, window) if stages else NoLatencyHistograms()
+
+        self.lanes = tuple(lanes)
+        self._lanes = dict((lane, n * len(self.LANE_FIELDS)) for n, lane in enumerate(self.lanes))
+        self._lane_values = RawArray('d', len(self.LANE_FIELDS) * len(self.lanes))
+
+        self.shards = tuple(shards)
+        self._shards = dict((shard, n * len(self.SHARD_FIELDS)) for n, shard in enumerate(self.shards))
+        self._shard_values = RawArray('d', len(self.SHARD_FIELDS) * len(self.shards))
+
+        self.sources = tuple(sources)
+        self._sources = dict((source, n * len(self.SOURCE_FIELDS)) for n, source in enumerate(self.sources))
+        self._source_values = RawArray('d', len(self.SOURCE_FIELDS) * len(self.sources))
+
+    def incr(self, name, n=1):
+        self._values[self._index[name]] += n
+
+    def set(self, name, value):
+        self._values[self._index[name]] = value
+
+    def get(self, name):
+        return self._values[self._index[name]]
+
+    def lane_incr(self, lane, name, n=1):
+        self._lane_values[self._lanes[lane] + self._lane_index[name]] += n
+
+    def lane_set(self, lane, name, value):
+        self._lane_values[self._lanes[lane] + self._lane_index[name]] = value
+
+    def shard_incr(self, shard, name, n=1):
+        self._shard_values[self._shards[shard] + self._shard_index[name]] += n
+
+    def shard_set(self, shard, name, value):
+        self._shard_values[self._shards[shard] + self._shard_index[name]] = value
+
+    def source_incr(self, source, name, n=1):
+        self._source_values[self._sources[source] + self._source_index[name]] += n
+
+    def source_set(self, source, name, value):
+        self._source_values[self._sources[source] + self._source_index[name]] = value
+
+    def as_dict(self):
+        values = self._values[:]
+        result = dict((name, values[n] if name in self.FLOATS else int(values[n]))
+                      for n, name in enumerate(self.FIELDS))
+
+        if self.lanes:
+            values = self._lane_values[:]
+            result['lanes'] = lanes = {}
+            for lane, offset in self._lanes.items():
+                lanes[lane] = dict((name, values[offset + n] if name == 'wait_seconds' else int(values[offset + n]))
+                                   for n, name in enumerate(self.LANE_FIELDS))
+
+        if self.shards:
+            values = self._shard_values[:]
+            result['shards'] = shards = {}
+            for shard, offset in self._shards.items():
+                shards[shard] = dict((name, int(values[offset + n])) for n, name in enumerate(self.SHARD_FIELDS))
+
+        if self.sources:
+            values = self._source_values[:]
+            result['sources'] = sources = {}
+            for source, offset in self._sources.items():
+                sources[source] = dict((name, int(values[offset + n])) for n, name in enumerate(self.SOURCE_FIELDS))
+
+        return result
+
+
+class WorkerPool(object):
+    """ Run 'size' instances of 'target(worker_id, stats, stop)' as threads or processes, restarting any that die.
+
+        'target' should return promptly once the 'stop' event is set. 'stages', 'window', 'lanes', 'shards' and
+        'sources' are for 'WorkerStats'.
+
+        Worker processes are not daemonic, so that they may have children of their own (e.g. for signing; see
+        'signing.Signer'); 'stop()' joins them instead, terminating any that do not stop in time.
+
+    """
+
+    def __init__(self, target, size=1, mode='thread', stages=None, window=60.0, lanes=(), shards=(), sources=()):
+
+        # Run-time checks.
+        assert size > 0
+        assert mode in ('thread', 'process')
+
+        self.target = target
+        self.size = size
+        self.mode = mode
+
+        if mode == 'process':
+            self.stop_event = multiprocessing.Event()
+        else:
+            self.stop_event = threading.Event()
+
+        self.stats = [WorkerStats(stages, window, lanes, shards, sources) for _ in range(size)]
+        self.workers = [None] * size
+
+    def start(self):
+        """ Start all workers. """
+
+        for worker_id in range(self.size):
+            self._start(worker_id)
+
+    def _start(self, worker_id):
+
+        name = 'register_publisher-{}'.format(worker_id)
+        args = (worker_id, self.stats[worker_id], self.stop_event)
+
+        if self.mode == 'process':
+            worker = multiprocessing.Process(name=name, target=self.target, args=args)
+        else:
+            worker = threading.Thread(name=name, target=self.target, args=args)
+            worker.daemon = True
+        worker.start()
+
+        self.workers[worker_id] = worker
+        logger.info("Started worker: {}".format(name))
+
+    def supervise(self, interval=5, callback=None):
+        """ Restart dead workers every 'interval' seconds, until 'stop()' is called.
+
+            'callback' (if any) is called after each check, e.g. to publish the stats.
+
+        """
+
+        while not self.stop_event.wait(interval):
+            for worker_id, worker in enumerate(self.workers):
+                if not worker.is_alive() and not self.stop_event.is_set():
+                    logger.error("Worker {} died; restarting.".format(worker_id))
+                    self.stats[worker_id].incr('restarts')
+                    self._start(worker_id)
+
+            if callback is not None:
+                callback()
+
+    def stop(self, timeout=30):
+        """ Ask all workers to stop, then wait up to 'timeout' seconds (in total) for them to do so. """
+
+        self.stop_event.set()
+
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker is not None:
+                worker.join(max(deadline - time.monotonic(), 0))
+
+        for worker_id, worker in enumerate(self.workers):
+            if worker is not None and worker.is_alive():
+                logger.error("Worker {} did not stop.".format(worker_id))
+                if self.mode == 'process':
+                    worker.terminate()
+
+    def status(self):
+        """ Per-worker counters, with liveness. """
+
+        status = []
+        for worker_id, worker in enumerate(self.workers):
+            worker_status = self.stats[worker_id].as_dict()
+            worker_status['worker'] = worker_id
+            worker_status['alive'] = worker is not None and worker.is_alive()
+            status.append(worker_status)
+
+        return status
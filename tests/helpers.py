@@ -0,0 +1,113 @@
+#!/bin/python
+import time
+import uuid
+import threading
+import contextlib
+from collections import defaultdict
+import mock
+import kombu
+import kombu.transport.virtual
+from application import forwarder
+from application.workers import WorkerStats
+
+"""
+Helpers for the tests (and benchmarks) that run the forwarder between queues on kombu's in-memory transport.
+
+"""
+
+
+def make_configs():
+    """ Incoming and outgoing configurations on the in-memory transport, with queues unique to the run. """
+
+    name = 'rp_test_{}'.format(uuid.uuid4().hex[:8])
+    incoming = forwarder.incoming_cfg._replace(hostname='memory://', queue=name + '_in', binding_key=name + '_in',
+                                               exchange=kombu.Exchange(name + '_in', type='direct'))
+    outgoing = forwarder.outgoing_cfg._replace(hostname='memory://', queue=name + '_out', binding_key='#',
+                                               exchange=kombu.Exchange(name + '_out', type='topic'))
+
+    return incoming, outgoing
+
+
+def queue_count(channel, cfg):
+    name, jobs, consumers = channel.queue_declare(queue=cfg.queue, passive=True)
+    return jobs
+
+
+def get_all(cfg):
+    """ Take every message from the queue of 'cfg', as [message, ...]. """
+
+    messages = []
+    with forwarder.setup_producer(cfg=cfg) as producer:
+        queue = forwarder.setup_queue(producer.channel, cfg=cfg)
+        message = queue.get(no_ack=True)
+        while message is not None:
+            messages.append(message)
+            message = queue.get(no_ack=True)
+
+    return messages
+
+
+def load(cfg, count):
+    """ Publish 'count' messages to the queue of 'cfg': {'n': n}, with title number 'DN<n>'. """
+
+    with forwarder.setup_producer(cfg=cfg) as producer:
+        for n in range(count):
+            producer.publish({'n': n}, headers={'title_number': 'DN{}'.format(n)}, routing_key=cfg.binding_key)
+
+
+def run_worker(incoming, outgoing, until, stats=None, timeout=10):
+    """ Run a worker ('forwarder.run()', in a thread) until 'until(stats)' is true or 'timeout' seconds have passed;
+        returns its stats.
+
+    """
+
+    stats = WorkerStats() if stats is None else stats
+    stop = threading.Event()
+    worker = threading.Thread(target=forwarder.run, args=(0, stats, stop, incoming, outgoing))
+    worker.start()
+
+    deadline = time.monotonic() + timeout
+    while not until(stats) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    stop.set()
+    worker.join(timeout)
+
+    return stats
+
+
+@contextlib.contextmanager
+def memory_confirms():
+    """ Publisher confirms on the in-memory transport, which has none: once a channel is in confirm mode, everything
+        published on it is confirmed (with 'multiple') by its connection's next 'drain_events()', as by a broker.
+
+    """
+
+    channel_cls, transport_cls = kombu.transport.virtual.Channel, kombu.transport.virtual.Transport
+    basic_publish, drain_events = channel_cls.basic_publish, transport_cls.drain_events
+
+    def confirm_select(channel, nowait=False):
+        channel.confirm_seq = 0
+        channel.confirm_pending = False
+
+    def publish(channel, *args, **kwargs):
+        result = basic_publish(channel, *args, **kwargs)
+        if hasattr(channel, 'confirm_seq'):
+            channel.confirm_seq += 1
+            channel.confirm_pending = True
+        return result
+
+    def drain(transport, connection, timeout=None):
+        for channel in transport.channels:
+            if getattr(channel, 'confirm_pending', False):
+                channel.confirm_pending = False
+                for handler in list(channel.events['basic_ack']):
+                    handler(channel.confirm_seq, True)
+                return
+        return drain_events(transport, connection, timeout=timeout)
+
+    events = property(lambda channel: channel.__dict__.setdefault('confirm_events', defaultdict(set)))
+    with mock.patch.object(channel_cls, 'events', events, create=True), \
+            mock.patch.object(channel_cls, 'confirm_select', confirm_select, create=True), \
+            mock.patch.object(channel_cls, 'basic_publish', publish), \
+            mock.patch.object(transport_cls, 'drain_events', drain):
+        yield
@@ -0,0 +1,96 @@
+import json
+import unittest
+import mock
+import kombu
+from application import forwarder
+from application.acks import BatchAcker
+from tests.helpers import make_configs, queue_count, load, run_worker
+
+
+def make_message(channel, delivery_tag):
+    message = mock.Mock()
+    message.channel = channel
+    message.delivery_tag = delivery_tag
+    return message
+
+
+class TestBatchAcker(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = mock.Mock()
+        self.acked = []
+        self.acker = BatchAcker(size=3, interval=0.1, on_ack=self.acked.append)
+        self.messages = [make_message(self.channel, n) for n in range(1, 6)]
+        for message in self.messages:
+            self.acker.received(message)
+
+    def test_batch(self):
+        for message in self.messages[:3]:
+            self.acker.ack(message)
+
+        self.channel.basic_ack.assert_called_once_with(3, multiple=True)
+        self.assertEqual(self.acked, self.messages[:3])
+
+    def test_out_of_order(self):
+        # Message 1 is still outstanding, so nothing may be acknowledged yet.
+        for message in self.messages[1:4]:
+            self.acker.ack(message)
+        self.assertFalse(self.channel.basic_ack.called)
+
+        self.acker.ack(self.messages[0])
+        self.channel.basic_ack.assert_called_once_with(4, multiple=True)
+
+    def test_requeue(self):
+        self.acker.ack(self.messages[0])
+        self.acker.requeue(self.messages[1])
+        self.acker.ack(self.messages[2])
+        self.acker.flush()
+
+        self.messages[1].requeue.assert_called_once_with()
+        self.channel.basic_ack.assert_called_once_with(3, multiple=True)
+        self.assertEqual(self.acked, [self.messages[0], self.messages[2]])
+
+    def test_interval(self):
+        self.acker.ack(self.messages[0])
+
+        with mock.patch('application.acks.time.monotonic', return_value=self.acker.ready_since + 1):
+            self.acker.tick()
+
+        self.channel.basic_ack.assert_called_once_with(1, multiple=True)
+
+    def test_new_channel(self):
+        self.acker.ack(self.messages[0])
+        channel = mock.Mock()
+        self.acker.received(make_message(channel, 1))
+
+        # Anything ready on the old channel is acknowledged before switching.
+        self.channel.basic_ack.assert_called_once_with(1, multiple=True)
+        self.acker.ack(self.messages[1])
+        self.assertEqual(self.acked, [self.messages[0]])
+
+
+class TestRun(unittest.TestCase):
+
+    def test_publish_failed(self):
+        """ A message whose publish fails is requeued, rather than holding up the acknowledgement of the rest. """
+
+        incoming, outgoing = make_configs()
+        load(incoming, 10)
+
+        failures = []
+        publish = kombu.Producer.publish
+
+        def fail_once(producer, body, **kwargs):
+            if producer.exchange.name == outgoing.exchange.name and json.loads(body)['n'] == 3 and not failures:
+                failures.append(body)
+                raise RuntimeError('rejected')
+            return publish(producer, body, **kwargs)
+
+        with mock.patch('application.forwarder.ACK_BATCH_SIZE', 5), \
+                mock.patch.object(kombu.Producer, 'publish', fail_once):
+            stats = run_worker(incoming, outgoing, lambda stats: stats.get('acked') >= 10)
+
+        self.assertEqual(len(failures), 1)
+        self.assertEqual((stats.get('acked'), stats.get('requeued'), stats.get('published')), (10, 1, 10))
+        with forwarder.setup_producer(cfg=outgoing) as producer:
+            self.assertEqual(queue_count(producer.channel, outgoing), 10)
@@ -0,0 +1,281 @@
+import json
+import zlib
+import types
+import asyncio
+import unittest
+import mock
+from application import aio
+from application.forwarder import incoming_cfg, outgoing_cfg
+from application.workers import WorkerStats
+from application.routing import RoutingKeyTemplate
+from application.dedup import DedupCache
+
+
+class FakeBroker(object):
+    """ Stand-in for the broker, via a stand-in for the 'aio_pika' module. """
+
+    def __init__(self, publish_delay=0.0):
+        self.publish_delay = publish_delay
+        self.fail = False
+        self.published = []
+        self.queues = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        self.module = types.SimpleNamespace(connect_robust=self.connect_robust, Message=FakeOutgoingMessage,
+                                            DeliveryMode=types.SimpleNamespace(PERSISTENT=2))
+
+    async def connect_robust(self, hostname, timeout=None):
+        return FakeConnection(self)
+
+    def deliver(self, body, headers=None, content_type='application/json', tag=1):
+        message = FakeIncomingMessage(body, headers or {}, content_type, tag)
+        queue = self.queues[incoming_cfg.queue]
+        return asyncio.ensure_future(queue.callback(message)), message
+
+
+class FakeConnection(object):
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.reconnect_callbacks = set()
+        self.closed = False
+
+    async def channel(self, publisher_confirms=False):
+        return FakeChannel(self.broker)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeChannel(object):
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.default_exchange = FakeExchange(broker, '')
+
+    async def set_qos(self, prefetch_count=0):
+        self.prefetch_count = prefetch_count
+
+    async def declare_exchange(self, name, type, durable=True):
+        return FakeExchange(self.broker, name)
+
+    async def declare_queue(self, name, durable=True):
+        return self.broker.queues.setdefault(name, FakeQueue(name))
+
+
+class FakeExchange(object):
+
+    def __init__(self, broker, name):
+        self.broker = broker
+        self.name = name
+
+    async def publish(self, message, routing_key):
+        broker = self.broker
+        broker.in_flight += 1
+        broker.max_in_flight = max(broker.max_in_flight, broker.in_flight)
+        try:
+            # Wait for the confirm.
+            await asyncio.sleep(broker.publish_delay)
+            if broker.fail:
+                raise RuntimeError("nack")
+            broker.published.append((routing_key, message))
+        finally:
+            broker.in_flight -= 1
+
+
+class FakeQueue(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.callback = None
+        self.bindings = []
+
+    async def bind(self, exchange, routing_key):
+        self.bindings.append((exchange.name, routing_key))
+
+    async def consume(self, callback):
+        self.callback = callback
+        return 'ctag'
+
+    async def cancel(self, consumer_tag):
+        self.callback = None
+
+
+class FakeIncomingMessage(object):
+
+    def __init__(self, body, headers, content_type, tag):
+        self.body = body
+        self.headers = headers
+        self.content_type = content_type
+        self.content_encoding = 'utf-8'
+        self.delivery_tag = tag
+        self.exchange = ''
+        self.routing_key = incoming_cfg.queue
+        self.message_id = None
+        self.redelivered = False
+        self.acked = False
+        self.requeued = False
+
+    async def ack(self):
+        self.acked = True
+
+    async def nack(self, requeue=True):
+        self.requeued = requeue
+
+
+class FakeOutgoingMessage(object):
+
+    def __init__(self, body, content_type=None, content_encoding=None, headers=None, delivery_mode=None):
+        self.body = body
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.headers = headers
+        self.delivery_mode = delivery_mode
+
+
+class TestAsyncForwarder(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = WorkerStats(aio.STAGES)
+        self.audit_logger = mock.Mock()
+
+    def forward(self, broker, deliveries, dedup=None, redelivered=False):
+        """ Start an 'AsyncForwarder', deliver messages to it (all at once) and wait until they are dealt with. """
+
+        async def forward():
+            engine = aio.AsyncForwarder(incoming_cfg, outgoing_cfg, self.stats, self.audit_logger, mock.Mock(), dedup)
+            await engine.start()
+
+            delivered = []
+            for tag, args in enumerate(deliveries, 1):
+                task, message = broker.deliver(*args, tag=tag)
+                message.redelivered = redelivered
+                # One at a time, so that any duplicates are published first.
+                await task
+                delivered.append((task, message))
+            await asyncio.gather(*[task for task, message in delivered])
+            await engine.stop()
+
+            return [message for task, message in delivered]
+
+        with mock.patch('application.aio.aio_pika', broker.module):
+            return asyncio.run(forward())
+
+    def test_forward(self):
+        broker = FakeBroker()
+        body = json.dumps({'title_number': 'DN1'}).encode()
+
+        messages = self.forward(broker, [(body, {'title_number': 'DN1'})])
+
+        routing_key, published = broker.published[0]
+        self.assertEqual(routing_key, outgoing_cfg.queue)
+        self.assertEqual(published.body, body)
+        self.assertEqual(published.headers, {'title_number': 'DN1'})
+        self.assertEqual(published.delivery_mode, 2)
+        self.assertTrue(messages[0].acked)
+
+        # Same audit trail as the kombu engine.
+        events = [call[0][0].event for call in self.audit_logger.audit.call_args_list]
+        self.assertEqual(events, [aio.PULL, aio.PUSH, aio.PUSH_ACK, aio.PULL_ACK])
+
+        stats = self.stats.as_dict()
+        self.assertEqual((stats['consumed'], stats['published'], stats['acked']), (1, 1, 1))
+
+    def test_publishes_in_flight(self):
+        broker = FakeBroker(publish_delay=0.01)
+
+        async def deliver():
+            engine = aio.AsyncForwarder(incoming_cfg, outgoing_cfg, self.stats, self.audit_logger, mock.Mock())
+            await engine.start()
+            delivered = [broker.deliver(b'{}', tag=tag) for tag in range(20)]
+            await asyncio.gather(*[task for task, message in delivered])
+            await engine.stop()
+            return [message for task, message in delivered]
+
+        with mock.patch('application.aio.aio_pika', broker.module):
+            messages = asyncio.run(deliver())
+
+        self.assertEqual(len(broker.published), 20)
+        self.assertTrue(all(message.acked for message in messages))
+        self.assertEqual(broker.max_in_flight, 20)
+
+    def test_publish_failure_requeues(self):
+        broker = FakeBroker()
+        broker.fail = True
+
+        messages = self.forward(broker, [(b'{}',)])
+
+        self.assertFalse(messages[0].acked)
+        self.assertTrue(messages[0].requeued)
+        stats = self.stats.as_dict()
+        self.assertEqual((stats['publish_errors'], stats['requeued'], stats['acked']), (1, 1, 0))
+
+        events = [call[0][0].event for call in self.audit_logger.audit.call_args_list]
+        self.assertEqual(events, [aio.PULL, aio.PUSH])
+
+    @mock.patch('application.forwarder.PASSTHROUGH_CONTENT_TYPES', frozenset())
+    def test_decode(self):
+        broker = FakeBroker()
+        body = zlib.compress(json.dumps({'a': 1}).encode())
+
+        self.forward(broker, [(body, {'compression': 'application/x-gzip'})])
+
+        routing_key, published = broker.published[0]
+        self.assertEqual(json.loads(published.body), {'a': 1})
+        self.assertEqual(published.content_type, 'application/json')
+        self.assertEqual(published.headers, {})
+
+    @mock.patch('application.aio.routing_key', RoutingKeyTemplate('register.{title_number:2}'))
+    def test_routing_key(self):
+        broker = FakeBroker()
+
+        self.forward(broker, [(b'{}', {'title_number': 'DN1'})])
+
+        routing_key, published = broker.published[0]
+        self.assertEqual(routing_key, 'register.DN')
+
+    def test_duplicate(self):
+        broker = FakeBroker()
+
+        messages = self.forward(broker, [(b'{"a": 1}',)] * 2 + [(b'{"a": 2}',)], dedup=DedupCache(), redelivered=True)
+
+        self.assertEqual([published.body for routing_key, published in broker.published], [b'{"a": 1}', b'{"a": 2}'])
+        self.assertTrue(all(message.acked for message in messages))
+        stats = self.stats.as_dict()
+        self.assertEqual((stats['dedup_checks'], stats['duplicates'], stats['acked']), (3, 1, 3))
+
+    def test_topology(self):
+        broker = FakeBroker()
+
+        self.forward(broker, [])
+
+        self.assertIn(incoming_cfg.queue, broker.queues)
+        self.assertEqual(broker.queues[outgoing_cfg.queue].bindings,
+                         [(outgoing_cfg.exchange.name, outgoing_cfg.binding_key)])
+
+    def test_requires_aio_pika(self):
+        engine = aio.AsyncForwarder(incoming_cfg, outgoing_cfg, self.stats, self.audit_logger, mock.Mock())
+
+        with mock.patch('application.aio.aio_pika', None):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(engine.start())
+
+    def test_unsupported(self):
+        self.assertEqual(aio.unsupported(), [])
+
+        with mock.patch('application.forwarder.SIGNING_KEY', 'private.pem'):
+            self.assertEqual(aio.unsupported(), ['SIGNING_KEY'])
+            with self.assertRaises(RuntimeError):
+                aio.run(stop=mock.Mock())
+
+        with mock.patch.multiple('application.forwarder', SPOOL_DIR='/tmp/spool', INCOMING_LANES='urgent:2',
+                                 BACKPRESSURE=True, CONFIRM_MODE='async', ACK_BATCH_SIZE=10):
+            self.assertEqual(aio.unsupported(), ['SPOOL_DIR', 'INCOMING_LANES', 'BACKPRESSURE', 'CONFIRM_MODE',
+                                                 'ACK_BATCH_SIZE'])
+
+        # E.g. shards, which 'aio_pika' would never manage to connect to.
+        outgoing = outgoing_cfg._replace(hostname='amqp://a/,amqp://b/')
+        self.assertEqual(aio.unsupported(outgoing=outgoing), ['OUTGOING_QUEUE_HOSTNAME (several brokers)'])
+        with self.assertRaises(RuntimeError):
+            aio.run(stop=mock.Mock(), outgoing=outgoing)
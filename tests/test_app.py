@@ -5,7 +5,7 @@ import datetime
 import os
 import socket
 from multiprocessing import Process
-from application import server
+from application import forwarder
 
 """
 Test Register-Publisher on an 'ad hoc' basis or automatically (pytest).
@@ -13,7 +13,7 @@ Pretend to be "System Of Record" publisher.
 """
 
 # Set up root logger
-logger = server.logger
+logger = forwarder.logger
 
 # Basic test data.
 def make_message():
@@ -23,7 +23,7 @@ def make_message():
 class Application(object):
     """ Mimic Process calls, for logging purposes. """
 
-    def __init__(self, target=server.run):
+    def __init__(self, target=forwarder.run):
         self.target = target
         self.process = None
         logger.debug("Target:'{}'.".format(self.target))
@@ -54,10 +54,10 @@ class TestRegisterPublisher(unittest.TestCase):
 
         self.payload = message.payload
 
-    def consume(self, cfg=server.incoming_cfg):
+    def consume(self, cfg=forwarder.incoming_cfg):
         """ Get message via callback mechanism """
 
-        with server.setup_consumer(cfg=cfg, callback=self.handle_message) as consumer:
+        with forwarder.setup_consumer(cfg=cfg, callback=self.handle_message) as consumer:
 
             logger.debug("cfg: {}".format(cfg))
 
@@ -81,23 +81,23 @@ class TestRegisterPublisher(unittest.TestCase):
         logger.debug("reset")
 
         try:
-            with server.setup_connection(server.outgoing_cfg.hostname) as outgoing_connection:
+            with forwarder.setup_connection(forwarder.outgoing_cfg.hostname) as outgoing_connection:
 
                 # Need a connection to delete the queues.
                 self.assertEqual(outgoing_connection.connected, True)
 
                 outgoing_channel = outgoing_connection.channel()
-                queue = server.setup_queue(outgoing_channel, cfg=server.outgoing_cfg)
+                queue = forwarder.setup_queue(outgoing_channel, cfg=forwarder.outgoing_cfg)
                 queue.purge()
                 queue.delete()
 
-            with server.setup_connection(server.incoming_cfg.hostname) as incoming_connection:
+            with forwarder.setup_connection(forwarder.incoming_cfg.hostname) as incoming_connection:
 
                 # Need a connection to delete the queues.
                 self.assertEqual(incoming_connection.connected, True)
 
                 incoming_channel = incoming_connection.channel()
-                queue = server.setup_queue(incoming_channel, cfg=server.incoming_cfg)
+                queue = forwarder.setup_queue(incoming_channel, cfg=forwarder.incoming_cfg)
                 queue.purge()
                 queue.delete()
 
@@ -118,7 +118,7 @@ class TestRegisterPublisher(unittest.TestCase):
         self.message = None             # Message to be sent.
         self.payload = None             # Corresponding 'payload' of message received.
 
-        # Execute 'server.run()' as a separate process.
+        # Execute 'forwarder.run()' as a separate process.
         self.app.start()
 
         test_title = self.id().split(sep='.')[-1]
@@ -143,8 +143,8 @@ class TestRegisterPublisher(unittest.TestCase):
 
         self.message = make_message()
 
-        producer = server.setup_producer(cfg=server.incoming_cfg)
-        producer.publish(body=self.message, routing_key=server.incoming_cfg.queue, headers={'title_number': 'DN1'})
+        producer = forwarder.setup_producer(cfg=forwarder.incoming_cfg)
+        producer.publish(body=self.message, routing_key=forwarder.incoming_cfg.queue, headers={'title_number': 'DN1'})
         logger.info("Put message, exchange: {}, {}".format(self.message, producer.exchange))
 
         producer.close()
@@ -159,9 +159,9 @@ class TestRegisterPublisher(unittest.TestCase):
         self.message = make_message()
 
         # Send a message to 'incoming' exchange - i.e. as if from SoR.
-        with server.setup_producer(cfg=server.incoming_cfg) as producer:
+        with forwarder.setup_producer(cfg=forwarder.incoming_cfg) as producer:
 
-            producer.publish(body=self.message, routing_key=server.incoming_cfg.queue, headers={'title_number': 'DN1'})
+            producer.publish(body=self.message, routing_key=forwarder.incoming_cfg.queue, headers={'title_number': 'DN1'})
 
             # Kill connection to broker.
             producer.connection.close()
@@ -170,7 +170,7 @@ class TestRegisterPublisher(unittest.TestCase):
         self.app.join(timeout=5)
 
         # Consume message from outgoing exchange; this will establish another connection.
-        self.consume(cfg=server.outgoing_cfg)
+        self.consume(cfg=forwarder.outgoing_cfg)
 
         self.assertEqual(self.message, self.payload)
 
@@ -182,14 +182,14 @@ class TestRegisterPublisher(unittest.TestCase):
         self.message = make_message()
 
         # Send a message to 'incoming' exchange - i.e. as if from SoR.
-        with server.setup_producer(cfg=server.incoming_cfg) as producer:
+        with forwarder.setup_producer(cfg=forwarder.incoming_cfg) as producer:
             producer.publish(body=self.message, headers={'title_number': 'DN1'})
             logger.debug(self.message)
 
         self.app.start()
 
         # Consume message from outgoing exchange.
-        self.consume(cfg=server.outgoing_cfg)
+        self.consume(cfg=forwarder.outgoing_cfg)
 
         self.assertEqual(self.message, self.payload)
 
@@ -199,8 +199,8 @@ class TestRegisterPublisher(unittest.TestCase):
         self.message = make_message()
 
         # Send a message to 'incoming' exchange - i.e. as if from SoR.
-        with server.setup_producer(cfg=server.incoming_cfg) as producer:
-            producer.publish(body=self.message, routing_key=server.incoming_cfg.queue, headers={'title_number': 'DN1'})
+        with forwarder.setup_producer(cfg=forwarder.incoming_cfg) as producer:
+            producer.publish(body=self.message, routing_key=forwarder.incoming_cfg.queue, headers={'title_number': 'DN1'})
             logger.debug(self.message)
 
         # Kill application; wait long enough for message to be stored.
@@ -209,7 +209,7 @@ class TestRegisterPublisher(unittest.TestCase):
         self.app.terminate()
 
         # Consume message from outgoing exchange.
-        self.consume(cfg=server.outgoing_cfg)
+        self.consume(cfg=forwarder.outgoing_cfg)
 
         self.assertEqual(self.message, self.payload)
 
@@ -224,9 +224,9 @@ class TestRegisterPublisher(unittest.TestCase):
         ROOT_KEY = 'feeder'
 
         # Use default binding key for the queue that is created via setup_producer().
-        cfg = server.outgoing_cfg
+        cfg = forwarder.outgoing_cfg
 
-        with server.setup_producer(cfg=cfg) as producer:
+        with forwarder.setup_producer(cfg=cfg) as producer:
             routing_key = ROOT_KEY + '.test_default_topic_keys'
             producer.publish(body=self.message, routing_key=routing_key, headers={'title_number': 'DN1'})
             logger.debug(self.message)
@@ -247,9 +247,9 @@ class TestRegisterPublisher(unittest.TestCase):
         ROOT_KEY = 'feeder'
 
         # Set binding key for the queue that is created via setup_producer().
-        cfg = server.outgoing_cfg._replace(binding_key=ROOT_KEY+'.*')
+        cfg = forwarder.outgoing_cfg._replace(binding_key=ROOT_KEY+'.*')
 
-        with server.setup_producer(cfg=cfg) as producer:
+        with forwarder.setup_producer(cfg=cfg) as producer:
             routing_key = ROOT_KEY + '.test_valid_topic_keys'
             producer.publish(body=self.message, routing_key=routing_key, headers={'title_number': 'DN1'})
             logger.debug(self.message)
@@ -270,9 +270,9 @@ class TestRegisterPublisher(unittest.TestCase):
         ROOT_KEY = 'feeder'
 
         # Set binding key for the queue that is created via setup_producer().
-        cfg = server.outgoing_cfg._replace(binding_key=ROOT_KEY+'.*')
+        cfg = forwarder.outgoing_cfg._replace(binding_key=ROOT_KEY+'.*')
 
-        with server.setup_producer(cfg=cfg) as producer:
+        with forwarder.setup_producer(cfg=cfg) as producer:
             routing_key = 'FEEDER' + '.test_invalid_topic_keys'
             producer.publish(body=self.message, routing_key=routing_key, headers={'title_number': 'DN1'})
             logger.debug(self.message)
@@ -290,20 +290,20 @@ class TestRegisterPublisher(unittest.TestCase):
 
         # Send a message to 'incoming' exchange - i.e. as if from SoR.
         # import pdb; pdb.set_trace()
-        with server.setup_producer(cfg=server.incoming_cfg) as producer:
+        with forwarder.setup_producer(cfg=forwarder.incoming_cfg) as producer:
             for n in range(count):
 
                 # Message to be sent.
                 self.message = make_message()
 
-                producer.publish(body=self.message, routing_key=server.incoming_cfg.queue, headers={'title_number': 'DN1'})
+                producer.publish(body=self.message, routing_key=forwarder.incoming_cfg.queue, headers={'title_number': 'DN1'})
                 logger.debug(self.message)
 
                 # Wait long enough message to be processed.
                 self.app.join(timeout=1)
 
                 # Consume message from outgoing exchange, via callback.
-                self.consume(cfg=server.outgoing_cfg)
+                self.consume(cfg=forwarder.outgoing_cfg)
 
                 self.assertEqual(self.message, self.payload)
 
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from application.spool import Spool
+from application.archive import Archive, Record, read_archive, to_json, from_json
+from tests.helpers import make_configs, load, run_worker
+
+
+def record(body, title='DN1', timestamp=100.0, **kwargs):
+    fields = dict(body=body, content_type='application/json', content_encoding='utf-8',
+                  headers={'title_number': title}, routing_key='title.' + title, compression=None, timestamp=timestamp)
+    fields.update(kwargs)
+    return Record(**fields)
+
+
+class TestJSON(unittest.TestCase):
+
+    def test_round_trip(self):
+        for original in (record(b'{"n": 1}'),
+                         record(b'\xff\x00', content_type='application/octet-stream', content_encoding='binary'),
+                         record(b'zipped', compression='application/x-gzip', timestamp=None)):
+            self.assertEqual(from_json(to_json(original)), original)
+
+    def test_defaults(self):
+        self.assertEqual(from_json('{"body": {"n": 1}}'),
+                         Record(b'{"n": 1}', 'application/json', None, {}, None, None, None))
+
+
+class TestReadArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_jsonl(self):
+        path = os.path.join(self.directory, 'export.jsonl')
+        with open(path, 'w') as f:
+            f.write(to_json(record(b'"one"')) + '\n\n' + to_json(record(b'"two"')) + '\n')
+
+        self.assertEqual([r.body for r in read_archive(path)], [b'"one"', b'"two"'])
+
+    def test_jsonl_invalid(self):
+        path = os.path.join(self.directory, 'export.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"body": "one"}\nnot json\n')
+
+        with self.assertRaises(ValueError):
+            list(read_archive(path))
+
+    def test_spool(self):
+        # Per-worker spools, as written by the forwarder.
+        for worker_id in (0, 1):
+            spool = Spool(os.path.join(self.directory, str(worker_id)), segment_size=64)
+            for n in range(3):
+                spool.append('{}.{}'.format(worker_id, n).encode('ascii'),
+                             dict(content_type='text/plain', content_encoding='utf-8', headers={'title_number': 'DN1'},
+                                  compression=None, routing_key='key', audit_header={}))
+            spool.close()
+
+        records = list(read_archive(self.directory))
+
+        self.assertEqual([r.body for r in records], [b'0.0', b'0.1', b'0.2', b'1.0', b'1.1', b'1.2'])
+        self.assertEqual(records[0].headers, {'title_number': 'DN1'})
+        self.assertEqual(records[0].routing_key, 'key')
+        self.assertIsNotNone(records[0].timestamp)
+
+    def test_spool_in_use(self):
+        # The messages in a spool that a worker has open are still to be forwarded (by the worker).
+        spool = Spool(os.path.join(self.directory, '0'))
+        spool.append(b'one', dict(content_type='text/plain', content_encoding='utf-8', headers={}, compression=None,
+                                  routing_key='key'))
+        spool.sync()
+
+        with self.assertRaises(RuntimeError):
+            read_archive(self.directory)
+
+        spool.close()
+        self.assertEqual([r.body for r in read_archive(self.directory)], [b'one'])
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_write(self):
+        archive = Archive(os.path.join(self.directory, '0'))
+        archive.write(record(b'"one"', timestamp=86400.0 * 2 - 1))
+        archive.write(record(b'"two"', timestamp=86400.0 * 2))
+        archive.write(record(b'"three"', timestamp=86400.0 * 2 + 1))
+        archive.close()
+
+        self.assertEqual(sorted(os.listdir(archive.directory)), ['1970-01-02.jsonl', '1970-01-03.jsonl'])
+        self.assertEqual([r.body for r in read_archive(self.directory)], [b'"one"', b'"two"', b'"three"'])
+        self.assertEqual(archive.written, 3)
+
+
+class TestRun(unittest.TestCase):
+
+    def test_forwarded(self):
+        """ Forwarded messages are archived, as published. """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        incoming, outgoing = make_configs()
+        load(incoming, 5)
+
+        with mock.patch('application.forwarder.ARCHIVE_DIR', directory):
+            run_worker(incoming, outgoing, lambda stats: stats.get('acked') >= 5)
+
+        records = list(read_archive(directory))
+        self.assertEqual([r.body for r in records], [('{"n": %d}' % n).encode('utf-8') for n in range(5)])
+        self.assertEqual(records[0].headers, {'title_number': 'DN0'})
+        self.assertEqual(records[0].content_type, 'application/json')
+        self.assertIsNotNone(records[0].timestamp)
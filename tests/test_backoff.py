@@ -0,0 +1,37 @@
+import unittest
+import mock
+from application.backoff import Backoff
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_first_retry_is_quick(self):
+        backoff = Backoff(initial=0.1, maximum=10)
+
+        delay = backoff.next()
+        self.assertGreaterEqual(delay, 0.05)
+        self.assertLessEqual(delay, 0.1)
+
+    def test_doubles_up_to_maximum(self):
+        backoff = Backoff(initial=0.1, maximum=1)
+
+        # No jitter: the upper bound of each delay.
+        with mock.patch('random.uniform', side_effect=lambda low, high: high):
+            delays = [backoff.next() for _ in range(6)]
+
+        self.assertEqual([round(delay, 3) for delay in delays], [0.1, 0.2, 0.4, 0.8, 1.0, 1.0])
+
+    def test_jitter(self):
+        backoff = Backoff(initial=1, maximum=1)
+
+        delays = set(backoff.next() for _ in range(10))
+        self.assertGreater(len(delays), 1)
+        self.assertTrue(all(0.5 <= delay <= 1 for delay in delays))
+
+    def test_reset(self):
+        backoff = Backoff(initial=0.1, maximum=10)
+        for _ in range(5):
+            backoff.next()
+
+        backoff.reset()
+        self.assertLessEqual(backoff.next(), 0.1)
@@ -0,0 +1,81 @@
+import unittest
+from application.backpressure import Backpressure, OPEN, THROTTLED, PAUSED
+
+
+class TestBackpressure(unittest.TestCase):
+
+    def setUp(self):
+        self.depth = 0
+        self.backpressure = Backpressure(lambda: self.depth, low=100, high=200, limit=300, rate=100.0, interval=1.0,
+                                         min_factor=0.1)
+        self.now = 1000.0
+
+    def update(self, depth):
+        self.depth = depth
+        self.now += 1.0
+        return self.backpressure.update(self.now)
+
+    def test_open(self):
+        self.assertFalse(self.update(50))
+        self.assertEqual(self.backpressure.state, OPEN)
+        self.assertEqual(self.backpressure.scale(100), 100)
+        self.assertIsNone(self.backpressure.current_rate())
+        self.assertEqual(self.backpressure.delay(self.now), 0.0)
+
+    def test_throttled(self):
+        self.assertTrue(self.update(150))
+        self.assertEqual(self.backpressure.state, THROTTLED)
+        self.assertAlmostEqual(self.backpressure.factor, 0.5)
+        self.assertEqual(self.backpressure.scale(100), 50)
+        self.assertEqual(self.backpressure.scale(0), 0)
+        self.assertAlmostEqual(self.backpressure.current_rate(), 50.0)
+
+        # Above the high watermark, down to the minimum.
+        self.assertTrue(self.update(250))
+        self.assertEqual(self.backpressure.state, THROTTLED)
+        self.assertAlmostEqual(self.backpressure.factor, 0.1)
+        self.assertEqual(self.backpressure.scale(5), 1)
+
+    def test_small_changes(self):
+        self.update(150)
+        self.assertFalse(self.update(152))
+        self.assertAlmostEqual(self.backpressure.factor, 0.5)
+        self.assertEqual(self.backpressure.depth, 152)
+
+    def test_paused(self):
+        self.assertTrue(self.update(300))
+        self.assertEqual(self.backpressure.state, PAUSED)
+
+        # Stays paused until below the high watermark.
+        self.update(250)
+        self.assertEqual(self.backpressure.state, PAUSED)
+        self.assertTrue(self.update(199))
+        self.assertEqual(self.backpressure.state, THROTTLED)
+
+        self.update(0)
+        self.assertEqual(self.backpressure.state, OPEN)
+        self.assertEqual(self.backpressure.factor, 1.0)
+
+    def test_interval(self):
+        self.update(150)
+        self.depth = 300
+        self.assertFalse(self.backpressure.update(self.now + 0.5))
+        self.assertEqual(self.backpressure.state, THROTTLED)
+
+    def test_delay(self):
+        self.update(150)
+
+        # 50 messages a second.
+        self.assertEqual(self.backpressure.delay(self.now), 0.0)
+        self.assertAlmostEqual(self.backpressure.delay(self.now), 0.02)
+        self.assertAlmostEqual(self.backpressure.delay(self.now + 0.01), 0.03)
+        self.assertEqual(self.backpressure.delay(self.now + 1.0), 0.0)
+
+    def test_sample_error(self):
+        def sample():
+            raise RuntimeError("unavailable")
+
+        backpressure = Backpressure(sample, low=1, high=2, limit=3)
+        with self.assertRaises(RuntimeError):
+            backpressure.update()
+        self.assertEqual(backpressure.state, OPEN)
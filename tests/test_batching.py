@@ -0,0 +1,116 @@
+import json
+import time
+import unittest
+import mock
+import kombu
+from application import forwarder
+from application.batching import Batcher, encode, decode_frames
+from tests.helpers import make_configs
+
+
+class TestEncode(unittest.TestCase):
+
+    items = [
+        (b'{"title_number": "DN1"}', 'application/json', 'utf-8', {'type': 'change'}),
+        ('plain text', 'text/plain', 'utf-8', {}),
+        (b'\xff\x00', 'application/octet-stream', 'binary', {}),
+    ]
+
+    def test_json(self):
+        envelope = json.loads(encode(self.items, 'json').decode('utf-8'))
+
+        self.assertEqual(envelope, [
+            {'headers': {'type': 'change'}, 'content_type': 'application/json', 'body': {'title_number': 'DN1'}},
+            {'headers': {}, 'content_type': 'text/plain', 'body': 'plain text'},
+            {'headers': {}, 'content_type': 'application/octet-stream', 'body_base64': '/wA='},
+        ])
+
+    def test_json_empty(self):
+        self.assertEqual(json.loads(encode([], 'json').decode('utf-8')), [])
+
+    def test_frames(self):
+        frames = list(decode_frames(encode(self.items, 'frames')))
+
+        self.assertEqual([body for _, body in frames], [b'{"title_number": "DN1"}', b'plain text', b'\xff\x00'])
+        self.assertEqual(frames[0][0], {'headers': {'type': 'change'}, 'content_type': 'application/json',
+                                        'content_encoding': 'utf-8'})
+
+
+class TestBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.publish = mock.Mock()
+        self.confirmed = []
+        self.rejected = []
+        self.batcher = Batcher(self.publish, self.confirmed.append, self.rejected.append, size=3, interval=0.05)
+
+    def add(self, message):
+        self.batcher.add(message, b'{"n": %d}' % message, 'application/json', 'utf-8', {})
+
+    def test_size(self):
+        self.add(1)
+        self.add(2)
+        self.publish.assert_not_called()
+        self.assertEqual(len(self.batcher), 2)
+
+        self.add(3)
+        body, content_type, headers = self.publish.call_args[0]
+        self.assertEqual(json.loads(body.decode('utf-8')),
+                         [{'headers': {}, 'content_type': 'application/json', 'body': {'n': n}} for n in (1, 2, 3)])
+        self.assertEqual(content_type, 'application/json')
+        self.assertEqual(headers, {'batch_size': 3, 'batch_format': 'json'})
+
+        self.assertEqual(self.confirmed, [1, 2, 3])
+        self.assertEqual(len(self.batcher), 0)
+
+    def test_interval(self):
+        self.add(1)
+        self.batcher.tick()
+        self.publish.assert_not_called()
+
+        time.sleep(0.06)
+        self.batcher.tick()
+        self.assertEqual(self.publish.call_count, 1)
+        self.assertEqual(self.confirmed, [1])
+
+        # Nothing to publish.
+        self.batcher.tick()
+        self.batcher.flush()
+        self.assertEqual(self.publish.call_count, 1)
+
+    def test_rejected(self):
+        self.publish.side_effect = ConnectionError('down')
+        self.add(1)
+        self.add(2)
+
+        with self.assertRaises(ConnectionError):
+            self.batcher.flush()
+
+        self.assertEqual(self.rejected, [1, 2])
+        self.assertEqual(self.confirmed, [])
+        self.assertEqual(len(self.batcher), 0)
+
+    def test_frames(self):
+        batcher = Batcher(self.publish, self.confirmed.append, self.rejected.append, size=2, format='frames')
+        batcher.add(1, b'one', 'text/plain', 'utf-8', {})
+        batcher.add(2, b'two', 'text/plain', 'utf-8', {})
+
+        body, content_type, headers = self.publish.call_args[0]
+        self.assertEqual([body for _, body in decode_frames(body)], [b'one', b'two'])
+        self.assertEqual(content_type, 'application/x-rp-frames')
+        self.assertEqual(headers['batch_format'], 'frames')
+
+
+class TestRun(unittest.TestCase):
+
+    @mock.patch('application.forwarder.SPOOL_DIR', '/tmp/rp_spool')
+    def test_spool(self):
+        """ Refused with a spool, whose drained messages would be missing from the envelopes. """
+
+        incoming, outgoing = make_configs()
+        batch = outgoing._replace(exchange=kombu.Exchange(outgoing.queue + '_batch', type='fanout'))
+
+        with self.assertRaisesRegex(RuntimeError, 'SPOOL_DIR'):
+            forwarder.run(0, None, None, incoming, outgoing, batch)
+        self.assertRaises(RuntimeError, forwarder.check, batch)
+        forwarder.check(batch._replace(exchange=kombu.Exchange('')))
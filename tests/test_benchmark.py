@@ -0,0 +1,266 @@
+#!/bin/python
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import unittest
+import functools
+import tracemalloc
+from application import forwarder
+from application.workers import WorkerPool
+from application.signing import Signer
+from tests.helpers import make_configs, queue_count
+
+"""
+Throughput benchmarks for the forwarder, without a broker.
+
+Messages are forwarded by 'forwarder.run()' workers between queues on kombu's in-memory transport, using the same
+'setup_producer()'/'setup_consumer()' set-up as in service. Each point of a grid of payload sizes, header shapes and
+worker counts reports messages per second, CPU time per message and peak memory growth per message; the latter includes
+the forwarded copies held by the in-memory "broker". Logging (and so auditing) is disabled while forwarding, so that
+results do not depend on the handlers installed, e.g. by pytest's log capture.
+
+These are skipped by the normal test run; set RUN_BENCHMARKS to run them (and compare against the stored baselines),
+or run this module directly for a report:
+
+    python -m tests.test_benchmark [--count N] [--update-baselines]
+
+Baselines are stored relative to a calibration point of the grid (the smallest payload, without headers, by a single
+worker), measured in the same run, so that they hold across machines and message counts.
+
+Signing throughput (signatures per second, by number of signing processes) is reported separately, with '--signing';
+that requires the 'cryptography' package.
+
+"""
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'benchmark_baselines.json')
+
+# Permitted regression, relative to baseline.
+TOLERANCE = float(os.getenv('BENCHMARK_TOLERANCE', 0.3))
+
+COUNT = int(os.getenv('BENCHMARK_COUNT', 1000))
+
+# Seconds to wait for a benchmark's messages to be forwarded.
+TIMEOUT = float(os.getenv('BENCHMARK_TIMEOUT', 120))
+
+# Runs per benchmark, of which the best is taken.
+REPEAT = int(os.getenv('BENCHMARK_REPEAT', 3))
+
+PAYLOAD_SIZES = (100, 10000, 100000)
+HEADER_SHAPES = {
+    'none': {},
+    'title': {'title_number': 'DN1'},
+    'wide': dict(('header_{}'.format(n), 'value {}'.format(n)) for n in range(20)),
+}
+WORKER_COUNTS = (1, 2, 4)
+
+# Compared measures, and whether a higher value is better.
+MEASURES = {'msgs_per_s': True, 'cpu_us_per_msg': False}
+
+SIGNING_KEY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_keys', 'test_private.pem')
+SIGNING_PROCESSES = (0, 1, 2, 4)
+
+
+def grid():
+    for payload_size in PAYLOAD_SIZES:
+        for header_shape in sorted(HEADER_SHAPES):
+            for workers in WORKER_COUNTS:
+                yield payload_size, header_shape, workers
+
+
+def key(payload_size, header_shape, workers):
+    return 'payload={},headers={},workers={}'.format(payload_size, header_shape, workers)
+
+
+CALIBRATION = key(PAYLOAD_SIZES[0], 'none', WORKER_COUNTS[0])
+
+
+def forward(payload_size, header_shape, workers, count=COUNT, trace=False, timeout=TIMEOUT):
+    """ Forward 'count' messages; returns elapsed seconds, CPU seconds and (if 'trace') peak memory growth.
+
+    Raises RuntimeError if they have not all been forwarded within 'timeout' seconds.
+
+    """
+
+    incoming, outgoing = make_configs()
+    body = {'data': 'x' * payload_size}
+    headers = HEADER_SHAPES[header_shape]
+
+    # Load the incoming queue beforehand; the outgoing queue is declared by the workers' producers.
+    with forwarder.setup_producer(cfg=incoming) as producer:
+        for _ in range(count):
+            producer.publish(body=body, routing_key=incoming.queue, headers=dict(headers))
+        channel = producer.channel
+
+        forwarder.setup_queue(channel, cfg=outgoing)
+
+        target = functools.partial(forwarder.run, incoming=incoming, outgoing=outgoing)
+        pool = WorkerPool(target, size=workers, mode='thread')
+
+        if trace:
+            tracemalloc.start()
+            start_memory = tracemalloc.get_traced_memory()[0]
+
+        logging.disable(logging.CRITICAL)
+        started, cpu_started = time.perf_counter(), time.process_time()
+        pool.start()
+        try:
+            while queue_count(channel, outgoing) < count:
+                if time.perf_counter() - started > timeout:
+                    raise RuntimeError("Forwarded {} of {} messages in {}s".format(
+                        queue_count(channel, outgoing), count, timeout))
+                time.sleep(0.005)
+            elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+        finally:
+            pool.stop()
+            logging.disable(logging.NOTSET)
+
+        peak = None
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1] - start_memory
+            tracemalloc.stop()
+
+        for cfg in (incoming, outgoing):
+            queue = forwarder.setup_queue(channel, cfg=cfg)
+            queue.purge()
+            queue.delete()
+
+    return elapsed, cpu, peak
+
+
+def measure(payload_size, header_shape, workers, count=COUNT, repeat=REPEAT):
+    """ Results for one point of the grid; the best of 'repeat' runs. """
+
+    runs = [forward(payload_size, header_shape, workers, count) for _ in range(repeat)]
+    elapsed, cpu = min(run[0] for run in runs), min(run[1] for run in runs)
+
+    # Memory is traced separately, over fewer messages, as tracing slows everything down.
+    traced = max(count // 10, 1)
+    _, _, peak = forward(payload_size, header_shape, workers, traced, trace=True)
+
+    return {
+        'msgs_per_s': count / elapsed,
+        'cpu_us_per_msg': cpu / count * 1e6,
+        'peak_bytes_per_msg': peak / traced,
+    }
+
+
+def measure_all(count=COUNT):
+    """ Results for every point of the grid. """
+
+    return dict((key(*point), measure(*point, count=count)) for point in grid())
+
+
+def relative(results, calibration=CALIBRATION):
+    """ The compared measures of 'results', as ratios to those of the calibration point. """
+
+    base = results[calibration]
+    return dict((name, dict((quantity, result[quantity] / base[quantity]) for quantity in MEASURES))
+                for name, result in results.items())
+
+
+def regressions(results, baselines, tolerance=TOLERANCE):
+    """ Descriptions of any results that are worse than baseline (relative to calibration) by more than 'tolerance'. """
+
+    failures = []
+    for name, ratios in sorted(relative(results).items()):
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        for quantity, higher_is_better in sorted(MEASURES.items()):
+            if higher_is_better:
+                worse = ratios[quantity] < baseline[quantity] * (1 - tolerance)
+            else:
+                worse = ratios[quantity] > baseline[quantity] * (1 + tolerance)
+            if worse:
+                failures.append('{}: {} {:.2f} x calibration, baseline {:.2f}'.format(
+                    name, quantity, ratios[quantity], baseline[quantity]))
+
+    return failures
+
+
+def load_baselines():
+    if not os.path.exists(BASELINES):
+        return {}
+    with open(BASELINES) as f:
+        return json.load(f)
+
+
+def save_baselines(results):
+    with open(BASELINES, 'w') as f:
+        json.dump(relative(results), f, indent=2, sort_keys=True)
+
+
+def report(results, out=sys.stdout):
+    out.write('{:<40} {:>12} {:>16} {:>20}\n'.format('benchmark', 'msgs/s', 'CPU us/msg', 'peak bytes/msg'))
+    for name, result in sorted(results.items()):
+        out.write('{:<40} {:>12.0f} {:>16.1f} {:>20.0f}\n'.format(
+            name, result['msgs_per_s'], result['cpu_us_per_msg'], result['peak_bytes_per_msg']))
+
+
+def signing_rate(processes, count=COUNT, payload_size=1000, batch=100):
+    """ Signatures per second, by a 'Signer' with 'processes' processes, in batches of 'batch' (as forwarded). """
+
+    bodies = [('{"n": %d, "data": "%s"}' % (n, 'x' * payload_size)).encode('ascii') for n in range(count)]
+
+    signer = Signer(SIGNING_KEY, processes=processes)
+    try:
+        # Start the pool's processes (and load the key in each) beforehand.
+        signer.sign_all(bodies[:max(processes, 2)])
+
+        started = time.perf_counter()
+        for n in range(0, count, batch):
+            signer.sign_all(bodies[n:n + batch])
+        elapsed = time.perf_counter() - started
+    finally:
+        signer.close()
+
+    return count / elapsed
+
+
+def report_signing(count=COUNT, out=sys.stdout):
+    out.write('{:<40} {:>12}\n'.format('signing', 'sigs/s'))
+    for processes in SIGNING_PROCESSES:
+        out.write('{:<40} {:>12.0f}\n'.format('processes={}'.format(processes), signing_rate(processes, count)))
+
+
+@unittest.skipUnless(os.getenv('RUN_BENCHMARKS'), "RUN_BENCHMARKS not set")
+class TestForwarderThroughput(unittest.TestCase):
+    """ Fail if the forwarding hot path has regressed against the stored baselines. """
+
+    def test_throughput(self):
+        baselines = load_baselines()
+        results = measure_all()
+        report(results)
+
+        failures = regressions(results, baselines)
+        self.assertEqual(failures, [], '\n'.join(failures))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Register-Publisher forwarding benchmarks (in-memory transport).")
+    parser.add_argument('--count', type=int, default=COUNT, help="Messages per benchmark.")
+    parser.add_argument('--update-baselines', action='store_true', help="Store the results as the new baselines.")
+    parser.add_argument('--signing', action='store_true', help="Report signing throughput instead.")
+    args = parser.parse_args()
+
+    if args.signing:
+        report_signing(args.count)
+        return 0
+
+    results = measure_all(args.count)
+    report(results)
+
+    if args.update_baselines:
+        save_baselines(results)
+        return 0
+
+    failures = regressions(results, load_baselines())
+    for failure in failures:
+        sys.stderr.write('REGRESSION: {}\n'.format(failure))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+import zlib
+import unittest
+import kombu.compression
+from application.compression import Compressor, setup_compressor
+from application.workers import WorkerStats
+
+
+class TestCompressor(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = WorkerStats()
+        self.compressor = Compressor('zlib', threshold=100, stats=self.stats)
+
+    def test_compress(self):
+        body = b'{"data": "' + b'x' * 1000 + b'"}'
+
+        compressed, headers = self.compressor.compress(body, {'title_number': 'DN1'})
+
+        self.assertEqual(headers, {'title_number': 'DN1', 'compression': 'application/x-gzip'})
+        self.assertEqual(zlib.decompress(compressed), body)
+        self.assertEqual(kombu.compression.decompress(compressed, headers['compression']), body)
+
+        stats = self.stats.as_dict()
+        self.assertEqual(stats['compressed'], 1)
+        self.assertEqual(stats['compress_bytes_in'], len(body))
+        self.assertEqual(stats['compress_bytes_out'], len(compressed))
+        self.assertGreaterEqual(stats['compress_seconds'], 0)
+
+    def test_below_threshold(self):
+        body = b'x' * 99
+        self.assertEqual(self.compressor.compress(body, {}), (body, {}))
+        self.assertEqual(self.stats.get('compressed'), 0)
+
+    def test_not_smaller(self):
+        body = bytes(range(256))
+        self.assertEqual(self.compressor.compress(body, None), (body, None))
+        self.assertEqual(self.stats.get('compressed'), 0)
+
+    def test_already_compressed(self):
+        body = b'x' * 1000
+        headers = {'compression': 'application/x-bz2'}
+        self.assertEqual(self.compressor.compress(body, headers), (body, headers))
+
+    def test_text(self):
+        compressed, headers = self.compressor.compress('x' * 1000, {})
+        self.assertEqual(zlib.decompress(compressed), b'x' * 1000)
+
+    def test_setup(self):
+        self.assertIsNone(setup_compressor('', 100))
+        self.assertEqual(setup_compressor('zlib', 100).method, 'zlib')
+        with self.assertRaises(Exception):
+            setup_compressor('no-such-method', 100)
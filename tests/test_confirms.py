@@ -0,0 +1,141 @@
+import unittest
+import socket
+import mock
+from collections import defaultdict
+from application import forwarder
+from application.confirms import PublisherConfirms
+from tests.helpers import make_configs, queue_count, load, run_worker, memory_confirms
+
+
+class FakeChannel(object):
+    """ Just enough of an AMQP channel for 'confirm_select()' and its events. """
+
+    def __init__(self, channel_id=1):
+        self.channel_id = channel_id
+        self.events = defaultdict(set)
+        self.confirm_select = mock.Mock()
+
+    def ack(self, delivery_tag, multiple=False):
+        for callback in self.events['basic_ack']:
+            callback(delivery_tag, multiple)
+
+    def nack(self, delivery_tag, multiple=False):
+        for callback in self.events['basic_nack']:
+            callback(delivery_tag, multiple, True)
+
+
+class TestPublisherConfirms(unittest.TestCase):
+
+    def setUp(self):
+        self.producer = mock.Mock()
+        self.producer.channel = FakeChannel()
+        self.producer.connection.drain_events.side_effect = socket.timeout
+
+        self.confirmed = []
+        self.rejected = []
+
+        self.confirms = PublisherConfirms(self.producer, self.confirmed.append, self.rejected.append,
+                                          window=3, timeout=30)
+        self.confirms.select()
+
+    def publish(self, *messages):
+        for message in messages:
+            self.confirms.publish(message, self.producer.publish, message)
+
+    def test_select(self):
+        self.producer.channel.confirm_select.assert_called_once_with()
+
+    def test_ack(self):
+        self.publish('a', 'b')
+        self.producer.channel.ack(2)
+
+        self.assertEqual(self.confirmed, ['b'])
+        self.assertEqual(len(self.confirms), 1)
+
+    def test_multiple_ack(self):
+        self.publish('a', 'b', 'c')
+        self.producer.channel.ack(2, multiple=True)
+
+        self.assertEqual(self.confirmed, ['a', 'b'])
+        self.assertEqual(len(self.confirms), 1)
+
+    def test_nack(self):
+        self.publish('a', 'b')
+        self.producer.channel.nack(1)
+
+        self.assertEqual(self.rejected, ['a'])
+        self.assertEqual(self.confirmed, [])
+
+    def test_timeout(self):
+        with mock.patch('application.confirms.time.monotonic', return_value=0):
+            self.publish('a')
+
+        with mock.patch('application.confirms.time.monotonic', return_value=self.confirms.timeout + 1):
+            self.confirms.wait(timeout=0)
+
+        self.assertEqual(self.rejected, ['a'])
+        self.assertEqual(len(self.confirms), 0)
+
+    def test_window(self):
+        self.publish('a', 'b', 'c')
+
+        # Window is full: the next publish has to wait for a confirm.
+        self.producer.connection.drain_events.side_effect = lambda timeout: self.producer.channel.ack(1)
+        self.publish('d')
+
+        self.assertEqual(self.confirmed, ['a'])
+        self.assertEqual(len(self.confirms), 3)
+
+    def test_wait_drains(self):
+        self.publish('a', 'b', 'c')
+
+        # A confirm per frame: all those that have arrived are processed by the one 'wait()'.
+        frames = [lambda: self.producer.channel.ack(1), lambda: self.producer.channel.ack(2)]
+
+        def drain_events(timeout):
+            if not frames:
+                raise socket.timeout()
+            frames.pop(0)()
+
+        self.producer.connection.drain_events.side_effect = drain_events
+        self.confirms.wait(timeout=0)
+
+        self.assertEqual(self.confirmed, ['a', 'b'])
+        self.assertEqual(len(self.confirms), 1)
+
+    def test_new_channel(self):
+        self.publish('a', 'b')
+
+        # E.g. after reconnection.
+        self.producer.channel = FakeChannel(2)
+        self.publish('c')
+
+        self.assertEqual(self.rejected, ['a', 'b'])
+        self.producer.channel.confirm_select.assert_called_once_with()
+
+        self.producer.channel.ack(1)
+        self.assertEqual(self.confirmed, ['c'])
+
+    def test_publish_error(self):
+        self.publish('a')
+        self.producer.publish.side_effect = IOError
+
+        self.assertRaises(IOError, self.publish, 'b')
+        self.assertEqual(self.rejected, ['a'])
+
+
+
+class TestRun(unittest.TestCase):
+
+    def test_async(self):
+        """ Messages are acknowledged as their publishes are confirmed, in batches if so configured. """
+
+        incoming, outgoing = make_configs()
+        load(incoming, 20)
+
+        with memory_confirms(), mock.patch.multiple('application.forwarder', CONFIRM_MODE='async', ACK_BATCH_SIZE=5):
+            stats = run_worker(incoming, outgoing, lambda stats: stats.get('acked') >= 20)
+
+        self.assertEqual((stats.get('published'), stats.get('acked'), stats.get('requeued')), (20, 20, 0))
+        with forwarder.setup_producer(cfg=outgoing) as producer:
+            self.assertEqual(queue_count(producer.channel, outgoing), 20)
@@ -0,0 +1,67 @@
+import unittest
+import threading
+import time
+import mock
+from collections import namedtuple
+from application.counts import QueueCounter
+
+Configuration = namedtuple("Configuration", ['hostname', 'exchange', 'queue', 'binding_key'])
+
+
+class TestQueueCounter(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = mock.Mock()
+        self.connection.connected = True
+        self.connection.default_channel.queue_declare.return_value = ('queue', 12, 1)
+
+        self.connect = mock.Mock(return_value=self.connection)
+        self.counter = QueueCounter(self.connect, ttl=60)
+        self.cfg = Configuration('amqp://localhost', None, 'queue', '#')
+
+    def test_count(self):
+        self.assertEqual(self.counter.count(self.cfg), 12)
+        self.connection.default_channel.queue_declare.assert_called_once_with(queue='queue', passive=True)
+
+    def test_cached(self):
+        self.counter.count(self.cfg)
+        self.counter.count(self.cfg)
+
+        self.assertEqual(self.connection.default_channel.queue_declare.call_count, 1)
+
+    def test_connection_reused(self):
+        self.counter.ttl = 0
+        self.counter.count(self.cfg)
+        self.counter.count(self.cfg._replace(queue='other'))
+
+        self.connect.assert_called_once_with('amqp://localhost')
+
+    def test_broken_connection(self):
+        self.counter.ttl = 0
+        self.counter.count(self.cfg)
+
+        self.connection.connected = False
+        self.counter.count(self.cfg)
+
+        self.assertEqual(self.connect.call_count, 2)
+        self.connection.close.assert_called_once_with()
+
+    def test_error_not_cached(self):
+        self.connection.default_channel.queue_declare.side_effect = [IOError, ('queue', 3, 0)]
+
+        self.assertRaises(IOError, self.counter.count, self.cfg)
+        self.assertEqual(self.counter.count(self.cfg), 3)
+
+    def test_single_flight(self):
+        def slow_declare(**kwargs):
+            time.sleep(0.1)
+            return ('queue', 5, 0)
+        self.connection.default_channel.queue_declare.side_effect = slow_declare
+
+        threads = [threading.Thread(target=self.counter.count, args=(self.cfg,)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.connection.default_channel.queue_declare.call_count, 1)
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from application.dedup import DedupCache, dedup_key
+
+
+class TestDedupKey(unittest.TestCase):
+
+    def test_message_id(self):
+        self.assertEqual(dedup_key('id-1', b'a'), dedup_key('id-1', b'b'))
+        self.assertNotEqual(dedup_key('id-1', b'a'), dedup_key('id-2', b'a'))
+
+    def test_body(self):
+        self.assertEqual(dedup_key(None, b'a'), dedup_key(None, b'a'))
+        self.assertNotEqual(dedup_key(None, b'a'), dedup_key(None, b'b'))
+        self.assertEqual(len(dedup_key(None, 'text')), 16)
+
+
+class TestDedupCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dedup.index')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_seen(self):
+        cache = DedupCache(capacity=10, ttl=60)
+        key = dedup_key('id-1', b'')
+
+        self.assertFalse(cache.seen(key))
+        cache.add(key)
+        self.assertTrue(cache.seen(key))
+
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['checks'], stats['hits'], stats['hit_rate']), (1, 2, 1, 0.5))
+        self.assertGreater(stats['bytes'], 0)
+
+    def test_lru(self):
+        cache = DedupCache(capacity=2, ttl=60)
+        a, b, c = [dedup_key(name, b'') for name in 'abc']
+
+        cache.add(a)
+        cache.add(b)
+        cache.seen(a)
+        cache.add(c)
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.seen(a))
+        self.assertFalse(cache.seen(b))
+
+    def test_ttl(self):
+        cache = DedupCache(capacity=10, ttl=60)
+        key = dedup_key('id-1', b'')
+
+        with mock.patch('time.time', return_value=1000.0):
+            cache.add(key)
+        with mock.patch('time.time', return_value=1061.0):
+            self.assertFalse(cache.seen(key))
+        self.assertEqual(len(cache), 0)
+
+    def test_index(self):
+        key = dedup_key('id-1', b'')
+
+        cache = DedupCache(capacity=10, ttl=60, path=self.path)
+        cache.add(key)
+
+        # As though the process had died.
+        restarted = DedupCache(capacity=10, ttl=60, path=self.path)
+        self.assertTrue(restarted.seen(key))
+
+        cache.close()
+        restarted.close()
+
+    def test_index_partial_line(self):
+        key = dedup_key('id-1', b'')
+        cache = DedupCache(capacity=10, ttl=60, path=self.path)
+        cache.add(key)
+        cache.close()
+
+        with open(self.path, 'a') as f:
+            f.write('12')
+
+        restarted = DedupCache(capacity=10, ttl=60, path=self.path)
+        self.assertEqual(len(restarted), 1)
+        restarted.close()
+
+    def test_index_compacted(self):
+        cache = DedupCache(capacity=2, ttl=60, path=self.path)
+        for n in range(10):
+            cache.add(dedup_key(str(n), b''))
+        cache.close()
+
+        with open(self.path) as f:
+            self.assertLessEqual(len(f.readlines()), 4)
+        self.assertEqual(len(DedupCache(capacity=2, ttl=60, path=self.path)), 2)
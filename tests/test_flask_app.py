@@ -2,7 +2,11 @@ import unittest
 from application import server
 from application.server import app
 import os
+import json
+import time
 import mock
+from application.workers import WorkerStats
+from application import metrics
 
 class TestSequenceFunctions(unittest.TestCase):
 
@@ -28,4 +32,115 @@ class TestSequenceFunctions(unittest.TestCase):
 
     def test_index(self):
         self.assertEqual(self.app.get('/').status, '200 OK')
-        self.assertEqual(self.app.get('/').data.decode("utf-8"), 'register publisher flask service running')
\ No newline at end of file
+        self.assertEqual(self.app.get('/').data.decode("utf-8"), 'register publisher flask service running')
+
+    @mock.patch('application.server.forwarder_stats')
+    def test_workers_endpoint(self, mock_stats):
+        mock_stats.read.return_value = {'workers': [{'worker': 0, 'alive': True, 'consumed': 3}]}
+        response = self.app.get('/workers')
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(json.loads(response.data.decode("utf-8")),
+                         {'workers': [{'worker': 0, 'alive': True, 'consumed': 3}]})
+
+    @mock.patch('application.server.forwarder_stats')
+    def test_workers_endpoint_no_forwarder(self, mock_stats):
+        mock_stats.read.return_value = {}
+        response = self.app.get('/workers')
+        self.assertEqual(json.loads(response.data.decode("utf-8")), {'workers': []})
+
+    @mock.patch('application.server.forwarder_stats')
+    def test_audit_endpoint(self, mock_stats):
+        mock_stats.read.return_value = {}
+        response = self.app.get('/audit')
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(json.loads(response.data.decode("utf-8")), {'enabled': False})
+
+    @mock.patch('application.server.queue_counter')
+    @mock.patch('application.server.forwarder_stats')
+    def test_metrics_endpoint(self, mock_stats, mock_counter):
+        status = WorkerStats().as_dict()
+        status.update(worker=0, alive=True)
+        mock_stats.read.return_value = {'workers': [status], 'latency': {}, 'updated': time.time()}
+        mock_counter.count.return_value = 7
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status, '200 OK')
+        text = response.data.decode("utf-8")
+        self.assertIn('rp_messages_consumed_total{worker="0"} 0\n', text)
+        self.assertIn('rp_queue_messages{queue="incoming"} 7\n', text)
+        self.assertIn('rp_seconds_since_last_forward NaN\n', text)
+        self.assertIn('rp_stats_age_seconds ', text)
+
+    @mock.patch('application.server.forwarder_stats')
+    def test_backpressure_endpoint(self, mock_stats):
+        stats = WorkerStats()
+        stats.set('bp_state', 1)
+        stats.set('bp_depth', 150)
+        stats.set('bp_factor', 0.5)
+        stats.set('bp_rate', 250.0)
+        mock_stats.read.return_value = {'backpressure': {'enabled': True, 'low': 100, 'high': 200, 'limit': 300},
+                                        'workers': [dict(stats.as_dict(), worker=0, alive=True)]}
+        response = self.app.get('/backpressure')
+        self.assertEqual(response.status, '200 OK')
+        status = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(status['high'], 200)
+        self.assertEqual(status['workers'], [dict(worker=0, state='throttled', depth=150, factor=0.5, rate=250.0,
+                                                  pauses=0, wait_seconds=0.0)])
+
+    @mock.patch('application.server.forwarder_stats')
+    def test_backpressure_endpoint_disabled(self, mock_stats):
+        mock_stats.read.return_value = {}
+        response = self.app.get('/backpressure')
+        self.assertEqual(json.loads(response.data.decode("utf-8")), {'enabled': False})
+
+    @mock.patch('application.server.forwarder_stats')
+    def test_lanes_endpoint(self, mock_stats):
+        stats = WorkerStats(lanes=('urgent',))
+        stats.lane_incr('urgent', 'forwarded', 4)
+        stats.lane_incr('urgent', 'wait_seconds', 1.0)
+        mock_stats.read.return_value = {'workers': [dict(stats.as_dict(), worker=0, alive=True)]}
+        response = self.app.get('/lanes')
+        self.assertEqual(response.status, '200 OK')
+        lanes = json.loads(response.data.decode("utf-8"))['lanes']
+        self.assertEqual(lanes['urgent']['forwarded'], 4)
+        self.assertEqual(lanes['urgent']['mean_wait_seconds'], 0.25)
+
+    @mock.patch('application.server.forwarder_stats')
+    def test_shards_endpoint(self, mock_stats):
+        stats = WorkerStats(shards=('amqp://a/', 'amqp://b/'))
+        stats.shard_incr('amqp://a/', 'published', 3)
+        stats.shard_set('amqp://a/', 'healthy', 1)
+        mock_stats.read.return_value = {'workers': [dict(stats.as_dict(), worker=0, alive=True)]}
+        response = self.app.get('/shards')
+        self.assertEqual(response.status, '200 OK')
+        shards = json.loads(response.data.decode("utf-8"))['shards']
+        self.assertEqual(shards['amqp://a/'], dict(published=3, failovers=0, errors=0, healthy=True))
+        self.assertFalse(shards['amqp://b/']['healthy'])
+
+    @mock.patch('application.server.forwarder_stats')
+    def test_sources_endpoint(self, mock_stats):
+        stats = WorkerStats(sources=('amqp://a/', 'amqp://b/'))
+        stats.source_incr('amqp://a/', 'consumed', 3)
+        stats.source_set('amqp://a/', 'healthy', 1)
+        mock_stats.read.return_value = {'workers': [dict(stats.as_dict(), worker=0, alive=True)]}
+        response = self.app.get('/sources')
+        self.assertEqual(response.status, '200 OK')
+        sources = json.loads(response.data.decode("utf-8"))['sources']
+        self.assertEqual(sources['amqp://a/'], dict(consumed=3, reconnects=0, errors=0, healthy=True))
+        self.assertFalse(sources['amqp://b/']['healthy'])
+
+    @mock.patch('application.server.queue_counter')
+    def test_sharded_count(self, mock_counter):
+        mock_counter.count.side_effect = lambda cfg: {'amqp://a/': 2, 'amqp://b/': 3}[cfg.hostname]
+        cfg = server.outgoing_count_cfg._replace(hostname='amqp://a/,amqp://b/')
+        self.assertEqual(server.get_queue_count(cfg), '5')
+
+    @mock.patch('application.server.forwarder_stats')
+    def test_latency_endpoint(self, mock_stats):
+        stats = WorkerStats(('publish',))
+        stats.latency.observe('publish', 0.001, stats.latency.start())
+        mock_stats.read.return_value = {'latency': metrics.latency_summary([stats.latency])}
+        response = self.app.get('/latency')
+        self.assertEqual(response.status, '200 OK')
+        summary = json.loads(response.data.decode("utf-8"))['stages']['publish']
+        self.assertEqual(summary['count'], 1)
+        self.assertTrue(0.0005 < summary['p50'] <= 0.0013)
@@ -0,0 +1,62 @@
+import unittest
+import mock
+from application import forwarder
+from application.forwarder import Forwarder
+from tests.helpers import make_configs, get_all, load
+
+
+class TestForwarder(unittest.TestCase):
+
+    def setUp(self):
+        self.incoming, self.outgoing = make_configs()
+        self.engine = Forwarder(incoming=self.incoming, outgoing=self.outgoing)
+
+    def test_poll(self):
+        """ Each poll forwards what has been delivered, once started. """
+
+        self.engine.start()
+        self.addCleanup(self.engine.close)
+        load(self.incoming, 3)
+
+        for _ in range(10):
+            self.engine.poll()
+            if self.engine.stats.get('acked') >= 3:
+                break
+
+        self.assertEqual(self.engine.stats.get('acked'), 3)
+        self.assertEqual([message.headers['title_number'] for message in get_all(self.outgoing)], ['DN0', 'DN1', 'DN2'])
+
+    def test_confirmed(self):
+        """ A message is acknowledged once all its publishes (e.g. per message and in an envelope) are confirmed. """
+
+        message = mock.Mock(unconfirmed=2, acker=None)
+        self.engine.confirmed(message)
+        self.assertFalse(message.ack.called)
+
+        self.engine.confirmed(message)
+        self.assertEqual(message.ack.call_count, 1)
+        self.assertEqual(self.engine.stats.get('acked'), 1)
+
+    def test_rejected(self):
+        """ A message is requeued (once) if any of its publishes is rejected; later confirms are ignored. """
+
+        message = mock.Mock(unconfirmed=2, acker=None)
+        self.engine.rejected(message)
+        self.engine.rejected(message)
+        self.engine.confirmed(message)
+
+        self.assertEqual(message.requeue.call_count, 1)
+        self.assertFalse(message.ack.called)
+        self.assertEqual(self.engine.stats.get('requeued'), 1)
+
+    def test_prepare(self):
+        """ The routing key comes from the headers, if so configured. """
+
+        message = mock.Mock(headers={'title_number': 'DN1'}, content_type='application/json',
+                            content_encoding='utf-8', body=b'{}')
+        template = forwarder.routing_key_template('register.{title_number}')
+        with mock.patch.object(forwarder, 'routing_key', template), mock.patch.object(forwarder, 'PASSTHROUGH', True):
+            body, key, properties = self.engine.prepare(message)
+
+        self.assertEqual((body, key), (b'{}', 'register.DN1'))
+        self.assertEqual(properties['headers'], {'title_number': 'DN1'})
@@ -0,0 +1,64 @@
+import os
+import json
+import shutil
+import tempfile
+import importlib
+import unittest
+import mock
+import kombu
+from application.archive import read_archive
+
+
+class Settings(object):
+    """ Settings for the inspector ('SETTINGS'): its queue, on the in-memory transport. """
+
+    OUTGOING_QUEUE_HOSTNAME = 'memory://'
+    OUTGOING_QUEUE = 'rp_inspector'
+
+
+class TestInspector(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.dict(os.environ, SETTINGS='tests.test_inspector.Settings'):
+            self.inspector = importlib.import_module('Do_not_deploy.query_outgoing_queue')
+        self.client = self.inspector.app.test_client()
+
+        # Not waiting long for more messages, once the queue is empty.
+        patcher = mock.patch.object(self.inspector, 'WAIT', 0.1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.inspector.queue.purge()
+        with kombu.Connection(Settings.OUTGOING_QUEUE_HOSTNAME) as connection:
+            producer = kombu.Producer(connection.channel())
+            for n in range(5):
+                producer.publish({'n': n}, routing_key=Settings.OUTGOING_QUEUE, headers={'title_number': 'DN1'})
+
+    def test_next_messages(self):
+        response = self.client.get('/getnextqueuemessages?n=3')
+
+        self.assertEqual(response.status_code, 200)
+        records = json.loads(response.get_data(as_text=True))
+        self.assertEqual([json.loads(record['body'])['n'] for record in records], [0, 1, 2])
+        self.assertEqual(records[0]['headers'], {'title_number': 'DN1'})
+
+        # The rest are left in the queue.
+        response = self.client.get('/getnextqueuemessages?n=10')
+        self.assertEqual([json.loads(record['body'])['n'] for record in json.loads(response.get_data(as_text=True))],
+                         [3, 4])
+
+    def test_remove_all_export(self):
+        with mock.patch.object(self.inspector, 'EXPORT_DIR', self.directory):
+            response = self.client.get('/removeallmessages?export=../removed.jsonl')
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(json.loads(response.get_data(as_text=True)), {'exported': 5, 'purged': 0})
+
+        # Written to the export directory only, in the archive format.
+        path = os.path.join(self.directory, 'removed.jsonl')
+        self.assertEqual([json.loads(record.body.decode('utf-8'))['n'] for record in read_archive(path)],
+                         list(range(5)))
+        self.assertEqual(self.inspector.queue.get(), None)
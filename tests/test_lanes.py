@@ -0,0 +1,119 @@
+import unittest
+from collections import Counter
+import mock
+from application import forwarder
+from application.lanes import Lane, LaneScheduler, parse_lanes
+from application.workers import WorkerStats
+from tests.helpers import make_configs, queue_count, load, run_worker
+
+
+def message(lane, size=100):
+    return mock.Mock(body=b'x' * size, lane=lane)
+
+
+class TestParseLanes(unittest.TestCase):
+
+    def test_parse(self):
+        lanes = parse_lanes(' urgent:8, bulk:1:20 ,other', prefetch=50)
+
+        self.assertEqual([(lane.queue, lane.weight, lane.prefetch) for lane in lanes],
+                         [('urgent', 8, 50), ('bulk', 1, 20), ('other', 1, 50)])
+
+    def test_empty(self):
+        self.assertEqual(parse_lanes(''), [])
+
+    def test_invalid(self):
+        for spec in ('urgent:x', 'urgent:1:2:3', 'urgent:0', 'a:1,a:2'):
+            with self.assertRaises((ValueError, AssertionError)):
+                parse_lanes(spec)
+
+
+class TestLaneScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.urgent = Lane('urgent', weight=8)
+        self.bulk = Lane('bulk', weight=1)
+        self.stats = WorkerStats(lanes=('urgent', 'bulk'))
+        self.scheduler = LaneScheduler([self.urgent, self.bulk], quantum=100, stats=self.stats)
+
+    def test_weighted(self):
+        for _ in range(100):
+            self.scheduler.put(self.bulk, message('bulk'))
+        for _ in range(100):
+            self.scheduler.put(self.urgent, message('urgent'))
+        self.assertEqual(len(self.scheduler), 200)
+
+        # A flood on the bulk lane (queued first) does not hold up the urgent lane.
+        taken = self.scheduler.round()
+        self.assertEqual(Counter(m.lane for m in taken), {'urgent': 8, 'bulk': 1})
+        self.assertEqual(len(self.scheduler), 191)
+
+    def test_deficit(self):
+        # Each bulk message costs 2.5 rounds' allowance, so it is forwarded every 2 or 3 rounds.
+        for _ in range(4):
+            self.scheduler.put(self.bulk, message('bulk', size=250))
+
+        counts = [len(self.scheduler.round()) for _ in range(10)]
+        self.assertEqual(counts, [0, 0, 1, 0, 1, 0, 0, 1, 0, 1])
+
+    def test_idle_lane(self):
+        # An idle lane does not save up an allowance.
+        self.scheduler.put(self.bulk, message('bulk', size=50))
+        self.scheduler.round()
+        self.assertEqual(self.bulk.deficit, 0)
+
+        for _ in range(3):
+            self.scheduler.put(self.bulk, message('bulk'))
+        self.assertEqual(len(self.scheduler.round()), 1)
+
+    def test_all_forwarded(self):
+        for n in range(30):
+            self.scheduler.put(self.urgent if n % 3 else self.bulk, message('lane', size=n + 1))
+
+        taken = []
+        while len(self.scheduler):
+            taken.extend(self.scheduler.round())
+        self.assertEqual(len(taken), 30)
+
+    def test_stats(self):
+        self.scheduler.put(self.urgent, message('urgent'))
+        self.scheduler.put(self.urgent, message('urgent'))
+        self.assertEqual(self.stats.as_dict()['lanes']['urgent']['buffered'], 2)
+
+        self.scheduler.round()
+
+        lanes = self.stats.as_dict()['lanes']
+        self.assertEqual(lanes['urgent']['forwarded'], 2)
+        self.assertEqual(lanes['urgent']['bytes'], 200)
+        self.assertEqual(lanes['urgent']['buffered'], 0)
+        self.assertGreaterEqual(lanes['urgent']['wait_seconds'], 0)
+        self.assertEqual(lanes['bulk'], dict(forwarded=0, bytes=0, wait_seconds=0.0, buffered=0))
+
+    def test_clear(self):
+        self.scheduler.put(self.urgent, message('urgent'))
+        self.scheduler.clear()
+
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertEqual(self.scheduler.round(), [])
+        self.assertEqual(self.stats.as_dict()['lanes']['urgent']['buffered'], 0)
+
+
+class TestRun(unittest.TestCase):
+
+    def test_lanes(self):
+        """ Messages from every lane are forwarded, and acknowledged (in batches) per lane. """
+
+        incoming, outgoing = make_configs()
+        queues = [incoming.queue + '_urgent', incoming.queue + '_bulk']
+        for queue in queues:
+            load(incoming._replace(queue=queue, binding_key=queue), 10)
+
+        with mock.patch.multiple('application.forwarder', INCOMING_LANES='{}:2,{}:1'.format(*queues),
+                                 ACK_BATCH_SIZE=4):
+            stats = run_worker(incoming, outgoing, lambda stats: stats.get('acked') >= 20,
+                               stats=WorkerStats(lanes=queues))
+
+        self.assertEqual(stats.get('acked'), 20)
+        self.assertEqual([stats.as_dict()['lanes'][queue]['forwarded'] for queue in queues], [10, 10])
+        with forwarder.setup_producer(cfg=outgoing) as producer:
+            self.assertEqual(queue_count(producer.channel, outgoing), 20)
@@ -0,0 +1,135 @@
+import unittest
+import mock
+from application import metrics, forwarder
+from application.workers import WorkerStats
+
+
+class TestLatencyHistograms(unittest.TestCase):
+
+    def setUp(self):
+        self.histograms = metrics.LatencyHistograms(('publish', 'ack'), window=60)
+        self.now = self.histograms.start()
+
+    def observe(self, stage, seconds, count=1, offset=0):
+        for _ in range(count):
+            self.histograms.observe(stage, seconds, self.now + offset)
+
+    def test_quantiles(self):
+        self.observe('publish', 0.001, 98)
+        self.observe('publish', 1.0, 2)
+
+        summary = metrics.latency_summary([self.histograms])['publish']
+        self.assertEqual(summary['count'], 100)
+        self.assertTrue(summary['p50'] <= 0.00128)
+        self.assertTrue(summary['p99'] >= 0.5)
+
+    def test_stages_separate(self):
+        self.observe('publish', 0.001)
+
+        summary = metrics.latency_summary([self.histograms])
+        self.assertEqual(summary['ack']['count'], 0)
+        self.assertEqual(summary['ack']['p50'], None)
+
+    def test_rolling_window(self):
+        self.observe('publish', 0.001)
+        self.observe('publish', 0.001, offset=61)
+        self.assertEqual(metrics.latency_summary([self.histograms])['publish']['count'], 2)
+
+        # The window before last is dropped.
+        self.observe('publish', 0.001, offset=122)
+        self.assertEqual(metrics.latency_summary([self.histograms])['publish']['count'], 2)
+
+    def test_aggregate(self):
+        other = metrics.LatencyHistograms(('publish',))
+        other.observe('publish', 0.001, self.now)
+        self.observe('publish', 0.001)
+
+        self.assertEqual(metrics.latency_summary([self.histograms, other])['publish']['count'], 2)
+
+
+class TestRender(unittest.TestCase):
+
+    def test_render(self):
+        text = metrics.render([('rp_test', 'summary', 'Test.', [({'quantile': 0.5}, 0.25), ('_count', {}, 4)])])
+
+        self.assertEqual(text, '# HELP rp_test Test.\n'
+                               '# TYPE rp_test summary\n'
+                               'rp_test{quantile="0.5"} 0.25\n'
+                               'rp_test_count 4\n')
+
+
+class TestLanes(unittest.TestCase):
+
+    def workers(self):
+        workers = []
+        for worker_id, forwarded in enumerate((2, 3)):
+            stats = WorkerStats(lanes=('urgent', 'bulk'))
+            stats.lane_incr('urgent', 'forwarded', forwarded)
+            stats.lane_incr('urgent', 'wait_seconds', 0.5)
+            status = stats.as_dict()
+            status['worker'] = worker_id
+            workers.append(status)
+        return workers
+
+    def test_summary(self):
+        summary = metrics.lane_summary(self.workers())
+
+        self.assertEqual(summary['urgent']['forwarded'], 5)
+        self.assertEqual(summary['urgent']['mean_wait_seconds'], 0.2)
+        self.assertIsNone(summary['bulk']['mean_wait_seconds'])
+
+    def test_families(self):
+        text = metrics.render(metrics.lane_families(self.workers()))
+
+        self.assertIn('rp_lane_messages_total{lane="urgent",worker="1"} 3\n', text)
+        self.assertIn('rp_lane_buffered{lane="bulk",worker="0"} 0\n', text)
+
+    def test_no_lanes(self):
+        self.assertEqual(metrics.lane_families([dict(WorkerStats().as_dict(), worker=0)]), [])
+
+
+class TestProcessStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = [WorkerStats(), WorkerStats()]
+        self.pool = mock.Mock(stats=self.stats)
+
+    def status(self):
+        return [dict(stats.as_dict(), worker=n, alive=True) for n, stats in enumerate(self.stats)]
+
+    def test_audit(self):
+        """ Worker processes have an audit sink each, so the parent gathers their status from their stats. """
+
+        sink = mock.Mock()
+        for n, stats in enumerate(self.stats):
+            sink.stats.return_value = dict(depth=n, written=10 * (n + 1), dropped=0, batches=n + 1,
+                                           last_flush_latency=0.01 * (n + 1), max_flush_latency=0.5)
+            with mock.patch('application.forwarder.audit_sink', sink):
+                forwarder.sample_process_stats(stats)
+
+        self.pool.status.return_value = self.status()
+        with mock.patch.multiple('application.forwarder', pool=self.pool, audit_sink=None, WORKER_MODE='process',
+                                 AUDIT_ASYNC=True, AUDIT_QUEUE_SIZE=100):
+            audit = forwarder.stats()['audit']
+
+        self.assertTrue(audit['enabled'])
+        self.assertEqual((audit['depth'], audit['capacity'], audit['written'], audit['batches']), (1, 200, 30, 3))
+        self.assertEqual((audit['last_flush_latency'], audit['max_flush_latency']), (0.02, 0.5))
+
+    def test_dedup(self):
+        cache = mock.Mock()
+        for n, stats in enumerate(self.stats):
+            cache.stats.return_value = dict(entries=5 * (n + 1), bytes=100 * (n + 1))
+            stats.incr('dedup_checks', 2)
+            stats.incr('duplicates', n)
+            with mock.patch.multiple('application.forwarder', audit_sink=None, dedup_cache=cache):
+                forwarder.sample_process_stats(stats)
+
+        self.pool.status.return_value = self.status()
+        with mock.patch.multiple('application.forwarder', pool=self.pool, dedup_cache=None, WORKER_MODE='process',
+                                 DEDUP=True, DEDUP_CAPACITY=1000, DEDUP_TTL=60):
+            dedup = forwarder.stats()['dedup']
+
+        self.assertTrue(dedup['enabled'])
+        self.assertEqual((dedup['entries'], dedup['capacity'], dedup['bytes']), (15, 2000, 300))
+        self.assertEqual((dedup['checks'], dedup['hits'], dedup['hit_rate']), (4, 1, 0.25))
@@ -0,0 +1,43 @@
+import json
+import unittest
+import mock
+from application import forwarder
+from tests.helpers import make_configs, get_all, run_worker
+
+
+@mock.patch('application.forwarder.PASSTHROUGH', True)
+class TestRun(unittest.TestCase):
+
+    def forward(self, body, **kwargs):
+        """ Forward a message, published to the incoming queue with 'body' and 'kwargs'; returns it as forwarded. """
+
+        incoming, outgoing = make_configs()
+        with forwarder.setup_producer(cfg=incoming) as producer:
+            producer.publish(body, routing_key=incoming.binding_key, **kwargs)
+
+        run_worker(incoming, outgoing, lambda stats: stats.get('acked') >= 1)
+
+        messages = get_all(outgoing)
+        self.assertEqual(len(messages), 1)
+        return messages[0]
+
+    def test_passthrough(self):
+        """ A JSON message is forwarded verbatim: not decoded (so not reformatted), with its properties and headers. """
+
+        body = '{"n":1,  "title":  "DN1"}'
+        headers = {'title_number': 'DN1', 'type': 'charge'}
+        message = self.forward(body, content_type='application/json', content_encoding='utf-8', headers=headers)
+
+        self.assertEqual(message.body, body.encode('utf-8'))
+        self.assertEqual((message.content_type, message.content_encoding), ('application/json', 'utf-8'))
+        self.assertEqual(message.headers, headers)
+
+    def test_decoded(self):
+        """ A message of any other content type is decoded, then serialized (as JSON) again. """
+
+        message = self.forward('DN1 changed', content_type='application/text', content_encoding='utf-8',
+                               headers={'title_number': 'DN1'})
+
+        self.assertEqual(json.loads(message.body), 'DN1 changed')
+        self.assertEqual((message.content_type, message.content_encoding), ('application/json', 'utf-8'))
+        self.assertEqual(message.headers, {})
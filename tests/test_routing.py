@@ -0,0 +1,41 @@
+import unittest
+from application.routing import RoutingKeyTemplate, routing_key_template, MAX_LENGTH
+
+
+class TestRoutingKeyTemplate(unittest.TestCase):
+
+    def test_headers(self):
+        template = RoutingKeyTemplate('register.{type}.{title_number:2}')
+        self.assertEqual(template({'type': 'title', 'title_number': 'DN100'}), 'register.title.DN')
+
+    def test_missing(self):
+        template = RoutingKeyTemplate('register.{type}.{title_number}', missing='other')
+        self.assertEqual(template({'type': 'title'}), 'register.title.other')
+        self.assertEqual(template(None), 'register.other.other')
+
+    def test_values_are_single_words(self):
+        template = RoutingKeyTemplate('{type}.end')
+        self.assertEqual(template({'type': 'a.b'}), 'a_b.end')
+        self.assertEqual(template({'type': b'raw'}), 'raw.end')
+        self.assertEqual(template({'type': 12}), '12.end')
+
+    def test_literal_braces(self):
+        template = RoutingKeyTemplate('{{x}}.{type}')
+        self.assertEqual(template({'type': 't'}), '{x}.t')
+
+    def test_length(self):
+        template = RoutingKeyTemplate('{type}')
+        self.assertEqual(len(template({'type': 'x' * 1000})), MAX_LENGTH)
+
+        # The limit is in bytes, and multi-byte characters are not cut in two.
+        key = template({'type': '\u00e9' * 1000})
+        self.assertEqual(len(key.encode('utf-8')), MAX_LENGTH - 1)
+        self.assertEqual(key, '\u00e9' * (MAX_LENGTH // 2))
+
+    def test_invalid(self):
+        for template in ('{}', '{type!r}', '{type:x}'):
+            with self.assertRaises(ValueError):
+                RoutingKeyTemplate(template)
+
+    def test_default(self):
+        self.assertIsNone(routing_key_template(''))
@@ -0,0 +1,96 @@
+import os
+import time
+import unittest
+import mock
+from application import signing
+from application.signing import Signer, sign, verify, verify_all
+from application.workers import WorkerPool
+
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
+
+KEYS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_keys')
+PRIVATE_KEY = os.path.join(KEYS, 'test_private.pem')
+PUBLIC_KEY = os.path.join(KEYS, 'test_public.pem')
+
+
+def sign_in_worker(worker_id, stats, stop):
+    """ Worker target: sign on a pool of processes of its own, as 'forwarder.run()' does if so configured. """
+
+    signer = Signer(PRIVATE_KEY, processes=2)
+    try:
+        bodies = [b'one', b'two', b'three']
+        if signer.sign_all(bodies) == [sign(body, PRIVATE_KEY) for body in bodies]:
+            stats.incr('signed', len(bodies))
+    finally:
+        signer.close()
+
+    stop.wait(10)
+
+
+@unittest.skipIf(cryptography is None, "'cryptography' not installed")
+class TestSigning(unittest.TestCase):
+
+    def test_sign_verify(self):
+        signature = sign(b'{"title_number": "DN1"}', PRIVATE_KEY)
+
+        self.assertTrue(verify(b'{"title_number": "DN1"}', signature, PUBLIC_KEY))
+        self.assertTrue(verify('{"title_number": "DN1"}', signature, PUBLIC_KEY))
+        self.assertFalse(verify(b'{"title_number": "DN2"}', signature, PUBLIC_KEY))
+        self.assertFalse(verify(b'{"title_number": "DN1"}', 'not a signature', PUBLIC_KEY))
+
+    def test_keys_cached(self):
+        self.assertIs(signing.load_private_key(PRIVATE_KEY), signing.load_private_key(PRIVATE_KEY))
+        self.assertIs(signing.load_public_key(PUBLIC_KEY), signing.load_public_key(PUBLIC_KEY))
+
+    def test_signer_inline(self):
+        signer = Signer(PRIVATE_KEY)
+        bodies = [b'one', b'two']
+
+        self.assertEqual(signer.sign_all(bodies), [sign(body, PRIVATE_KEY) for body in bodies])
+        self.assertEqual(signer.sign(b'one'), sign(b'one', PRIVATE_KEY))
+
+    def test_signer_pool(self):
+        signer = Signer(PRIVATE_KEY, processes=2, chunksize=4)
+        self.addCleanup(signer.close)
+        bodies = ['{{"n": {}}}'.format(n).encode('ascii') for n in range(20)]
+
+        # In the same order as the bodies, whichever process signed them.
+        signatures = signer.sign_all(bodies)
+        self.assertEqual(verify_all(zip(bodies, signatures), PUBLIC_KEY), [True] * 20)
+        self.assertEqual(signatures[7], sign(bodies[7], PRIVATE_KEY))
+
+    def test_verify_all(self):
+        bodies = [b'one', b'two', b'three']
+        items = [(body, sign(body, PRIVATE_KEY)) for body in bodies]
+        items[1] = (b'tampered', items[1][1])
+
+        self.assertEqual(verify_all(items, PUBLIC_KEY), [True, False, True])
+        self.assertEqual(verify_all(items, PUBLIC_KEY, processes=2), [True, False, True])
+
+    def test_worker_process(self):
+        """ Worker processes may have signing processes of their own (i.e. they are not daemonic). """
+
+        pool = WorkerPool(sign_in_worker, size=1, mode='process')
+        pool.start()
+        self.addCleanup(pool.stop, timeout=10)
+
+        deadline = time.monotonic() + 30
+        while not pool.stats[0].get('signed') and pool.workers[0].is_alive() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        self.assertEqual(pool.stats[0].get('signed'), 3)
+
+    def test_missing_key(self):
+        with self.assertRaises(OSError):
+            Signer(os.path.join(KEYS, 'missing.pem'))
+
+
+class TestWithoutCryptography(unittest.TestCase):
+
+    def test_required(self):
+        with mock.patch('application.signing.serialization', None):
+            with self.assertRaises(RuntimeError):
+                verify_all([], PUBLIC_KEY)
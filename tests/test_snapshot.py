@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+from application import snapshot
+from application import settings
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'stats.json')
+        self.reader = snapshot.SnapshotReader(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_missing(self):
+        self.assertEqual(self.reader.read(), {})
+
+    def test_write_read(self):
+        snapshot.write(self.path, {'workers': [{'worker': 0}]})
+
+        data = self.reader.read()
+        self.assertEqual(data['workers'], [{'worker': 0}])
+        self.assertIn('updated', data)
+
+        # Only the snapshot itself is left behind.
+        self.assertEqual(os.listdir(self.directory), ['stats.json'])
+
+    def test_replaced(self):
+        snapshot.write(self.path, {'pid': 1})
+        self.assertEqual(self.reader.read()['pid'], 1)
+
+        snapshot.write(self.path, {'pid': 2})
+        self.assertEqual(self.reader.read()['pid'], 2)
+
+
+class TestSettings(unittest.TestCase):
+
+    def test_load(self):
+        config = settings.load('config.TestConfig')
+        self.assertIn('INCOMING_CFG', config)
+        self.assertNotIn('Configuration', config)
@@ -0,0 +1,237 @@
+import os
+import time
+import shutil
+import json
+import tempfile
+import threading
+import unittest
+import mock
+import kombu
+import kombu.message
+from application import forwarder
+from application.spool import Spool, Spooler, SpoolFull, HEADER, in_use, undrained
+from tests.helpers import make_configs, get_all, load, run_worker, memory_confirms
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def spool(self, **kwargs):
+        kwargs.setdefault('segment_size', 1024)
+        kwargs.setdefault('max_bytes', 64 * 1024)
+        return Spool(self.directory, **kwargs)
+
+    def test_append_head_remove(self):
+        spool = self.spool()
+        spool.append(b'one', {'routing_key': 'a'})
+        spool.append(b'two', {'routing_key': 'b'})
+        spool.sync()
+
+        self.assertEqual(len(spool), 2)
+        seq, records = spool.head()
+        self.assertEqual([body for _, body in records], [b'one', b'two'])
+        self.assertEqual([meta['routing_key'] for meta, _ in records], ['a', 'b'])
+
+        spool.remove(seq)
+        self.assertEqual(len(spool), 0)
+        self.assertIsNone(spool.head())
+        self.assertEqual(os.listdir(self.directory), [])
+
+        # Appending after the head was read starts a new segment.
+        spool.append(b'three', {})
+        self.assertEqual(spool.head()[0], seq + 1)
+
+    def test_segments_in_order(self):
+        spool = self.spool()
+        for n in range(50):
+            spool.append(b'x' * 100, {'n': n})
+
+        self.assertGreater(len(spool.segments), 1)
+
+        drained = []
+        while spool.head() is not None:
+            seq, records = spool.head()
+            drained.extend(meta['n'] for meta, _ in records)
+            spool.remove(seq)
+
+        self.assertEqual(drained, list(range(50)))
+
+    def test_reopen(self):
+        spool = self.spool()
+        spool.append(b'one', {})
+        spool.append(b'two', {})
+        spool.close()
+
+        spool = self.spool()
+        self.assertEqual(len(spool), 2)
+        self.assertEqual(spool.bytes, os.path.getsize(os.path.join(self.directory, os.listdir(self.directory)[0])))
+        self.assertIsNotNone(spool.oldest())
+
+        spool.append(b'three', {})
+        seq, records = spool.head()
+        self.assertEqual([body for _, body in records], [b'one', b'two'])
+
+    def test_partial_record(self):
+        spool = self.spool()
+        spool.append(b'one', {})
+        spool.append(b'two', {})
+        spool.close()
+
+        # As if the process died part way through writing the second record.
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 2)
+
+        seq, records = self.spool().head()
+        self.assertEqual([body for _, body in records], [b'one'])
+
+    def test_corrupt_record(self):
+        spool = self.spool()
+        spool.append(b'one', {})
+        spool.close()
+
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(path, 'r+b') as f:
+            f.seek(os.path.getsize(path) - 1)
+            f.write(b'X')
+
+        self.assertEqual(self.spool().head()[1], [])
+
+    def test_max_bytes(self):
+        spool = self.spool(max_bytes=1024)
+        with self.assertRaises(SpoolFull):
+            for _ in range(20):
+                spool.append(b'x' * 100, {})
+
+        self.assertLessEqual(spool.bytes, 1024)
+        self.assertGreater(spool.bytes, 1024 - (HEADER.size + 200))
+
+    def test_max_age(self):
+        spool = self.spool(max_age=60)
+        spool.append(b'one', {})
+
+        with mock.patch('application.spool.time.time', return_value=time.time() + 61):
+            with self.assertRaises(SpoolFull):
+                spool.append(b'two', {})
+
+        self.assertEqual(len(spool), 1)
+
+    def test_stats(self):
+        spool = self.spool()
+        self.assertEqual(spool.stats(), dict(messages=0, bytes=0, segments=0, oldest_age=0.0))
+
+        spool.append(b'one', {})
+        stats = spool.stats()
+        self.assertEqual(stats['messages'], 1)
+        self.assertEqual(stats['segments'], 1)
+        self.assertGreater(stats['bytes'], 3)
+        self.assertGreaterEqual(stats['oldest_age'], 0)
+
+    def test_in_use(self):
+        self.assertFalse(in_use(self.directory))
+
+        spool = self.spool()
+        self.assertTrue(in_use(self.directory))
+        with self.assertRaises(RuntimeError):
+            self.spool()
+
+        spool.close()
+        self.assertFalse(in_use(self.directory))
+
+
+class TestSpooler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_drain_steps(self):
+        """ The spool is drained a window at a time, returning in between; a segment goes once it is all confirmed. """
+
+        incoming, outgoing = make_configs()
+        spool = Spool(self.directory)
+        for n in range(5):
+            spool.append(json.dumps({'n': n}).encode('utf-8'), dict(routing_key=outgoing.queue,
+                                                                   content_type='application/json',
+                                                                   content_encoding='utf-8', headers={},
+                                                                   compression=None))
+        spool.sync()
+
+        unspooled = []
+        with memory_confirms():
+            spooler = Spooler(spool, lambda: forwarder.setup_producer(cfg=outgoing, confirm_publish=False),
+                              lambda meta, body: unspooled.append(json.loads(body)['n']), window=2)
+            self.addCleanup(spooler.close)
+
+            spooler.maybe_drain()
+            self.assertEqual(unspooled, [0, 1])
+            self.assertEqual(len(spool.segments), 1)
+
+            spooler.maybe_drain()
+            spooler.maybe_drain()
+
+        self.assertEqual(unspooled, list(range(5)))
+        self.assertEqual(spool.segments, {})
+        self.assertEqual([json.loads(message.body)['n'] for message in get_all(outgoing)], list(range(5)))
+
+    def test_undrained(self):
+        """ Spools of worker ids beyond the number of workers, with segments left in them, are not drained. """
+
+        for worker_id in (0, 2, 3, 10):
+            spool = Spool(os.path.join(self.directory, str(worker_id)))
+            if worker_id != 3:
+                spool.append(b'body', {})
+            spool.close()
+
+        self.assertEqual(undrained(self.directory, 2), [os.path.join(self.directory, name) for name in ('2', '10')])
+        self.assertEqual(undrained(self.directory, 11), [])
+        self.assertEqual(undrained(os.path.join(self.directory, 'none'), 1), [])
+
+
+class TestRun(unittest.TestCase):
+
+    def test_outgoing_down(self):
+        """ While the outgoing broker is down messages are spooled, then forwarded in order once it is back. """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        incoming, outgoing = make_configs()
+        load(incoming, 20)
+
+        # The broker goes down at the sixth message and is back once the rest have been spooled.
+        down = threading.Event()
+        outages = []
+        publish, ack = kombu.Producer.publish, kombu.message.Message.ack
+        acked = []
+
+        def outgoing_publish(producer, body, **kwargs):
+            if producer.exchange.name == outgoing.exchange.name:
+                if json.loads(body)['n'] == 5 and not outages:
+                    outages.append(body)
+                    down.set()
+                if down.is_set():
+                    raise ConnectionError('down')
+            return publish(producer, body, **kwargs)
+
+        def incoming_ack(message, *args, **kwargs):
+            acked.append(json.loads(message.body)['n'])
+            return ack(message, *args, **kwargs)
+
+        def until(stats):
+            if stats.get('spooled') >= 15:
+                down.clear()
+            return stats.get('unspooled') >= 15
+
+        with memory_confirms(), mock.patch('application.forwarder.SPOOL_DIR', directory), \
+                mock.patch.object(kombu.Producer, 'publish', outgoing_publish), \
+                mock.patch.object(kombu.message.Message, 'ack', incoming_ack):
+            stats = run_worker(incoming, outgoing, until, timeout=20)
+
+        self.assertEqual((stats.get('spooled'), stats.get('unspooled'), stats.get('spool_messages')), (15, 15, 0))
+        self.assertEqual(sorted(acked), list(range(20)))
+
+        self.assertEqual([json.loads(message.body)['n'] for message in get_all(outgoing)], list(range(20)))